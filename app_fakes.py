@@ -0,0 +1,487 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-ins for the App Engine and Cloud APIs used by the app.
+
+Lets offline tools load ``language-app/main.py`` (along with
+``appengine_config.py``) outside of App Engine and exercise its routes
+with the Flask test client:
+
+* ``google.appengine.ext.vendor``, ``google.appengine.api.app_identity``
+  and ``google.appengine.api.memcache`` are replaced by in-memory fakes.
+* The real ``LanguageServiceClient`` (and real ``google.auth``
+  credential discovery) is used, but over a fake gRPC channel that
+  answers requests locally with deterministic responses.
+
+Must be run with a Python 2.7 that has ``grpcio`` installed (e.g.
+``language-app/clean-env``), just like the ``dev_appserver``.
+"""
+
+import os
+import random
+import re
+import site
+import sys
+import tempfile
+import threading
+import time
+import types
+import zlib
+
+
+APP_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'language-app')
+SERVICE_PREFIX = '/google.cloud.language.v1.LanguageService/'
+FAKE_APP_ID = 'fake-app'
+FAKE_EMAIL = 'fake-app@appspot.gserviceaccount.com'
+TOKEN_LIFETIME = 3600
+TRACEBACK_MARKER = b'Traceback (most recent call last)'
+
+
+def _add_module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    parent_name, _, child_name = name.rpartition('.')
+    if parent_name:
+        setattr(sys.modules[parent_name], child_name, module)
+    return module
+
+
+def _vendor_add(path):
+    """Stand-in for ``google.appengine.ext.vendor.add``."""
+    path = os.path.abspath(path)
+    if not os.path.isdir(path):
+        raise ValueError('vendor.add: {} is not a directory'.format(path))
+    sys.path.insert(0, path)
+    site.addsitedir(path)
+
+
+_MEMCACHE = []
+
+
+def _memcache():
+    """The shared ``result_cache.FakeMemcache`` (built after ``lib/``)."""
+    if not _MEMCACHE:
+        import result_cache
+        _MEMCACHE.append(result_cache.FakeMemcache())
+    return _MEMCACHE[0]
+
+
+def _memcache_get(key):
+    return _memcache().get(key)
+
+
+def _memcache_set(key, value, time=0):
+    return _memcache().set(key, value, time=time)
+
+
+def _get_access_token(scopes, service_account_id=None):
+    token = 'fake-token-{:08x}'.format(zlib.crc32(repr(scopes)) & 0xffffffff)
+    return token, int(time.time()) + TOKEN_LIFETIME
+
+
+def _sign_blob(bytes_to_sign, deadline=None):
+    signature = '{:08x}'.format(zlib.crc32(bytes_to_sign) & 0xffffffff) * 8
+    return 'fake-key', signature
+
+
+def add_vendor_lib(app_dir=APP_DIR):
+    """Make the app's vendored ``lib/`` importable (without the app)."""
+    _vendor_add(os.path.join(app_dir, 'lib'))
+
+
+def install_appengine():
+    """Install fake ``google.appengine`` modules in ``sys.modules``.
+
+    Like the SDK, ``google`` is a package that vendored namespace
+    packages (via their ``*-nspkg.pth`` files) extend.
+    """
+    if 'google' not in sys.modules:
+        _add_module('google', __path__=[])
+    _add_module('google.appengine', __path__=[])
+    _add_module('google.appengine.ext', __path__=[])
+    _add_module('google.appengine.ext.vendor', add=_vendor_add)
+    _add_module('google.appengine.api', __path__=[])
+    _add_module(
+        'google.appengine.api.memcache',
+        get=_memcache_get, set=_memcache_set)
+    _add_module(
+        'google.appengine.api.app_identity',
+        get_access_token=_get_access_token,
+        get_access_token_uncached=_get_access_token,
+        sign_blob=_sign_blob,
+        get_application_id=lambda: FAKE_APP_ID,
+        get_default_gcs_bucket_name=lambda: FAKE_APP_ID + '.appspot.com',
+        get_default_version_hostname=lambda: 'localhost:8080',
+        get_public_certificates=lambda deadline=None: [],
+        get_service_account_name=lambda deadline=None: FAKE_EMAIL)
+
+
+def _score(content):
+    """A deterministic sentiment score in ``[-1, 1]`` for some text."""
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    bucket = zlib.crc32(content) & 0xffff
+    return round(2.0 * bucket / 0xffff - 1.0, 2)
+
+
+def _split_sentences(content):
+    sentences = []
+    offset = 0
+    for piece in content.replace('!', '.').replace('?', '.').split('.'):
+        stripped = piece.strip()
+        if stripped:
+            begin = content.index(stripped, offset)
+            sentences.append((stripped, begin))
+            offset = begin + len(stripped)
+    return sentences
+
+
+def analyze_sentiment(request):
+    """Build a deterministic ``AnalyzeSentimentResponse``.
+
+    Each sentence gets a score derived from a hash of its text. The
+    document score is the magnitude-weighted mean of the sentences.
+    """
+    from google.cloud.language_v1 import types as language_types
+
+    content = request.document.content
+    sentences = []
+    total_magnitude = 0.0
+    weighted = 0.0
+    for text, begin in _split_sentences(content):
+        score = _score(text)
+        magnitude = abs(score)
+        total_magnitude += magnitude
+        weighted += score * magnitude
+        sentences.append(language_types.Sentence(
+            text=language_types.TextSpan(content=text, begin_offset=begin),
+            sentiment=language_types.Sentiment(
+                score=score, magnitude=magnitude)))
+
+    doc_score = weighted / total_magnitude if total_magnitude else 0.0
+    return language_types.AnalyzeSentimentResponse(
+        document_sentiment=language_types.Sentiment(
+            score=round(doc_score, 2), magnitude=total_magnitude),
+        language='en',
+        sentences=sentences)
+
+
+def annotate_text(request):
+    """Build a deterministic ``AnnotateTextResponse``.
+
+    Sentences are as in :func:`analyze_sentiment`, each word is a
+    ``NOUN`` token and each capitalized word is an ``OTHER`` entity.
+    """
+    from google.cloud.language_v1 import types as language_types
+
+    content = request.document.content
+    features = request.features
+    response = language_types.AnnotateTextResponse(language='en')
+    if features.extract_document_sentiment or features.extract_syntax:
+        sentiment = analyze_sentiment(request)
+        response.sentences.extend(sentiment.sentences)
+        if features.extract_document_sentiment:
+            response.document_sentiment.CopyFrom(
+                sentiment.document_sentiment)
+        else:
+            for sentence in response.sentences:
+                sentence.ClearField('sentiment')
+
+    for match in re.finditer(r'\w+', content, re.UNICODE):
+        word, begin = match.group(), match.start()
+        if features.extract_syntax:
+            token = response.tokens.add()
+            token.text.content = word
+            token.text.begin_offset = begin
+            token.part_of_speech.tag = language_types.PartOfSpeech.NOUN
+            token.lemma = word.lower()
+            edge = token.dependency_edge
+            edge.head_token_index = len(response.tokens) - 1
+            edge.label = language_types.DependencyEdge.ROOT
+        if features.extract_entities and word[:1].isupper():
+            entity = response.entities.add(
+                name=word, type=language_types.Entity.OTHER,
+                salience=abs(_score(word)))
+            mention = entity.mentions.add()
+            mention.text.content = word
+            mention.text.begin_offset = begin
+    return response
+
+
+def _annotate(request, **features):
+    from google.cloud.language_v1 import types as language_types
+
+    return annotate_text(language_types.AnnotateTextRequest(
+        document=request.document, features=features,
+        encoding_type=request.encoding_type))
+
+
+def analyze_entities(request):
+    """Build a deterministic ``AnalyzeEntitiesResponse``."""
+    from google.cloud.language_v1 import types as language_types
+
+    annotated = _annotate(request, extract_entities=True)
+    return language_types.AnalyzeEntitiesResponse(
+        entities=annotated.entities, language=annotated.language)
+
+
+def analyze_entity_sentiment(request):
+    """Build a deterministic ``AnalyzeEntitySentimentResponse``."""
+    from google.cloud.language_v1 import types as language_types
+
+    annotated = _annotate(request, extract_entities=True)
+    for entity in annotated.entities:
+        score = _score(entity.name)
+        entity.sentiment.score = score
+        entity.sentiment.magnitude = abs(score)
+    return language_types.AnalyzeEntitySentimentResponse(
+        entities=annotated.entities, language=annotated.language)
+
+
+def analyze_syntax(request):
+    """Build a deterministic ``AnalyzeSyntaxResponse``."""
+    from google.cloud.language_v1 import types as language_types
+
+    annotated = _annotate(request, extract_syntax=True)
+    return language_types.AnalyzeSyntaxResponse(
+        sentences=annotated.sentences, tokens=annotated.tokens,
+        language=annotated.language)
+
+
+HANDLERS = {
+    'AnalyzeSentiment': analyze_sentiment,
+    'AnalyzeEntities': analyze_entities,
+    'AnalyzeEntitySentiment': analyze_entity_sentiment,
+    'AnalyzeSyntax': analyze_syntax,
+    'AnnotateText': annotate_text,
+}
+
+
+def rpc_error(code_name, details=''):
+    """Build a ``grpc.RpcError`` like the one a failed call raises.
+
+    Args:
+        code_name (str): The name of a ``grpc.StatusCode``, e.g.
+            ``'RESOURCE_EXHAUSTED'``.
+        details (str): The error details.
+
+    Returns:
+        grpc.RpcError: The error, with ``code()`` and ``details()``.
+    """
+    import grpc
+
+    class FakeRpcError(grpc.RpcError):
+
+        def code(self):
+            return grpc.StatusCode[code_name]
+
+        def details(self):
+            return details
+
+    return FakeRpcError(code_name, details)
+
+
+def inject_errors(handlers, rate, code_name='RESOURCE_EXHAUSTED', seed=None):
+    """Wrap handlers so that a fraction of the calls fail.
+
+    Args:
+        handlers (Dict[str, Callable]): Handlers (e.g. :data:`HANDLERS`).
+        rate (float): The probability (in ``[0, 1]``) that a call fails.
+        code_name (str): The status code of the failures.
+        seed (Optional[int]): Seeds the failures (for repeatable runs).
+
+    Returns:
+        Dict[str, Callable]: The wrapped handlers.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    def wrap(handler):
+        def flaky_handler(request):
+            with lock:
+                fail = rng.random() < rate
+            if fail:
+                raise rpc_error(code_name, 'Injected failure')
+            return handler(request)
+        return flaky_handler
+
+    return dict((name, wrap(handler)) for name, handler in handlers.items())
+
+
+class _FakeUnaryUnary(object):
+    """A unary-unary "multi-callable" that answers locally."""
+
+    def __init__(self, channel, method):
+        self.channel = channel
+        self.method = method
+
+    def __call__(self, request, timeout=None, metadata=None,
+                 credentials=None):
+        return self.channel.handle(self.method, request)
+
+    def with_call(self, request, timeout=None, metadata=None,
+                  credentials=None):
+        return self(request), None
+
+
+class FakeChannel(object):
+    """Stand-in for ``grpc.Channel`` that answers requests locally.
+
+    Requests and responses are not serialized; each method name is
+    looked up in ``handlers`` (by default :data:`HANDLERS`).
+
+    Args:
+        handlers (Optional[Dict[str, Callable]]): Maps a method name
+            (e.g. ``'AnalyzeSentiment'``) to a function that takes the
+            request message and returns the response message.
+        latency (float): Seconds to sleep in each call (to simulate the
+            round trip to the API).
+    """
+
+    def __init__(self, handlers=None, latency=0.0):
+        if handlers is None:
+            handlers = HANDLERS
+        self.handlers = handlers
+        self.latency = latency
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def handle(self, method, request):
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        handler = None
+        if method.startswith(SERVICE_PREFIX):
+            handler = self.handlers.get(method[len(SERVICE_PREFIX):])
+        if handler is None:
+            raise NotImplementedError(method)
+        return handler(request)
+
+    def unary_unary(self, method, request_serializer=None,
+                    response_deserializer=None):
+        return _FakeUnaryUnary(self, method)
+
+    def subscribe(self, callback, try_to_connect=False):
+        import grpc
+
+        # NOTE: The fake channel is always connected.
+        callback(grpc.ChannelConnectivity.READY)
+
+    def unsubscribe(self, callback):
+        pass
+
+
+def fake_client_factory(channel=None):
+    """Build a client factory for ``language_api.ClientPool``.
+
+    Mirrors ``language_api._default_factory`` (credentials are still
+    discovered via ``google.auth.default()``) except for the channel.
+
+    Args:
+        channel (Optional[object]): The channel to use. Defaults to a
+            new :class:`FakeChannel`.
+
+    Returns:
+        Callable[[], language_api.ClientHandle]: The factory.
+    """
+    def factory():
+        import google.auth
+        import google.auth.transport.grpc
+        import google.auth.transport.requests
+        from google.cloud import language_v1
+
+        import language_api
+
+        client_class = language_v1.LanguageServiceClient
+        credentials, _ = google.auth.default(scopes=client_class._ALL_SCOPES)
+        # NOTE: Not used by the fake channel, but built for parity.
+        google.auth.transport.grpc.AuthMetadataPlugin(
+            credentials, google.auth.transport.requests.Request())
+        client_channel = channel
+        if client_channel is None:
+            client_channel = FakeChannel()
+        client = client_class(channel=client_channel)
+        return language_api.ClientHandle(
+            client, channel=client_channel, credentials=credentials)
+
+    return factory
+
+
+def install_fakes(channel=None):
+    """Point the (already imported) app modules at the local fakes.
+
+    If ``LANGUAGE_API_TARGET`` is set (e.g. to a running
+    ``fake_language_server.py``), the app's own (real gRPC) client is
+    kept and ``channel`` is not used.
+    """
+    import language_api
+
+    if os.environ.get(language_api.TARGET_ENV):
+        return
+    language_api.POOL.factory = fake_client_factory(channel=channel)
+    language_api.POOL.current = None
+
+
+def response_ok(response):
+    """Check if a test client response succeeded.
+
+    Args:
+        response (flask.Response): The response (it will be consumed and
+            closed, as a WSGI server would).
+
+    Returns:
+        bool: Indicating the status was not an error and the body does
+        not contain a traceback (as rendered by ``PrettyErrors``).
+    """
+    try:
+        data = response.get_data()
+    finally:
+        response.close()
+    return response.status_code < 400 and TRACEBACK_MARKER not in data
+
+
+def load_app(app_dir=APP_DIR, channel=None):
+    """Load ``main.app`` (after ``appengine_config``) with fakes.
+
+    Changes the working directory to ``app_dir`` (``appengine_config``
+    uses paths relative to the app root). The plain ``lib/`` is used
+    unless ``VENDOR_BUNDLE`` is set in the environment.
+
+    Args:
+        app_dir (str): The root of the App Engine app.
+        channel (Optional[object]): The channel used by the Language
+            client. Defaults to a new :class:`FakeChannel`.
+
+    Returns:
+        flask.Flask: The WSGI application.
+    """
+    os.chdir(app_dir)
+    os.environ.setdefault('VENDOR_BUNDLE', '0')
+    os.environ.setdefault('LANGUAGE_CACHE_SHARED', 'fake')
+    # NOTE: Make sure ``google.auth.default()`` finds the (fake) App
+    #       Engine credentials rather than any local ones.
+    os.environ.pop('GOOGLE_APPLICATION_CREDENTIALS', None)
+    os.environ['CLOUDSDK_CONFIG'] = tempfile.mkdtemp()
+    if app_dir not in sys.path:
+        sys.path.insert(0, app_dir)
+
+    install_appengine()
+    import appengine_config
+    import main
+
+    install_fakes(channel=channel)
+    return main.app
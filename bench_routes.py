@@ -0,0 +1,372 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Offline benchmark of the routes in ``language-app/main.py``.
+
+Loads the app with the stand-ins in ``app_fakes.py`` (so no App Engine
+SDK, credentials or network are needed) and requests each route with the
+Flask test client from a number of threads. Since the app is
+``threadsafe``, this shows how each route scales with concurrency before
+raising ``max_concurrent_requests``. The Language API round trip is
+simulated with ``--rpc-latency``::
+
+    $ language-app/clean-env/bin/python bench_routes.py \\
+    >     --threads 1,4,8 --output bench.json
+    $ # ... change something ...
+    $ language-app/clean-env/bin/python bench_routes.py \\
+    >     --threads 1,4,8 --compare bench.json
+
+To include real gRPC (serialization and HTTP/2) in the round trip, run
+``fake_language_server.py`` and set ``LANGUAGE_API_TARGET`` (e.g. to
+``localhost:50051``); ``--rpc-latency`` and ``--error-rate`` are then
+configured on the server instead.
+
+Reports the p50 / p95 / p99 latency and the requests per second for each
+route at each thread count, and writes them as JSON.
+"""
+
+from __future__ import print_function
+
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+
+import app_fakes
+
+
+DEFAULT_THREADS = (1, 2, 4, 8)
+DEFAULT_REQUESTS = 200
+DEFAULT_WARMUP = 5
+DEFAULT_RPC_LATENCY = 0.05
+PERCENTILES = (50, 95, 99)
+
+
+def _batch_body(count):
+    # NOTE: Unique content per request, so the result cache always misses.
+    return [
+        'Request {} is great. It is not bad.'.format(count),
+        {'content': '<p>Request {} is terrible.</p>'.format(count),
+         'type': 'HTML'},
+    ]
+
+
+def _annotate_body(count):
+    return {
+        'document': 'Request {} from Alice is great. Bob is not.'.format(
+            count),
+        'features': ['sentiment', 'entities', 'syntax'],
+    }
+
+
+def _chunked_body(count):
+    # NOTE: About 8KB, i.e. four chunks of (at most) 2KB.
+    sentences = [
+        'Request {} sentence {} is rather good.'.format(count, index)
+        for index in range(200)]
+    return {'document': ' '.join(sentences)}
+
+
+# NOTE: Each route is ``(name, method, path, body)``, where ``body`` is
+#       :data:`None` or a function of a per-request counter that returns
+#       the JSON body. ``/system-tests`` always sends the same document,
+#       so (after the first request) it measures cache hits.
+ROUTES = (
+    ('index', 'GET', '/', None),
+    ('info', 'GET', '/info', None),
+    ('auth-check', 'GET', '/auth-check', None),
+    ('system-tests', 'GET', '/system-tests', None),
+    ('analyze-batch', 'POST', '/analyze/batch', _batch_body),
+    ('annotate', 'POST', '/analyze/annotate', _annotate_body),
+    ('chunked', 'POST', '/analyze/chunked?max_bytes=2048', _chunked_body),
+    ('cache-stats', 'GET', '/cache-stats', None),
+)
+
+
+def percentile(sorted_values, percent):
+    """Get a percentile (nearest-rank) of some sorted values."""
+    if not sorted_values:
+        return None
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class _Route(object):
+    """Issues requests for a single route (from any thread)."""
+
+    def __init__(self, app, name, method, path, body):
+        self.app = app
+        self.name = name
+        self.method = method
+        self.path = path
+        self.body = body
+        self._counter = itertools.count()
+        self._local = threading.local()
+
+    def request(self):
+        """Make one request.
+
+        Returns:
+            Tuple[float, bool]: The latency (in seconds) and whether the
+            request succeeded.
+        """
+        # NOTE: A test client is not thread-safe, so each thread has one.
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self.app.test_client()
+            self._local.client = client
+
+        kwargs = {}
+        if self.body is not None:
+            kwargs['data'] = json.dumps(self.body(next(self._counter)))
+            kwargs['content_type'] = 'application/json'
+        start = time.time()
+        response = client.open(self.path, method=self.method, **kwargs)
+        ok = app_fakes.response_ok(response)
+        return time.time() - start, ok
+
+
+def run_route(route, threads, requests, warmup=DEFAULT_WARMUP):
+    """Request a route ``requests`` times, split across ``threads``.
+
+    Args:
+        route (_Route): The route to request.
+        threads (int): The number of concurrent threads.
+        requests (int): The total number of (measured) requests.
+        warmup (int): The number of requests made (and not measured)
+            before starting.
+
+    Returns:
+        dict: The latency percentiles (in milliseconds), requests per
+        second and error count.
+    """
+    for _ in range(warmup):
+        route.request()
+
+    remaining = itertools.count()
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker():
+        while next(remaining) < requests:
+            latency, ok = route.request()
+            with lock:
+                latencies.append(latency)
+                if not ok:
+                    errors.append(latency)
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies.sort()
+    result = {
+        'route': route.name,
+        'method': route.method,
+        'path': route.path,
+        'threads': threads,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'rps': round(len(latencies) / elapsed, 2),
+        'mean_ms': round(1000.0 * sum(latencies) / len(latencies), 3),
+        'max_ms': round(1000.0 * latencies[-1], 3),
+    }
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        result['p{}_ms'.format(percent)] = round(1000.0 * value, 3)
+    return result
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).strip().decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(route_names=None, thread_counts=DEFAULT_THREADS,
+        requests=DEFAULT_REQUESTS, rpc_latency=DEFAULT_RPC_LATENCY,
+        warmup=DEFAULT_WARMUP, error_rate=0.0, app_dir=app_fakes.APP_DIR):
+    """Benchmark routes of the app.
+
+    Args:
+        route_names (Optional[Iterable[str]]): The names of the routes to
+            run (from :data:`ROUTES`). Defaults to all of them.
+        thread_counts (Iterable[int]): The thread counts to run each
+            route with.
+        requests (int): The number of measured requests per route and
+            thread count.
+        rpc_latency (float): Seconds the fake Language API takes per
+            call.
+        warmup (int): Unmeasured requests per route and thread count.
+        error_rate (float): The fraction of fake Language API calls that
+            fail with ``RESOURCE_EXHAUSTED``.
+        app_dir (str): The root of the App Engine app.
+
+    Returns:
+        dict: Information about the run and a list of results (see
+        :func:`run_route`).
+    """
+    # NOTE: ``appengine_config`` stubs out ``subprocess``, so this is
+    #       done before loading the app.
+    revision = _git_revision()
+    handlers = app_fakes.HANDLERS
+    if error_rate:
+        handlers = app_fakes.inject_errors(handlers, error_rate, seed=0)
+    channel = app_fakes.FakeChannel(handlers=handlers, latency=rpc_latency)
+    app = app_fakes.load_app(app_dir, channel=channel)
+
+    known = dict((route[0], route) for route in ROUTES)
+    if route_names is None:
+        route_names = [route[0] for route in ROUTES]
+    routes = [_Route(app, *known[name]) for name in route_names]
+
+    results = []
+    for route in routes:
+        for threads in thread_counts:
+            result = run_route(route, threads, requests, warmup=warmup)
+            print(format_result(result))
+            results.append(result)
+
+    return {
+        'revision': revision,
+        'python': platform.python_version(),
+        'created': time.time(),
+        'requests': requests,
+        'rpc_latency': rpc_latency,
+        'error_rate': error_rate,
+        'rpc_calls': channel.calls,
+        'results': results,
+    }
+
+
+def format_result(result):
+    return (
+        '{route:>14s} x{threads:<3d} {rps:9.1f} req/s  p50 {p50_ms:8.2f}ms  '
+        'p95 {p95_ms:8.2f}ms  p99 {p99_ms:8.2f}ms  errors {errors}').format(
+            **result)
+
+
+def compare(baseline, current):
+    """Compare the results of two runs.
+
+    Args:
+        baseline (dict): The earlier run (see :func:`run`).
+        current (dict): The later run.
+
+    Returns:
+        List[str]: A line per route / thread count found in both runs,
+        with the change in throughput and p50 / p99 latency.
+    """
+    previous = dict(
+        ((result['route'], result['threads']), result)
+        for result in baseline['results'])
+    lines = ['Compared to {} (current {}):'.format(
+        baseline.get('revision'), current.get('revision'))]
+    for result in current['results']:
+        before = previous.get((result['route'], result['threads']))
+        if before is None:
+            continue
+        changes = []
+        for key in ('rps', 'p50_ms', 'p99_ms'):
+            if before[key]:
+                change = 100.0 * (result[key] - before[key]) / before[key]
+                changes.append('{} {:+.1f}%'.format(key, change))
+        lines.append('{:>14s} x{:<3d} {}'.format(
+            result['route'], result['threads'], '  '.join(changes)))
+    return lines
+
+
+def _thread_counts(value):
+    try:
+        counts = tuple(int(count) for count in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('Expected e.g. 1,4,8', value)
+    if not counts or min(counts) < 1:
+        raise argparse.ArgumentTypeError('Expected e.g. 1,4,8', value)
+    return counts
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the app routes with local fakes.')
+    parser.add_argument(
+        '--route', dest='route_names', action='append',
+        choices=[route[0] for route in ROUTES],
+        help='A route to benchmark (can be repeated; default: all).')
+    parser.add_argument(
+        '--threads', type=_thread_counts, default=DEFAULT_THREADS,
+        help='Comma-separated thread counts (default: 1,2,4,8).')
+    parser.add_argument(
+        '--requests', type=int, default=DEFAULT_REQUESTS,
+        help='Measured requests per route and thread count.')
+    parser.add_argument(
+        '--warmup', type=int, default=DEFAULT_WARMUP,
+        help='Unmeasured requests per route and thread count.')
+    parser.add_argument(
+        '--rpc-latency', type=float, default=DEFAULT_RPC_LATENCY,
+        help='Seconds the fake Language API takes per call.')
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0,
+        help='Fraction of fake Language API calls that fail with '
+             'RESOURCE_EXHAUSTED.')
+    parser.add_argument('--output', help='Write the results to a JSON file.')
+    parser.add_argument(
+        '--compare', help='A JSON file from an earlier run to compare to.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    # NOTE: Loading the app changes the working directory.
+    output = args.output and os.path.abspath(args.output)
+    baseline = None
+    if args.compare:
+        # NOTE: Read before running, in case it is also the ``--output``.
+        with open(args.compare, 'r') as file_obj:
+            baseline = json.load(file_obj)
+
+    current = run(
+        route_names=args.route_names, thread_counts=args.threads,
+        requests=args.requests, rpc_latency=args.rpc_latency,
+        warmup=args.warmup, error_rate=args.error_rate)
+
+    if baseline is not None:
+        for line in compare(baseline, current):
+            print(line)
+    if output:
+        with open(output, 'w') as file_obj:
+            json.dump(current, file_obj, indent=2, sort_keys=True)
+        print('Wrote {}'.format(output))
+
+    if any(result['errors'] for result in current['results']):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
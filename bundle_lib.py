@@ -0,0 +1,216 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bundle a vendored ``lib/`` into a precompiled ``zipimport`` archive.
+
+Every ``import`` from a plain directory costs several filesystem stats
+(and on App Engine there are no ``.pyc`` files to re-use). This compiles
+the vendored packages to bytecode and packs them into a single archive
+that ``zipimport`` reads once. The output directory contains:
+
+* ``lib.zip``: The bytecode (and data files) for every zip-safe package.
+* ``bundle.json``: The archive name and the namespace packages (e.g.
+  ``google``) that ``appengine_config.py`` must extend.
+* Plain copies of packages that are not zip-safe (they need real files
+  on disk) and of all ``*.dist-info`` / ``*.egg-info`` metadata.
+
+Must be run with the same Python (2.7) used by the runtime, so the
+bytecode magic number matches.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import py_compile
+import shutil
+import sys
+import tempfile
+import zipfile
+
+
+ARCHIVE_NAME = 'lib.zip'
+BUNDLE_INFO = 'bundle.json'
+# NOTE: ``certifi.where()`` returns a path to a real ``.pem`` file.
+NOT_ZIP_SAFE = ('certifi',)
+INFO_SUFFIXES = ('.dist-info', '.egg-info')
+# NOTE: ``.pth`` files are only processed for ``sys.path`` directories
+#       (``bundle.json`` replaces ``*-nspkg.pth``) and App Engine can't
+#       load vendored extension modules.
+SKIP_SUFFIXES = ('.pyc', '.pyo', '.pth', '.so', '.pyd')
+
+
+def _is_namespace(dirpath, filenames):
+    """Check if a directory is an ``__init__.py``-less namespace package."""
+    if '__init__.py' in filenames:
+        return False
+    for _, _, sub_filenames in os.walk(dirpath):
+        if any(filename.endswith('.py') for filename in sub_filenames):
+            return True
+    return False
+
+
+def _compile(src_path, tmp_dir):
+    """Compile a source file to bytecode in a scratch location.
+
+    Returns:
+        Optional[str]: The path of the bytecode file, or :data:`None`
+        if the file does not compile (e.g. Python 3 only code).
+    """
+    cfile = os.path.join(tmp_dir, 'module.pyc')
+    try:
+        py_compile.compile(src_path, cfile=cfile, doraise=True)
+    except py_compile.PyCompileError as exc:
+        print('Skipping bytecode for {}: {}'.format(src_path, exc.msg),
+              file=sys.stderr)
+        return None
+    return cfile
+
+
+class _Stats(object):
+
+    def __init__(self):
+        self.zipped = 0
+        self.copied = 0
+        self.skipped = []
+
+
+def _zip_entry(archive, src_dir, name, keep_source, tmp_dir, stats,
+               namespaces):
+    """Add a top-level entry of ``src_dir`` to the archive."""
+    top_path = os.path.join(src_dir, name)
+    if os.path.isfile(top_path):
+        walk = [(src_dir, [], [name])]
+    else:
+        walk = os.walk(top_path)
+
+    for dirpath, _, filenames in walk:
+        rel_dir = os.path.relpath(dirpath, src_dir)
+        if rel_dir != '.' and _is_namespace(dirpath, filenames):
+            # NOTE: Only a namespace package (or the top level) can
+            #       contain a namespace package.
+            parent = os.path.dirname(rel_dir).replace(os.sep, '.')
+            if not parent or parent in namespaces:
+                namespaces.append(rel_dir.replace(os.sep, '.'))
+
+        for filename in sorted(filenames):
+            src_path = os.path.join(dirpath, filename)
+            arcname = os.path.relpath(src_path, src_dir).replace(os.sep, '/')
+            if filename.endswith(SKIP_SUFFIXES):
+                stats.skipped.append(arcname)
+                continue
+
+            if filename.endswith('.py'):
+                cfile = _compile(src_path, tmp_dir)
+                if cfile is not None:
+                    archive.write(cfile, arcname + 'c')
+                if cfile is None or keep_source:
+                    archive.write(src_path, arcname)
+            else:
+                archive.write(src_path, arcname)
+            stats.zipped += 1
+
+
+def _copy_entry(src_dir, dest_dir, name, stats):
+    """Copy a top-level entry of ``src_dir`` as-is (following links)."""
+    src_path = os.path.join(src_dir, name)
+    dest_path = os.path.join(dest_dir, name)
+    if os.path.isdir(src_path):
+        shutil.copytree(src_path, dest_path, symlinks=False)
+    else:
+        shutil.copy2(src_path, dest_path)
+    stats.copied += 1
+
+
+def bundle(src_dir, dest_dir, keep_source=False, not_zip_safe=NOT_ZIP_SAFE):
+    """Bundle the packages in ``src_dir`` into ``dest_dir``.
+
+    Args:
+        src_dir (str): The vendored directory (i.e. ``lib``).
+        dest_dir (str): The bundle directory to (re-)create.
+        keep_source (bool): Whether to also store ``.py`` files in the
+            archive (for readable tracebacks).
+        not_zip_safe (Iterable[str]): Top-level names to copy as-is.
+
+    Returns:
+        _Stats: Counts of zipped, copied and skipped files.
+    """
+    if os.path.exists(dest_dir):
+        shutil.rmtree(dest_dir)
+    os.makedirs(dest_dir)
+
+    stats = _Stats()
+    namespaces = []
+    tmp_dir = tempfile.mkdtemp()
+    archive_path = os.path.join(dest_dir, ARCHIVE_NAME)
+    archive = zipfile.ZipFile(archive_path, 'w', zipfile.ZIP_DEFLATED)
+    try:
+        for name in sorted(os.listdir(src_dir)):
+            if name.endswith(INFO_SUFFIXES) or name in not_zip_safe:
+                _copy_entry(src_dir, dest_dir, name, stats)
+            elif name.endswith(SKIP_SUFFIXES):
+                stats.skipped.append(name)
+            else:
+                _zip_entry(archive, src_dir, name, keep_source, tmp_dir,
+                           stats, namespaces)
+    finally:
+        archive.close()
+        shutil.rmtree(tmp_dir)
+
+    info = {
+        'archive': ARCHIVE_NAME,
+        'namespaces': sorted(namespaces),
+    }
+    with open(os.path.join(dest_dir, BUNDLE_INFO), 'w') as file_obj:
+        json.dump(info, file_obj, indent=2, sort_keys=True)
+
+    return stats
+
+
+def _tree_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Bundle vendored packages into a zipimport archive.')
+    parser.add_argument('src_dir', help='The vendored directory (lib).')
+    parser.add_argument('dest_dir', help='The bundle directory to create.')
+    parser.add_argument(
+        '--keep-source', action='store_true',
+        help='Also store .py files in the archive.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    stats = bundle(args.src_dir, args.dest_dir, keep_source=args.keep_source)
+    for name in stats.skipped:
+        print('Skipped {}'.format(name))
+    msg = (
+        'Bundled {} files into {} ({} entries copied as-is): '
+        '{:.1f} MB -> {:.1f} MB').format(
+            stats.zipped, os.path.join(args.dest_dir, ARCHIVE_NAME),
+            stats.copied, _tree_size(args.src_dir) / 1e6,
+            _tree_size(args.dest_dir) / 1e6)
+    print(msg)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,23 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Helper to convert a JSON key file into a PEM PKCS#1 key."""
+"""Helper to convert a JSON key file into a PEM PKCS#1 key.
+
+The conversion (from the PKCS#8 key in the JSON key file) is done in
+process with ``rsa`` and ``pyasn1``. If they are not installed, the
+copies vendored into ``language-app/lib`` are used.
+"""
 
 from __future__ import print_function
 
 import argparse
+import glob
+import hashlib
 import os
 import json
-import subprocess
 import sys
 
-try:
-    import py
-except ImportError:
-    py = None
-
 
 ENV_VAR = 'GOOGLE_APPLICATION_CREDENTIALS'
+VENDOR_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'language-app', 'lib')
+PKCS1_MARKER = 'RSA PRIVATE KEY'
+PKCS8_MARKER = 'PRIVATE KEY'
+RSA_ENCRYPTION_OID = '1.2.840.113549.1.1.1'
+DEFAULT_WORKERS = 8
+CACHE_VERSION = 1
+
+
+class ConversionError(Exception):
+    """A key could not be converted (or checked)."""
 
 
 def _require_env():
@@ -86,141 +98,309 @@ def get_key_json():
     return key_json, json_filename
 
 
-def _require_py():
-    if py is None:
-        msg = 'py (https://pypi.org/project/py/) must be installed.'
-        print(msg, file=sys.stderr)
-        sys.exit(1)
-
+def _import_rsa():
+    """Import ``rsa`` and ``pyasn1``, falling back to the vendored copies.
 
-def _require_openssl():
-    """Check that ``openssl`` is on the PATH.
+    Returns:
+        Tuple[module, module, module, module]: The ``rsa``, ``rsa.pem``,
+        ``pyasn1.codec.der.decoder`` and ``pyasn1_modules.rfc5208``
+        modules.
 
-    Assumes :func:`_require_py` has been checked.
+    Raises:
+        ConversionError: If they can't be imported.
     """
-    if py.path.local.sysfind('openssl') is None:
-        msg = '``openssl`` command line tool must be installed.'
-        print(msg, file=sys.stderr)
-        sys.exit(1)
+    try:
+        import rsa
+    except ImportError:
+        if os.path.isdir(VENDOR_DIR) and VENDOR_DIR not in sys.path:
+            sys.path.append(VENDOR_DIR)
+
+    try:
+        import rsa
+        import rsa.pem
+        from pyasn1.codec.der import decoder
+        from pyasn1_modules import rfc5208
+    except ImportError:
+        msg = (
+            '``rsa`` and ``pyasn1-modules`` must be installed (or '
+            'vendored in {}, via ``make language-app/lib``).').format(
+                VENDOR_DIR)
+        raise ConversionError(msg)
+
+    return rsa, rsa.pem, decoder, rfc5208
 
 
-def _pkcs8_filename(pkcs8_pem, base):
-    """Create / check a PKCS#8 file.
+def pkcs1_der(pkcs8_pem):
+    """Convert a PEM PKCS#8 RSA private key to DER PKCS#1.
 
-    Exits with 1 if the file already exists and differs from
-    ``pkcs8_pem``. If the file does not exists, creates it with
-    ``pkcs8_pem`` as contents and sets permissions to 0400.
+    The PKCS#1 key is the ``privateKey`` field of the PKCS#8 structure
+    (i.e. this is what ``openssl rsa`` does).
 
     Args:
-        pkcs8_pem (str): The contents to be stored (or checked).
-        base (str): The base file path (without extension).
+        pkcs8_pem (str): The PEM PKCS#8 key (as in a JSON key file).
 
     Returns:
-        str: The filename that was checked / created.
+        bytes: The DER PKCS#1 key.
+
+    Raises:
+        ConversionError: If the key can't be parsed or is not RSA.
     """
-    pkcs8_filename = '{}-PKCS8.pem'.format(base)
-    if os.path.exists(pkcs8_filename):
-        with open(pkcs8_filename, 'r') as file_obj:
-            contents = file_obj.read()
+    rsa, rsa_pem, decoder, rfc5208 = _import_rsa()
+    try:
+        pkcs8_der = rsa_pem.load_pem(pkcs8_pem, PKCS8_MARKER)
+        key_info, remaining = decoder.decode(
+            pkcs8_der, asn1Spec=rfc5208.PrivateKeyInfo())
+    except Exception as exc:
+        raise ConversionError('Invalid PKCS#8 key: {}'.format(exc))
+    if remaining:
+        raise ConversionError('Invalid PKCS#8 key: unused bytes.')
+
+    algorithm = key_info.getComponentByName('privateKeyAlgorithm')
+    oid = str(algorithm.getComponentByName('algorithm'))
+    if oid != RSA_ENCRYPTION_OID:
+        raise ConversionError('Not an RSA key (algorithm {}).'.format(oid))
+
+    der = key_info.getComponentByName('privateKey').asOctets()
+    try:
+        # NOTE: Make sure the PKCS#1 key is valid before using it.
+        rsa.PrivateKey.load_pkcs1(der, format='DER')
+    except Exception as exc:
+        raise ConversionError('Invalid PKCS#1 key: {}'.format(exc))
+    return der
+
+
+def _pkcs1_verify(der, pkcs1_filename):
+    """Verify the contents of an existing PKCS#1 file.
 
-        if contents != pkcs8_pem:
-            msg = 'PKCS#8 file {} already exists.'.format(pkcs8_filename)
-            print(msg, file=sys.stderr)
-            sys.exit(1)
-    else:
-        with open(pkcs8_filename, 'w') as file_obj:
-            file_obj.write(pkcs8_pem)
-        # Protect the file from being read by other users..
-        os.chmod(pkcs8_filename, 0o400)
+    The keys are compared as DER, so PEM formatting differences (e.g.
+    line lengths) don't matter.
 
-    return pkcs8_filename
+    Args:
+        der (bytes): The expected DER PKCS#1 key.
+        pkcs1_filename (str): The PKCS#1 file to check against.
 
+    Raises:
+        ConversionError: If the file can't be read or holds another key.
+    """
+    _, rsa_pem, _, _ = _import_rsa()
+    try:
+        with open(pkcs1_filename, 'rb') as file_obj:
+            existing_der = rsa_pem.load_pem(file_obj.read(), PKCS1_MARKER)
+    except (IOError, ValueError) as exc:
+        msg = 'Failed checking contents of {}: {}'.format(
+            pkcs1_filename, exc)
+        raise ConversionError(msg)
+
+    if existing_der != der:
+        msg = 'PKCS#1 file {} already exists.'.format(pkcs1_filename)
+        raise ConversionError(msg)
 
-def _pkcs1_verify(pkcs8_filename, pkcs1_filename):
-    """Verify the contents of an existing PKCS#1 file.
 
-    Does so by using ``openssl rsa`` to print to stdout and
-    then checking against contents.
+def _pkcs1_create(der, pkcs1_filename):
+    """Create a PKCS#1 file.
 
-    Exits with 1 if:
+    Args:
+        der (bytes): The DER PKCS#1 key.
+        pkcs1_filename (str): The PKCS#1 file to be created.
+    """
+    _, rsa_pem, _, _ = _import_rsa()
+    with open(pkcs1_filename, 'wb') as file_obj:
+        file_obj.write(rsa_pem.save_pem(der, PKCS1_MARKER))
+    # Protect the file from being read by other users..
+    os.chmod(pkcs1_filename, 0o400)
+
+
+def _pkcs1_filename(json_filename):
+    base, _ = os.path.splitext(json_filename)
+    return '{}-PKCS1.pem'.format(base)
 
-    * The ``openssl`` command fails
-    * The ``pkcs1_filename`` contents differ from what was produced
-      by ``openssl``
+
+def convert_key(pkcs8_pem, json_filename, create=True):
+    """Convert the key from a JSON key file into a PKCS#1 file.
+
+    If the PKCS#1 file already exists, it is checked instead.
 
     Args:
-        pkcs8_filename (str): The PKCS#8 file to be converted.
-        pkcs1_filename (str): The PKCS#1 file to check against.
+        pkcs8_pem (str): The PEM PKCS#8 key.
+        json_filename (str): The JSON key file (the PKCS#1 filename is
+            based on it).
+        create (bool): Whether to create a missing PKCS#1 file.
+
+    Returns:
+        str: The PKCS#1 filename.
+
+    Raises:
+        ConversionError: If the key is invalid, an existing PKCS#1 file
+            differs, or (when not ``create``) the file is missing.
     """
-    cmd = (
-        'openssl',
-        'rsa',
-        '-in',
-        pkcs8_filename,
-    )
-    process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return_code = process.wait()
-
-    if return_code != 0:
-        msg = 'Failed checking contents of {} against openssl.'.format(
-            pkcs1_filename)
-        print(msg, file=sys.stderr)
-        sys.exit(1)
+    der = pkcs1_der(pkcs8_pem)
+    pkcs1_filename = _pkcs1_filename(json_filename)
+    if os.path.exists(pkcs1_filename):
+        _pkcs1_verify(der, pkcs1_filename)
+    elif create:
+        _pkcs1_create(der, pkcs1_filename)
+    else:
+        msg = 'PKCS#1 file {} does not exist.'.format(pkcs1_filename)
+        raise ConversionError(msg)
 
-    cmd_output = process.stdout.read().decode('utf-8')
-    with open(pkcs1_filename, 'r') as file_obj:
-        expected_contents = file_obj.read()
+    return pkcs1_filename
+
+
+def _cache_filename(json_filename):
+    base, _ = os.path.splitext(json_filename)
+    # NOTE: Not ``.json``, so that :func:`batch` doesn't mistake it for a
+    #       key file.
+    return '{}-PKCS1.cache'.format(base)
 
-    if cmd_output != expected_contents:
-        msg = 'PKCS#1 file {} already exists.'.format(pkcs1_filename)
-        print(msg, file=sys.stderr)
-        sys.exit(1)
 
+def _cache_entry(pkcs8_pem, pkcs1_filename):
+    """Describe a key and the PKCS#1 file converted from it.
+
+    Raises:
+        OSError: If the PKCS#1 file does not exist.
+    """
+    digest = hashlib.sha256(pkcs8_pem.encode('utf-8')).hexdigest()
+    stat_result = os.stat(pkcs1_filename)
+    return {
+        'version': CACHE_VERSION,
+        'key_sha256': digest,
+        'pkcs1_filename': pkcs1_filename,
+        'pkcs1_size': stat_result.st_size,
+        'pkcs1_mtime': stat_result.st_mtime,
+    }
 
-def _pkcs1_create(pkcs8_filename, pkcs1_filename):
-    """Create a existing PKCS#1 file from a PKCS#8 file.
 
-    Does so by using ``openssl rsa -in * -out *``.
+def cached_convert_key(pkcs8_pem, json_filename):
+    """Convert (or check) a key, unless it is unchanged since last time.
 
-    Exits with 1 if the ``openssl`` command fails.
+    After a successful :func:`convert_key`, the SHA-256 of the private
+    key and the size / mtime of the PKCS#1 file are stored next to the
+    JSON key file. If both still match, conversion and verification are
+    skipped entirely.
 
     Args:
-        pkcs8_filename (str): The PKCS#8 file to be converted.
-        pkcs1_filename (str): The PKCS#1 file to be created.
+        pkcs8_pem (str): The PEM PKCS#8 key.
+        json_filename (str): The JSON key file.
+
+    Returns:
+        str: The PKCS#1 filename.
+
+    Raises:
+        ConversionError: If :func:`convert_key` fails.
     """
-    cmd = (
-        'openssl',
-        'rsa',
-        '-in',
-        pkcs8_filename,
-        '-out',
-        pkcs1_filename,
-    )
-    process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    return_code = process.wait()
-    if return_code != 0:
-        msg = 'Failed to convert {} to {} with openssl.'.format(
-            pkcs8_filename, pkcs1_filename)
-        print(msg, file=sys.stderr)
-        sys.exit(1)
+    pkcs1_filename = _pkcs1_filename(json_filename)
+    cache_filename = _cache_filename(json_filename)
+    try:
+        with open(cache_filename, 'r') as file_obj:
+            cached = json.load(file_obj)
+        if cached == _cache_entry(pkcs8_pem, pkcs1_filename):
+            return pkcs1_filename
+    except (IOError, OSError, ValueError):
+        pass
+
+    convert_key(pkcs8_pem, json_filename)
+    with open(cache_filename, 'w') as file_obj:
+        json.dump(
+            _cache_entry(pkcs8_pem, pkcs1_filename), file_obj,
+            indent=2, sort_keys=True)
+    return pkcs1_filename
 
 
-def convert_key(pkcs8_pem, json_filename):
-    _require_py()
-    _require_openssl()
+def _make_escape(value):
+    return value.replace('$', '$$')
 
-    base, _ = os.path.splitext(json_filename)
-    pkcs8_filename = _pkcs8_filename(pkcs8_pem, base)
 
-    pkcs1_filename = '{}-PKCS1.pem'.format(base)
-    if os.path.exists(pkcs1_filename):
-        _pkcs1_verify(pkcs8_filename, pkcs1_filename)
-    else:
-        _pkcs1_create(pkcs8_filename, pkcs1_filename)
+def format_values(email, pkcs1_filename, output_format):
+    """Format the ``dev_appserver`` values for the key.
 
-    return pkcs1_filename
+    Args:
+        email (str): The service account email.
+        pkcs1_filename (str): The PKCS#1 filename.
+        output_format (str): Either ``'make'`` (a fragment that can be
+            ``include``-d by a ``Makefile``) or ``'json'``.
+
+    Returns:
+        str: The formatted values.
+    """
+    if output_format == 'json':
+        values = {'email': email, 'pkcs1': pkcs1_filename}
+        return json.dumps(values, indent=2, sort_keys=True) + '\n'
+
+    return '\n'.join([
+        '# Generated by convert_key.py; do not edit.',
+        'GAE_EMAIL := {}'.format(_make_escape(email)),
+        'GAE_KEY := {}'.format(_make_escape(pkcs1_filename)),
+        '',
+    ])
+
+
+def _write_if_changed(filename, contents):
+    """Write a file, unless it already has the given contents.
+
+    Leaving the file (and its mtime) alone means ``make`` does not
+    restart after remaking an included fragment that didn't change.
+    """
+    try:
+        with open(filename, 'r') as file_obj:
+            if file_obj.read() == contents:
+                return
+    except IOError:
+        pass
+
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'w') as file_obj:
+        file_obj.write(contents)
+    os.rename(tmp_filename, filename)
+
+
+def _convert_file(json_filename, create):
+    """Convert (or check) a single JSON key file for :func:`batch`."""
+    try:
+        with open(json_filename, 'r') as file_obj:
+            key_json = json.load(file_obj)
+    except (IOError, ValueError) as exc:
+        raise ConversionError('Invalid JSON key file: {}'.format(exc))
+
+    pkcs8_pem = key_json.get('private_key') if isinstance(
+        key_json, dict) else None
+    if pkcs8_pem is None:
+        raise ConversionError('``private_key`` missing in JSON key file')
+    return convert_key(pkcs8_pem, json_filename, create=create)
+
+
+def batch(directory, create=True, max_workers=DEFAULT_WORKERS):
+    """Convert (or check) every JSON key file in a directory concurrently.
+
+    Args:
+        directory (str): The directory containing ``*.json`` key files.
+        create (bool): Whether to create missing PKCS#1 files (otherwise
+            only existing files are checked).
+        max_workers (int): The number of files handled concurrently.
+
+    Returns:
+        List[Tuple[str, Optional[str], Optional[ConversionError]]]: The
+        JSON filename, PKCS#1 filename (on success) and error (on
+        failure) for each file, sorted by filename.
+    """
+    # NOTE: Import once up front, rather than racing in the workers (this
+    #       may also add the vendored ``lib/``, which has ``futures``).
+    _import_rsa()
+    from concurrent import futures
+
+    json_filenames = sorted(glob.glob(os.path.join(directory, '*.json')))
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = [
+            executor.submit(_convert_file, json_filename, create)
+            for json_filename in json_filenames
+        ]
+
+    results = []
+    for json_filename, future in zip(json_filenames, pending):
+        try:
+            results.append((json_filename, future.result(), None))
+        except ConversionError as exc:
+            results.append((json_filename, None, exc))
+    return results
 
 
 def get_args():
@@ -238,16 +418,38 @@ def get_args():
     group.add_argument(
         '--clean', action='store_true',
         help='Clean up any created files.')
+    group.add_argument(
+        '--batch', metavar='DIRECTORY',
+        help='Convert every JSON key file in a directory.')
+    group.add_argument(
+        '--make', dest='output_format', action='store_const', const='make',
+        help='Print both values as a Makefile fragment.')
+    group.add_argument(
+        '--json', dest='output_format', action='store_const', const='json',
+        help='Print both values as JSON.')
+    parser.add_argument(
+        '--output', metavar='FILENAME',
+        help=('With --make / --json, write to a file (only if the values '
+              'changed) rather than printing.'))
+    parser.add_argument(
+        '--check', action='store_true',
+        help='With --batch, only check existing PKCS#1 files.')
+    parser.add_argument(
+        '--workers', type=int, default=DEFAULT_WORKERS,
+        help='With --batch, the number of files handled concurrently.')
 
     return parser.parse_args()
 
 
 def _clean(json_filename):
     base, _ = os.path.splitext(json_filename)
-    pkcs1_filename = '{}-PKCS1.pem'.format(base)
+    pkcs1_filename = _pkcs1_filename(json_filename)
+    # NOTE: The PKCS#8 file was only needed (as input) for ``openssl``.
     pkcs8_filename = '{}-PKCS8.pem'.format(base)
 
-    for filename in (pkcs1_filename, pkcs8_filename):
+    cache_filename = _cache_filename(json_filename)
+
+    for filename in (pkcs1_filename, pkcs8_filename, cache_filename):
         try:
             os.remove(filename)
             print('Removed {}'.format(filename))
@@ -255,16 +457,55 @@ def _clean(json_filename):
             pass
 
 
+def _batch_main(args):
+    results = batch(
+        args.batch, create=not args.check, max_workers=args.workers)
+    if not results:
+        msg = 'No JSON key files in {}.'.format(args.batch)
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    failed = 0
+    for json_filename, pkcs1_filename, error in results:
+        if error is None:
+            print('{} -> {}'.format(json_filename, pkcs1_filename))
+        else:
+            failed += 1
+            msg = '{}: {}'.format(json_filename, error)
+            print(msg, file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
+
+def _require_pkcs1(pkcs8_pem, json_filename):
+    try:
+        return cached_convert_key(pkcs8_pem, json_filename)
+    except ConversionError as exc:
+        print(exc, file=sys.stderr)
+        sys.exit(1)
+
+
 def main():
     args = get_args()
+    if args.batch is not None:
+        _batch_main(args)
+        return
 
     key_json, json_filename = get_key_json()
     if args.email:
         print(_require_email(key_json))
     elif args.pkcs1:
         pkcs8_pem = _require_private_key(key_json)
-        pkcs1_filename = convert_key(pkcs8_pem, json_filename)
-        print(pkcs1_filename)
+        print(_require_pkcs1(pkcs8_pem, json_filename))
+    elif args.output_format is not None:
+        email = _require_email(key_json)
+        pkcs8_pem = _require_private_key(key_json)
+        pkcs1_filename = _require_pkcs1(pkcs8_pem, json_filename)
+        contents = format_values(email, pkcs1_filename, args.output_format)
+        if args.output is None:
+            sys.stdout.write(contents)
+        else:
+            _write_if_changed(args.output, contents)
     elif args.clean:
         _clean(json_filename)
     else:
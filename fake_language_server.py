@@ -0,0 +1,323 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local (insecure) gRPC stand-in for the Cloud Natural Language API.
+
+Serves every ``LanguageService`` method with the deterministic responses
+built in ``app_fakes.py`` (or canned responses from a JSON file), with
+optional latency and injected errors, so the app can be load tested
+without live services or quota::
+
+    $ language-app/clean-env/bin/python fake_language_server.py \\
+    >     --port 50051 --latency exponential:0.05 \\
+    >     --error RESOURCE_EXHAUSTED=0.02
+
+and then point the app at it, e.g.
+``make language-app-run LANGUAGE_API_TARGET=localhost:50051``.
+
+A latency is ``constant:SECONDS`` (or just ``SECONDS``),
+``uniform:LOW,HIGH``, ``exponential:MEAN`` or ``lognormal:MEDIAN,SIGMA``.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+
+import app_fakes
+
+
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 50051
+DEFAULT_WORKERS = 16
+SERVICE_NAME = 'google.cloud.language.v1.LanguageService'
+METHODS = (
+    'AnalyzeSentiment',
+    'AnalyzeEntities',
+    'AnalyzeEntitySentiment',
+    'AnalyzeSyntax',
+    'AnnotateText',
+)
+DISTRIBUTIONS = {
+    'constant': (1, lambda rng, seconds: seconds),
+    'uniform': (2, lambda rng, low, high: rng.uniform(low, high)),
+    'exponential': (1, lambda rng, mean: rng.expovariate(1.0 / mean)),
+    'lognormal': (
+        2, lambda rng, median, sigma: rng.lognormvariate(
+            math.log(median), sigma)),
+}
+
+
+def parse_latency(spec):
+    """Parse a latency distribution (see the module docstring).
+
+    Args:
+        spec (str): The distribution, e.g. ``exponential:0.05``.
+
+    Returns:
+        Callable[[random.Random], float]: Samples a latency (in seconds).
+
+    Raises:
+        ValueError: If ``spec`` is not valid.
+    """
+    name, _, args = spec.partition(':')
+    if not args:
+        name, args = 'constant', name
+    if name not in DISTRIBUTIONS:
+        raise ValueError('Unknown distribution', name, sorted(DISTRIBUTIONS))
+    num_args, sample = DISTRIBUTIONS[name]
+    values = tuple(float(value) for value in args.split(','))
+    if len(values) != num_args or min(values) < 0:
+        raise ValueError('Invalid arguments for distribution', spec)
+    if name in ('exponential', 'lognormal') and values[0] == 0:
+        raise ValueError('Invalid arguments for distribution', spec)
+    return lambda rng: max(0.0, sample(rng, *values))
+
+
+def parse_error(spec):
+    """Parse an injected error, e.g. ``RESOURCE_EXHAUSTED=0.05``.
+
+    Returns:
+        Tuple[str, float]: The status code name and rate.
+
+    Raises:
+        ValueError: If ``spec`` is not valid.
+    """
+    import grpc
+
+    code_name, _, rate = spec.partition('=')
+    if code_name not in grpc.StatusCode.__members__:
+        raise ValueError('Unknown status code', code_name)
+    rate = float(rate)
+    if not 0.0 <= rate <= 1.0:
+        raise ValueError('Expected a rate in [0, 1]', spec)
+    return code_name, rate
+
+
+def load_responses(filename):
+    """Load canned responses (as JSON) keyed by method name.
+
+    Args:
+        filename (str): A JSON file like ``{"AnalyzeSentiment":
+            {"documentSentiment": {"score": 0.5}}}``.
+
+    Returns:
+        Dict[str, object]: The response message for each method listed.
+    """
+    from google.cloud.language_v1.proto import language_service_pb2
+    from google.protobuf import json_format
+
+    with open(filename, 'r') as file_obj:
+        info = json.load(file_obj)
+    responses = {}
+    for method, value in info.items():
+        if method not in METHODS:
+            raise ValueError('Unknown method', method, METHODS)
+        response_class = getattr(language_service_pb2, method + 'Response')
+        responses[method] = json_format.ParseDict(value, response_class())
+    return responses
+
+
+class FakeLanguageService(object):
+    """Answers ``LanguageService`` calls, with latency and errors.
+
+    Args:
+        handlers (Optional[Dict[str, Callable]]): Builds the response to
+            a request, per method. Defaults to ``app_fakes.HANDLERS``.
+        responses (Optional[Dict[str, object]]): Canned responses (used
+            instead of ``handlers``), per method.
+        latency (Optional[Callable[[random.Random], float]]): Samples
+            the latency of each call (see :func:`parse_latency`).
+        method_latency (Optional[Dict[str, Callable]]): Overrides
+            ``latency`` for some methods.
+        errors (Sequence[Tuple[str, float]]): Status code names and the
+            fraction of calls that fail with each.
+        seed (Optional[int]): Seeds the latency and errors.
+    """
+
+    def __init__(self, handlers=None, responses=None, latency=None,
+                 method_latency=None, errors=(), seed=None):
+        if handlers is None:
+            handlers = app_fakes.HANDLERS
+        self.handlers = handlers
+        self.responses = responses or {}
+        self.latency = latency
+        self.method_latency = method_latency or {}
+        self.errors = tuple(errors)
+        self.calls = dict((method, 0) for method in METHODS)
+        self.injected = dict((code_name, 0) for code_name, _ in self.errors)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _sample(self, method):
+        """Pick the latency and (injected) error for a call."""
+        latency = self.method_latency.get(method, self.latency)
+        with self._lock:
+            self.calls[method] += 1
+            delay = 0.0 if latency is None else latency(self._rng)
+            draw = self._rng.random()
+            for code_name, rate in self.errors:
+                if draw < rate:
+                    self.injected[code_name] += 1
+                    return delay, code_name
+                draw -= rate
+        return delay, None
+
+    def handle(self, method, request, context):
+        import grpc
+        from google.cloud.language_v1.proto import language_service_pb2
+
+        delay, code_name = self._sample(method)
+        if delay:
+            time.sleep(delay)
+        if code_name is not None:
+            context.set_code(grpc.StatusCode[code_name])
+            context.set_details('Injected by fake_language_server.py')
+            return getattr(language_service_pb2, method + 'Response')()
+        if method in self.responses:
+            return self.responses[method]
+        return self.handlers[method](request)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'calls': dict(self.calls),
+                'injected': dict(self.injected),
+            }
+
+
+def build_server(service, address, max_workers=DEFAULT_WORKERS):
+    """Build a gRPC server for a :class:`FakeLanguageService`.
+
+    Args:
+        service (FakeLanguageService): Answers the calls.
+        address (str): The ``host:port`` to listen on.
+        max_workers (int): The number of threads serving calls.
+
+    Returns:
+        Tuple[grpc.Server, int]: The (not yet started) server and the
+        port it is bound to.
+    """
+    from concurrent import futures
+
+    import grpc
+    from google.cloud.language_v1.proto import language_service_pb2
+
+    def behavior(method):
+        return lambda request, context: service.handle(
+            method, request, context)
+
+    method_handlers = {}
+    for method in METHODS:
+        request_class = getattr(language_service_pb2, method + 'Request')
+        response_class = getattr(language_service_pb2, method + 'Response')
+        method_handlers[method] = grpc.unary_unary_rpc_method_handler(
+            behavior(method),
+            request_deserializer=request_class.FromString,
+            response_serializer=response_class.SerializeToString)
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=max_workers))
+    server.add_generic_rpc_handlers([
+        grpc.method_handlers_generic_handler(SERVICE_NAME, method_handlers),
+    ])
+    port = server.add_insecure_port(address)
+    return server, port
+
+
+def _method_latency(value):
+    method, _, spec = value.partition('=')
+    if method not in METHODS:
+        raise argparse.ArgumentTypeError(
+            'Unknown method {!r}, expected one of {}'.format(
+                method, ', '.join(METHODS)))
+    return method, _argument(parse_latency)(spec)
+
+
+def _argument(parse):
+    def parse_argument(value):
+        try:
+            return parse(value)
+        except ValueError as exc:
+            raise argparse.ArgumentTypeError(str(exc))
+    return parse_argument
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Serve a fake Cloud Natural Language API locally.')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        '--workers', type=int, default=DEFAULT_WORKERS,
+        help='Threads serving calls.')
+    parser.add_argument(
+        '--latency', type=_argument(parse_latency),
+        help='Latency of every call, e.g. exponential:0.05.')
+    parser.add_argument(
+        '--method-latency', dest='method_latency', action='append',
+        type=_method_latency, default=[],
+        help='Latency of one method, e.g. AnnotateText=uniform:0.1,0.3 '
+             '(can be repeated).')
+    parser.add_argument(
+        '--error', dest='errors', action='append',
+        type=_argument(parse_error), default=[],
+        help='Fail a fraction of calls with a status code, e.g. '
+             'RESOURCE_EXHAUSTED=0.05 (can be repeated).')
+    parser.add_argument(
+        '--responses',
+        help='JSON file of canned responses, keyed by method name.')
+    parser.add_argument(
+        '--seed', type=int, help='Seed for the latency and errors.')
+    return parser.parse_args()
+
+
+def main():
+    # NOTE: The handlers use the (vendored) ``google-cloud-language``.
+    app_fakes.add_vendor_lib()
+    args = get_args()
+    if sum(rate for _, rate in args.errors) > 1.0:
+        sys.exit('The error rates add up to more than 1')
+
+    responses = None
+    if args.responses:
+        responses = load_responses(args.responses)
+    service = FakeLanguageService(
+        responses=responses, latency=args.latency,
+        method_latency=dict(args.method_latency), errors=args.errors,
+        seed=args.seed)
+    address = '{}:{}'.format(args.host, args.port)
+    server, port = build_server(service, address, max_workers=args.workers)
+    if not port:
+        sys.exit('Could not bind to {}'.format(address))
+
+    server.start()
+    print('Serving {} on {}:{} (Ctrl-C to stop)'.format(
+        SERVICE_NAME, args.host, port))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop(0)
+        print(json.dumps(service.stats(), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
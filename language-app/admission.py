@@ -0,0 +1,395 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Client-side admission control for outbound RPCs.
+
+When a backend is overloaded (``RESOURCE_EXHAUSTED`` or deadline
+errors), sending it more requests only makes things worse. Each RPC
+method gets a :class:`MethodController` which:
+
+* Rate limits calls with a token bucket.
+* Limits concurrent calls with an AIMD limit: the limit grows by about
+  one per limit's worth of successful calls and is cut (at most once per
+  ``decrease_interval``) when the backend reports overload.
+* Queues calls over the limit, but fails fast (with :exc:`Rejected`)
+  once the queue is full or a call has waited too long.
+* Retries overload errors, after a (fully) jittered exponential backoff.
+
+The state of every controller is available via :meth:`Admission.state`.
+"""
+
+import logging
+import random
+import threading
+import time
+
+
+DEFAULT_RATE = 50.0
+DEFAULT_BURST = 100
+DEFAULT_INITIAL_LIMIT = 8
+DEFAULT_MIN_LIMIT = 1
+DEFAULT_MAX_LIMIT = 64
+DEFAULT_MAX_QUEUE = 32
+DEFAULT_QUEUE_TIMEOUT = 5.0
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_BACKOFF_BASE = 0.1
+DEFAULT_BACKOFF_CAP = 2.0
+DECREASE_FACTOR = 0.5
+DECREASE_INTERVAL = 1.0
+# NOTE: These are the names of ``grpc.StatusCode`` members.
+OVERLOAD_CODES = frozenset(['RESOURCE_EXHAUSTED', 'DEADLINE_EXCEEDED'])
+# NOTE: These are the names of errors raised by App Engine APIs (e.g.
+#       ``app_identity``) and the ``apiproxy`` layer under them.
+OVERLOAD_ERRORS = frozenset([
+    'BackendDeadlineExceeded',
+    'DeadlineExceededError',
+    'OverQuotaError',
+])
+
+
+class Rejected(Exception):
+    """A call was not admitted (so that the backend can recover)."""
+
+
+def status_code_name(exc):
+    """Get the gRPC status code name for an error (if it has one).
+
+    ``google-gax`` wraps the ``grpc.RpcError`` as the ``cause`` of a
+    ``GaxError``.
+    """
+    cause = getattr(exc, 'cause', exc)
+    code = getattr(cause, 'code', None)
+    if not callable(code):
+        return None
+    try:
+        return getattr(code(), 'name', None)
+    except Exception:
+        return None
+
+
+def is_overload(exc):
+    """Check if an error means the backend is overloaded.
+
+    Args:
+        exc (Exception): The error raised by a call.
+
+    Returns:
+        bool: Indicating if the call should be retried (after a backoff)
+        and the concurrency limit decreased.
+    """
+    if status_code_name(exc) in OVERLOAD_CODES:
+        return True
+    return exc.__class__.__name__ in OVERLOAD_ERRORS
+
+
+def backoff(attempt, base=DEFAULT_BACKOFF_BASE, cap=DEFAULT_BACKOFF_CAP,
+            random_func=random.random):
+    """Get the delay before a retry ("full jitter" exponential backoff).
+
+    Args:
+        attempt (int): The number of attempts made so far (at least 1).
+        base (float): The (maximum) delay after the first attempt.
+        cap (float): The maximum delay.
+        random_func (Callable[[], float]): Returns a value in ``[0, 1)``.
+
+    Returns:
+        float: The number of seconds to wait.
+    """
+    return random_func() * min(cap, base * 2 ** (attempt - 1))
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket.
+
+    Args:
+        rate (float): Tokens added per second.
+        burst (int): The capacity of the bucket.
+        clock (Callable[[], float]): The current time.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST,
+                 clock=time.time):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        elapsed = max(0.0, now - self._updated)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        """Take a token, if there is one.
+
+        Returns:
+            bool: Indicating if a token was taken.
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens < 1.0:
+                return False
+            self.tokens -= 1.0
+            return True
+
+    def available(self):
+        with self._lock:
+            self._refill()
+            return self.tokens
+
+
+class AIMDLimiter(object):
+    """Thread-safe concurrency limit with additive increase and
+    multiplicative decrease.
+
+    Args:
+        initial (int): The starting limit.
+        minimum (int): The lowest the limit is cut to.
+        maximum (int): The highest the limit grows to.
+        max_queue (int): The number of calls that may wait for a slot.
+        clock (Callable[[], float]): The current time.
+    """
+
+    def __init__(self, initial=DEFAULT_INITIAL_LIMIT,
+                 minimum=DEFAULT_MIN_LIMIT, maximum=DEFAULT_MAX_LIMIT,
+                 max_queue=DEFAULT_MAX_QUEUE, clock=time.time):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_queue = max_queue
+        self.clock = clock
+        self.in_flight = 0
+        self.queued = 0
+        self.decreases = 0
+        self._last_decrease = None
+        self._cond = threading.Condition(threading.Lock())
+
+    def _has_slot(self):
+        return self.in_flight < int(self.limit)
+
+    def acquire(self, timeout=DEFAULT_QUEUE_TIMEOUT):
+        """Wait for a slot.
+
+        Args:
+            timeout (float): The number of seconds to wait in the queue.
+
+        Raises:
+            Rejected: If the queue is full or no slot frees up in time.
+        """
+        with self._cond:
+            if self._has_slot():
+                self.in_flight += 1
+                return
+            if self.queued >= self.max_queue:
+                raise Rejected('Queue full ({} waiting).'.format(self.queued))
+
+            self.queued += 1
+            try:
+                deadline = self.clock() + timeout
+                while not self._has_slot():
+                    remaining = deadline - self.clock()
+                    if remaining <= 0:
+                        raise Rejected(
+                            'Timed out in queue after {}s.'.format(timeout))
+                    self._cond.wait(remaining)
+            finally:
+                self.queued -= 1
+            self.in_flight += 1
+
+    def release(self, overloaded=False):
+        """Free a slot and adjust the limit.
+
+        Args:
+            overloaded (bool): Indicating if the call failed because the
+                backend is overloaded.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if overloaded:
+                # NOTE: A burst of concurrent failures is a single signal,
+                #       so the limit is cut at most once per interval.
+                now = self.clock()
+                if (self._last_decrease is None or
+                        now - self._last_decrease >= DECREASE_INTERVAL):
+                    self.limit = max(
+                        self.minimum, self.limit * DECREASE_FACTOR)
+                    self._last_decrease = now
+                    self.decreases += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._cond.notify_all()
+
+
+class MethodController(object):
+    """Admission control (and retries) for a single RPC method.
+
+    Args:
+        name (str): The name of the method (for logging).
+        bucket (TokenBucket): Rate limits calls (and retries).
+        limiter (AIMDLimiter): Limits concurrent calls.
+        max_attempts (int): The maximum attempts per call (including
+            retries of overload errors).
+        queue_timeout (float): The number of seconds a call may wait for
+            a concurrency slot.
+        sleep (Callable[[float], None]): Waits before a retry.
+        random_func (Callable[[], float]): Jitters the backoff.
+    """
+
+    def __init__(self, name, bucket, limiter,
+                 max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT, sleep=time.sleep,
+                 random_func=random.random):
+        self.name = name
+        self.bucket = bucket
+        self.limiter = limiter
+        self.max_attempts = max_attempts
+        self.queue_timeout = queue_timeout
+        self.sleep = sleep
+        self.random_func = random_func
+        self.calls = 0
+        self.rejected = 0
+        self.retries = 0
+        self.overloads = 0
+        self._lock = threading.Lock()
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _admit(self):
+        if not self.bucket.try_acquire():
+            self._count('rejected')
+            raise Rejected('Rate limited: {}.'.format(self.name))
+        try:
+            self.limiter.acquire(self.queue_timeout)
+        except Rejected:
+            self._count('rejected')
+            raise
+
+    def call(self, func):
+        """Make a call, if it is admitted.
+
+        Args:
+            func (Callable[[], object]): Makes the call.
+
+        Returns:
+            object: The result of the call.
+
+        Raises:
+            Rejected: If the call (or a retry) is not admitted.
+            Exception: Whatever the last attempt raised.
+        """
+        self._count('calls')
+        attempt = 0
+        while True:
+            self._admit()
+            attempt += 1
+            overloaded = False
+            try:
+                return func()
+            except Exception as exc:
+                overloaded = is_overload(exc)
+                if not overloaded:
+                    raise
+                self._count('overloads')
+                if attempt >= self.max_attempts:
+                    raise
+            finally:
+                self.limiter.release(overloaded=overloaded)
+
+            delay = backoff(attempt, random_func=self.random_func)
+            logging.warning(
+                '%s overloaded (attempt %d), retrying in %.3fs',
+                self.name, attempt, delay)
+            self._count('retries')
+            self.sleep(delay)
+
+    def state(self):
+        with self._lock:
+            info = {
+                'calls': self.calls,
+                'rejected': self.rejected,
+                'retries': self.retries,
+                'overloads': self.overloads,
+            }
+        info.update({
+            'limit': self.limiter.limit,
+            'in_flight': self.limiter.in_flight,
+            'queued': self.limiter.queued,
+            'decreases': self.limiter.decreases,
+            'tokens': self.bucket.available(),
+        })
+        return info
+
+
+class Admission(object):
+    """Per-method controllers, created on first use.
+
+    Args:
+        controller_factory (Optional[Callable[[str], MethodController]]):
+            Builds the controller for a method. Defaults to one with the
+            default settings.
+    """
+
+    def __init__(self, controller_factory=None):
+        if controller_factory is None:
+            controller_factory = _default_controller
+        self.controller_factory = controller_factory
+        self._controllers = {}
+        self._lock = threading.Lock()
+
+    def controller(self, service, method):
+        name = '{}.{}'.format(service, method)
+        with self._lock:
+            controller = self._controllers.get(name)
+            if controller is None:
+                controller = self.controller_factory(name)
+                self._controllers[name] = controller
+            return controller
+
+    def call(self, service, method, func):
+        """Make a call through the controller for a method.
+
+        Args:
+            service (str): The service called, e.g. ``'language'``.
+            method (str): The method called, e.g. ``'analyze_sentiment'``.
+            func (Callable[[], object]): Makes the call.
+
+        Returns:
+            object: The result of the call.
+        """
+        return self.controller(service, method).call(func)
+
+    def state(self):
+        """Get the state of every controller.
+
+        Returns:
+            Dict[str, dict]: The counters, limit, queue and bucket level
+            of each method (keyed by ``service.method``).
+        """
+        with self._lock:
+            controllers = list(self._controllers.values())
+        return dict(
+            (controller.name, controller.state())
+            for controller in controllers)
+
+
+def _default_controller(name):
+    return MethodController(name, TokenBucket(), AIMDLimiter())
+
+
+ADMISSION = Admission()
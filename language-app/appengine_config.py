@@ -12,12 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# NOTE: ``startup`` is imported first so that every import after it
+#       is recorded in the startup profile.
+import startup
+
 import __builtin__
 import _pyio
 import errno
-import imp
+import json
 import os
 import sys
+import types
 
 from google.appengine.ext import vendor
 try:
@@ -27,30 +32,53 @@ except ImportError:
     devappserver2 = None
     stubs = None
 
+import importers
+
 
 BUILTIN_OPEN = __builtin__.open
 PYIO_OPEN = _pyio.open
+VENDOR_DIR = 'lib'
+BUNDLE_DIR = 'lib-bundle'
+BUNDLE_INFO = 'bundle.json'
+# NOTE: Set to ``'0'`` (e.g. in ``app.yaml``) to use the plain ``lib/``
+#       directory even if a bundle has been built.
+BUNDLE_ENV = 'VENDOR_BUNDLE'
+VENDOR_PATHS = []
+
 
+def _args_from_interpreter_flags(*args, **kwargs):
+    """Stub for ``subprocess._args_from_interpreter_flags``."""
+    print(
+        '_args_from_interpreter_flags stub called with {!r} {!r}'.format(
+            args, kwargs))
+    return None
 
-def stub_replace(mod_name):
-    """Replace a module from the SDK/Rutime.
 
-    Replaces it with a stub provided in ``stubs/``.
+def register_stubs():
+    """Replace modules from the SDK/Rutime with in-memory stubs.
+
+    The stubs are held in :data:`importers.STUBS` and are only built the
+    first time they are imported.
 
     Used for
 
     * ``subprocess``: Needed by concurrency primitives. We don't actually
        use these primitives in most of our libraries, but we do use the
-       interface.
+       interface. For some reason, when ``multiprocessing.util`` calls
+       ``from subprocess import _args_from_interpreter_flags`` there is an
+       import failure, so we entirely skip the standard library version.
     * ``_multiprocessing``: Imported un-protected in ``__init__.py`` for
       ``multiprocessing`` but not provided in GAE SDK.
     * ``ctypes``: Imported by ``setuptools.windows_support`` (gets imported
       when ``setuptools`` does).
     """
-    sys.modules.pop(mod_name, None)
-    file_obj, filename, details = imp.find_module(mod_name, ['stubs'])
-    sys.modules[mod_name] = imp.load_module(
-        mod_name, file_obj, filename, details)
+    importers.STUBS.register(
+        'subprocess', 'Stub ``subprocess`` module.',
+        _args_from_interpreter_flags=_args_from_interpreter_flags)
+    importers.STUBS.register(
+        '_multiprocessing', 'Stub ``_multiprocessing`` module.')
+    importers.STUBS.register('ctypes', 'Stub ``ctypes`` module.')
+    importers.STUBS.install()
 
 
 def _open_avoid_devnull(filename, mode='r', **kwargs):
@@ -146,29 +174,97 @@ def patch_dev_fake_file():
 
 
 
-def clear_imports(mod_name):
-    """Remove cached imports for a module.
+def _extend_namespace(name, path):
+    """Add ``path`` to the ``__path__`` of a namespace package.
+
+    Helper for :func:`add_bundle`. Does the same thing as the
+    ``*-nspkg.pth`` files that ``pip`` writes (and that ``vendor.add``
+    processes), creating the package if it has not been imported. This
+    matters for ``google``, which the SDK has already imported.
+    """
+    module = sys.modules.get(name)
+    if module is None:
+        module = types.ModuleType(name)
+        module.__path__ = []
+        sys.modules[name] = module
+        parent_name, _, child_name = name.rpartition('.')
+        if parent_name:
+            setattr(sys.modules[parent_name], child_name, module)
+
+    if path not in module.__path__:
+        module.__path__.append(path)
+
+
+def add_bundle(bundle_dir=BUNDLE_DIR):
+    """Add a precompiled vendored bundle to the path.
+
+    The bundle is built from ``lib/`` by ``bundle_lib.py``. Its archive
+    is imported from via ``zipimport``, with plain copies of the
+    packages that are not zip-safe (and distribution metadata) in
+    ``bundle_dir`` itself.
+
+    Returns:
+        List[str]: The vendored paths, in search order.
+    """
+    with open(os.path.join(bundle_dir, BUNDLE_INFO), 'r') as file_obj:
+        info = json.load(file_obj)
+
+    vendor.add(bundle_dir)
+    archive = os.path.abspath(os.path.join(bundle_dir, info['archive']))
+    sys.path.insert(0, archive)
+    for name in info['namespaces']:
+        # NOTE: ``json`` gives ``unicode``, but module names must be ``str``.
+        name = str(name)
+        path = os.path.join(archive, *name.split('.'))
+        _extend_namespace(name, path)
+
+    return [archive, os.path.abspath(bundle_dir)]
+
+
+def add_vendored():
+    """Add the vendored packages to the path.
+
+    Uses the bundle from :func:`add_bundle` if one has been built,
+    unless the ``VENDOR_BUNDLE`` environment variable is ``'0'``, in
+    which case (or if there is no bundle) ``lib/`` is used directly.
 
-    We may want to do this if we provide an over-ride in ``lib/`` for an
+    Sets the paths used in :data:`VENDOR_PATHS`.
+    """
+    use_bundle = (
+        os.environ.get(BUNDLE_ENV, '1') != '0' and
+        os.path.isfile(os.path.join(BUNDLE_DIR, BUNDLE_INFO)))
+    if use_bundle:
+        VENDOR_PATHS[:] = add_bundle(BUNDLE_DIR)
+    else:
+        vendor.add(VENDOR_DIR)
+        VENDOR_PATHS[:] = [os.path.abspath(VENDOR_DIR)]
+
+
+def redirect_vendored(*mod_names):
+    """Make sure some modules are only ever imported from ``lib/``.
+
+    We want this if we provide an over-ride in ``lib/`` for an
     out-of-date package that comes with the SDK (or accidentally comes
     in the environment running the ``dev_appserver``).
+
+    Installs a :class:`~importers.VendorRedirector` at the front of
+    ``sys.meta_path`` so future imports come straight from ``lib/``
+    and evicts any non-vendored copies that were already imported
+    (vendored modules already in ``sys.modules`` are kept).
     """
-    for key in sys.modules.keys():
-        if key.startswith(mod_name):
-            del sys.modules[key]
+    redirector = importers.VendorRedirector(VENDOR_PATHS, mod_names)
+    return redirector.install()
 
 
 def all_updates():
-    vendor.add('lib')
-    stub_replace('subprocess')
-    stub_replace('_multiprocessing')
-    stub_replace('ctypes')
-    patch_open_for_devnull()
-    patch_dev_fake_file()
-    clear_imports('google.protobuf')
-    clear_imports('pkg_resources')
-    clear_imports('setuptools')
-    clear_imports('six')
+    with startup.timed('appengine_config.all_updates()'):
+        startup.step(add_vendored)
+        startup.step(register_stubs)
+        startup.step(patch_open_for_devnull)
+        startup.step(patch_dev_fake_file)
+        startup.step(
+            redirect_vendored,
+            'google.protobuf', 'pkg_resources', 'setuptools', 'six')
 
 
 all_updates()
@@ -0,0 +1,240 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Analyze the sentiment of large documents as concurrent chunks.
+
+A large document is split (at paragraph or sentence boundaries) into
+chunks of at most ``max_bytes`` (UTF-8) each. The chunks are analyzed
+concurrently and the results merged into a single response:
+
+* The document score is the mean of the chunk scores, weighted by
+  magnitude (so a long neutral stretch does not drown out a strongly
+  worded one) and the document magnitude is the sum of the chunk
+  magnitudes.
+* Sentence offsets are rebased onto the original document.
+
+So a long document takes about as long as its slowest chunk rather than
+the sum of them, and never exceeds the API size limit.
+"""
+
+import re
+
+import six
+
+import fanout
+import language_api
+
+
+DEFAULT_MAX_BYTES = 16 * 1024
+# NOTE: A code point is at most 4 bytes in UTF-8.
+MIN_MAX_BYTES = 4
+# NOTE: A blank line (a paragraph break) or whitespace after the end of a
+#       sentence.
+_BOUNDARY = re.compile(r'\n\s*\n|(?<=[.!?])\s+', re.UNICODE)
+_WHITESPACE = re.compile(r'\s+', re.UNICODE)
+
+
+class Chunk(object):
+    """A piece of a document.
+
+    Args:
+        text (unicode): The content of the chunk.
+        offset (int): The offset (in code points) of the chunk in the
+            original content.
+    """
+
+    def __init__(self, text, offset):
+        self.text = text
+        self.offset = offset
+
+    def __repr__(self):
+        return 'Chunk(offset={}, length={})'.format(
+            self.offset, len(self.text))
+
+
+def _size(text):
+    return len(text.encode('utf-8'))
+
+
+def _pieces(text, pattern):
+    """Split text after each match of ``pattern`` (keeping everything)."""
+    start = 0
+    for match in pattern.finditer(text):
+        if match.end() > start:
+            yield text[start:match.end()]
+            start = match.end()
+    if start < len(text):
+        yield text[start:]
+
+
+def _hard_split(text, max_bytes):
+    """Split an over-sized piece at whitespace, or else anywhere."""
+    for word in _pieces(text, _WHITESPACE):
+        if _size(word) <= max_bytes:
+            yield word
+            continue
+
+        # NOTE: Walk the word once, cutting before each code point that
+        #       would go over the budget.
+        start = 0
+        size = 0
+        for index, char in enumerate(word):
+            char_size = _size(char)
+            if size + char_size > max_bytes:
+                yield word[start:index]
+                start = index
+                size = 0
+            size += char_size
+        yield word[start:]
+
+
+def split(content, max_bytes=DEFAULT_MAX_BYTES):
+    """Split text into chunks that fit in a byte budget.
+
+    Chunks end at a paragraph or sentence boundary unless a single
+    sentence does not fit (then it is split at whitespace, or as a last
+    resort, anywhere).
+
+    Args:
+        content (Union[str, unicode]): The text to split.
+        max_bytes (int): The maximum size (UTF-8) of a chunk.
+
+    Returns:
+        List[Chunk]: The chunks, in order. Joining their text gives back
+        ``content``.
+
+    Raises:
+        ValueError: If ``max_bytes`` is less than :data:`MIN_MAX_BYTES`.
+    """
+    if max_bytes < MIN_MAX_BYTES:
+        raise ValueError(
+            'The byte budget must be at least {} bytes.'.format(
+                MIN_MAX_BYTES))
+    if isinstance(content, six.binary_type):
+        content = content.decode('utf-8')
+
+    chunks = []
+    current = []
+    current_size = 0
+    offset = 0
+    for sentence in _pieces(content, _BOUNDARY):
+        if _size(sentence) > max_bytes:
+            pieces = _hard_split(sentence, max_bytes)
+        else:
+            pieces = [sentence]
+        for piece in pieces:
+            size = _size(piece)
+            if current and current_size + size > max_bytes:
+                text = u''.join(current)
+                chunks.append(Chunk(text, offset))
+                offset += len(text)
+                current = []
+                current_size = 0
+            current.append(piece)
+            current_size += size
+    if current:
+        chunks.append(Chunk(u''.join(current), offset))
+    return chunks
+
+
+def merge_sentiment(chunks, responses):
+    """Merge the sentiment of each chunk into one response.
+
+    Args:
+        chunks (List[Chunk]): The chunks analyzed.
+        responses (List[object]): The ``AnalyzeSentimentResponse`` for
+            each chunk (analyzed with ``UTF32`` offsets).
+
+    Returns:
+        object: An ``AnalyzeSentimentResponse`` for the whole document.
+    """
+    # NOTE: We intentionally import at run-time.
+    from google.cloud.language_v1 import types
+
+    merged = types.AnalyzeSentimentResponse()
+    weighted = 0.0
+    magnitude = 0.0
+    for chunk, response in zip(chunks, responses):
+        if not merged.language:
+            merged.language = response.language
+        weighted += (
+            response.document_sentiment.score *
+            response.document_sentiment.magnitude)
+        magnitude += response.document_sentiment.magnitude
+        for sentence in response.sentences:
+            merged_sentence = merged.sentences.add()
+            merged_sentence.CopyFrom(sentence)
+            if sentence.text.begin_offset >= 0:
+                merged_sentence.text.begin_offset += chunk.offset
+
+    if magnitude:
+        score = weighted / magnitude
+    elif responses:
+        # NOTE: Every chunk is neutral (and has a score of about zero).
+        score = sum(
+            response.document_sentiment.score
+            for response in responses) / len(responses)
+    else:
+        score = 0.0
+    merged.document_sentiment.score = score
+    merged.document_sentiment.magnitude = magnitude
+    return merged
+
+
+def analyze_sentiment(
+        document, max_bytes=DEFAULT_MAX_BYTES,
+        concurrency=fanout.DEFAULT_CONCURRENCY,
+        timeout=language_api.DEFAULT_TIMEOUT):
+    """Analyze the sentiment of a (possibly large) document in chunks.
+
+    Only ``PLAIN_TEXT`` documents are split, since a chunk boundary
+    could fall inside an HTML tag.
+
+    Args:
+        document (dict): The document to analyze (see
+            :func:`language_api.make_document`).
+        max_bytes (int): The maximum size (UTF-8) of a chunk.
+        concurrency (int): The maximum number of concurrent RPCs.
+        timeout (Optional[float]): The timeout (in seconds) for each
+            chunk.
+
+    Returns:
+        Tuple[object, List[Chunk]]: The merged
+        ``AnalyzeSentimentResponse`` and the chunks it was built from.
+
+    Raises:
+        Exception: The error for the first chunk that failed (a partial
+            result would be misleading).
+    """
+    # NOTE: We intentionally import at run-time.
+    from google.cloud.language_v1 import enums
+
+    if document['type'] == enums.Document.Type.PLAIN_TEXT:
+        chunks = split(document['content'], max_bytes=max_bytes)
+    else:
+        chunks = [Chunk(document['content'], 0)]
+
+    def analyze(chunk):
+        chunk_document = dict(document, content=chunk.text)
+        return language_api.analyze_sentiment(
+            chunk_document, timeout=timeout,
+            encoding_type=enums.EncodingType.UTF32)
+
+    outcomes = fanout.bounded_map(
+        analyze, chunks, concurrency=concurrency, timeout=timeout)
+    for outcome in outcomes:
+        if not outcome.ok:
+            raise outcome.error
+    responses = [outcome.value for outcome in outcomes]
+    return merge_sentiment(chunks, responses), chunks
@@ -0,0 +1,214 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Manifest of the vendored distributions (in the deployed ``lib-bundle/``).
+
+Importing ``pkg_resources`` scans every entry on ``sys.path`` (and
+every ``*.dist-info`` / ``*.egg-info`` in them), which is one of the
+slowest parts of a cold start. Instead, the manifest is generated once,
+from the vendor directory that is deployed, when it is built::
+
+    $ python2.7 dist_manifest.py lib-bundle dist-manifest.json
+
+and loaded (a single small JSON file) at run-time. If the manifest is
+missing or stale (including when its vendor directory is not on
+``sys.path``, e.g. with ``VENDOR_BUNDLE=0``), or does not know a
+distribution, lookups fall back to ``pkg_resources``.
+"""
+
+from __future__ import print_function
+
+import collections
+import json
+import os
+import re
+import sys
+import threading
+
+
+VENDOR_DIR = 'lib'
+MANIFEST_FILENAME = 'dist-manifest.json'
+METADATA_FILES = ('METADATA', 'PKG-INFO')
+INFO_SUFFIXES = ('.dist-info', '.egg-info')
+
+Distribution = collections.namedtuple(
+    'Distribution', ['project_name', 'version', 'location'])
+
+_LOCK = threading.Lock()
+_LOADED = {}
+
+
+class DistributionNotFound(Exception):
+    """A distribution is in neither the manifest nor ``sys.path``."""
+
+
+def _normalize(name):
+    """Normalize a distribution name (as ``pip`` does) for lookups."""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
+def _info_dirs(vendor_dir):
+    return sorted(
+        name for name in os.listdir(vendor_dir)
+        if name.endswith(INFO_SUFFIXES))
+
+
+def _read_metadata(info_path):
+    """Read the name and version from a ``*-info`` directory.
+
+    Returns:
+        Tuple[Optional[str], Optional[str]]: The name and version.
+    """
+    for filename in METADATA_FILES:
+        path = os.path.join(info_path, filename)
+        if not os.path.isfile(path):
+            continue
+
+        name = version = None
+        with open(path, 'r') as file_obj:
+            for line in file_obj:
+                if not line.strip():
+                    # NOTE: The headers end at the first blank line.
+                    break
+                if line.startswith('Name:'):
+                    name = line.split(':', 1)[1].strip()
+                elif line.startswith('Version:'):
+                    version = line.split(':', 1)[1].strip()
+        return name, version
+
+    return None, None
+
+
+def build(vendor_dir=VENDOR_DIR):
+    """Build a manifest for the distributions in a directory.
+
+    Args:
+        vendor_dir (str): The directory that packages were installed to.
+
+    Returns:
+        dict: The manifest, with the ``*-info`` directory names (used to
+        check staleness) and the name / version of each distribution.
+    """
+    info_dirs = _info_dirs(vendor_dir)
+    distributions = {}
+    for info_dir in info_dirs:
+        name, version = _read_metadata(os.path.join(vendor_dir, info_dir))
+        if name is None or version is None:
+            # NOTE: Fall back to ``{name}-{version}.dist-info``.
+            stem, _ = os.path.splitext(info_dir)
+            name, _, version = stem.partition('-')
+            version = version.split('-py', 1)[0]
+        distributions[_normalize(name)] = {
+            'project_name': name,
+            'version': version,
+        }
+
+    return {
+        'vendor_dir': vendor_dir,
+        'info_dirs': info_dirs,
+        'distributions': distributions,
+    }
+
+
+def load(manifest_filename=MANIFEST_FILENAME, check_stale=True):
+    """Load a manifest (once per instance).
+
+    Args:
+        manifest_filename (str): The path to the manifest.
+        check_stale (bool): Whether to check that the vendor directory
+            is in use (on ``sys.path``) and compare the manifest against
+            the ``*-info`` directories actually in it.
+
+    Returns:
+        Optional[dict]: The manifest, or :data:`None` if it is missing,
+        unreadable or stale.
+    """
+    with _LOCK:
+        if manifest_filename in _LOADED:
+            return _LOADED[manifest_filename]
+
+        manifest = None
+        try:
+            with open(manifest_filename, 'r') as file_obj:
+                manifest = json.load(file_obj)
+        except (IOError, OSError, ValueError):
+            pass
+
+        if manifest is not None and check_stale:
+            vendor_dir = os.path.abspath(manifest['vendor_dir'])
+            sys_path = [os.path.abspath(path) for path in sys.path]
+            if vendor_dir not in sys_path:
+                manifest = None
+
+        if manifest is not None and check_stale:
+            try:
+                info_dirs = _info_dirs(manifest['vendor_dir'])
+            except OSError:
+                info_dirs = None
+            if info_dirs != manifest['info_dirs']:
+                manifest = None
+
+        _LOADED[manifest_filename] = manifest
+        return manifest
+
+
+def get_distribution(name, manifest_filename=MANIFEST_FILENAME):
+    """Look up a distribution, falling back to ``pkg_resources``.
+
+    Args:
+        name (str): The name of the distribution, e.g. ``'grpcio'``.
+        manifest_filename (str): The path to the manifest.
+
+    Returns:
+        Union[Distribution, pkg_resources.Distribution]: The name,
+        version and location of the distribution.
+
+    Raises:
+        DistributionNotFound: If the manifest can't be used and
+            ``pkg_resources`` can't find the distribution.
+    """
+    manifest = load(manifest_filename)
+    if manifest is not None:
+        info = manifest['distributions'].get(_normalize(name))
+        if info is not None:
+            location = os.path.abspath(manifest['vendor_dir'])
+            return Distribution(
+                info['project_name'], info['version'], location)
+
+    # NOTE: We intentionally import at run-time (this is slow).
+    import pkg_resources
+
+    try:
+        return pkg_resources.get_distribution(name)
+    except pkg_resources.DistributionNotFound as exc:
+        raise DistributionNotFound(name, str(exc))
+
+
+def main():
+    if len(sys.argv) != 3:
+        msg = 'Usage: {} VENDOR_DIR MANIFEST_FILENAME'.format(sys.argv[0])
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    vendor_dir, manifest_filename = sys.argv[1:]
+    manifest = build(vendor_dir)
+    with open(manifest_filename, 'w') as file_obj:
+        json.dump(manifest, file_obj, indent=2, sort_keys=True)
+    msg = 'Wrote {} distributions to {}'.format(
+        len(manifest['distributions']), manifest_filename)
+    print(msg)
+
+
+if __name__ == '__main__':
+    main()
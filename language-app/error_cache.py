@@ -0,0 +1,174 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Render each distinct error once, and count how often it happens.
+
+An error is fingerprinted by its exception type and the location (file,
+line and function) of each frame in its traceback, which is cheap to
+compute from the raw traceback. The formatted traceback frames are
+cached per fingerprint, so when the same failure repeats (e.g. a broken
+dependency failing every request) it costs a dictionary lookup rather
+than a full traceback format.
+
+The message is not part of the fingerprint (it often contains request
+specific values), so it is never cached with the frames: the exception
+line is formatted for each occurrence (see :func:`format_exception_only`)
+so one request's data is never shown to another (nor kept for the
+error summary).
+"""
+
+import collections
+import hashlib
+import threading
+import time
+
+
+DEFAULT_MAXSIZE = 256
+
+
+def fingerprint(exc_type, traceback):
+    """Fingerprint an error by its type and traceback frame locations.
+
+    Args:
+        exc_type (type): The exception class.
+        traceback (types.TracebackType): The traceback.
+
+    Returns:
+        str: A short hex digest, the same for repeats of an error.
+    """
+    parts = ['{}.{}'.format(exc_type.__module__, exc_type.__name__)]
+    while traceback is not None:
+        code = traceback.tb_frame.f_code
+        parts.append('{}:{}:{}'.format(
+            code.co_filename, traceback.tb_lineno, code.co_name))
+        traceback = traceback.tb_next
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def _message(exc_value):
+    try:
+        return str(exc_value)
+    except UnicodeError:
+        return repr(exc_value)
+
+
+def format_exception_only(exc_type, exc_value):
+    """Format the last line of a traceback, e.g. ``ValueError: bad``.
+
+    Args:
+        exc_type (type): The exception class.
+        exc_value (Exception): The exception.
+
+    Returns:
+        str: The exception type and message.
+    """
+    return '{}: {}'.format(exc_type.__name__, _message(exc_value))
+
+
+class ErrorRecord(object):
+    """A distinct error, its formatted frames and its occurrences.
+
+    Args:
+        fingerprint (str): The fingerprint of the error.
+        exc_type_name (str): The name of the exception class.
+        frames (str): The formatted traceback frames (without the
+            exception line).
+        now (float): When the error first occurred.
+    """
+
+    def __init__(self, fingerprint, exc_type_name, frames, now):
+        self.fingerprint = fingerprint
+        self.exc_type_name = exc_type_name
+        self.frames = frames
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+
+    def to_dict(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'type': self.exc_type_name,
+            'count': self.count,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen,
+        }
+
+
+class ErrorCache(object):
+    """Thread-safe cache of formatted tracebacks, keyed by fingerprint.
+
+    Once ``maxsize`` distinct errors are cached, the least recently seen
+    is dropped (and counted in ``evictions``).
+
+    Args:
+        render (Callable[[types.TracebackType], str]): Formats the
+            frames of a traceback (only called for a new fingerprint).
+        maxsize (int): The maximum number of distinct errors kept.
+        clock (Callable[[], float]): The current time.
+    """
+
+    def __init__(self, render, maxsize=DEFAULT_MAXSIZE, clock=time.time):
+        self.render = render
+        self.maxsize = maxsize
+        self.clock = clock
+        self.evictions = 0
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, exc_type, exc_value, traceback):
+        """Count an occurrence of an error, formatting it if it is new.
+
+        Args:
+            exc_type (type): The exception class.
+            exc_value (Exception): The exception.
+            traceback (types.TracebackType): The traceback.
+
+        Returns:
+            ErrorRecord: The (updated) record for the error.
+        """
+        key = fingerprint(exc_type, traceback)
+        now = self.clock()
+        with self._lock:
+            record = self._records.pop(key, None)
+            if record is not None:
+                record.count += 1
+                record.last_seen = now
+                self._records[key] = record
+                return record
+
+        # NOTE: Formatting is slow, so it is done without the lock. If
+        #       two threads race on a new error, one format is wasted.
+        frames = self.render(traceback)
+        new_record = ErrorRecord(key, exc_type.__name__, frames, now)
+        with self._lock:
+            record = self._records.pop(key, new_record)
+            record.count += 1
+            record.last_seen = now
+            self._records[key] = record
+            while len(self._records) > self.maxsize:
+                self._records.popitem(last=False)
+                self.evictions += 1
+            return record
+
+    def summary(self):
+        """Get every cached error, most frequent first.
+
+        Returns:
+            List[dict]: The fingerprint, type, count and first / last
+            seen time of each error.
+        """
+        with self._lock:
+            records = [record.to_dict() for record in self._records.values()]
+        records.sort(key=lambda info: (-info['count'], info['fingerprint']))
+        return records
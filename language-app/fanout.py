@@ -0,0 +1,171 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded concurrent fan-out with per-item timeouts."""
+
+import threading
+import time
+
+from concurrent import futures
+
+
+DEFAULT_CONCURRENCY = 8
+MAX_CONCURRENCY = 32
+
+
+class ItemTimeout(Exception):
+    """An item did not finish within its timeout."""
+
+
+class Outcome(object):
+    """The result of calling a function on a single item.
+
+    Exactly one of ``value`` and ``error`` is meaningful.
+
+    Args:
+        value (Optional[object]): The return value (on success).
+        error (Optional[Exception]): The exception raised (on failure).
+        duration (Optional[float]): The time (in seconds) spent on the
+            item once it started running.
+    """
+
+    def __init__(self, value=None, error=None, duration=None):
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class _Task(object):
+    """A single item submitted to the pool.
+
+    Records when it actually starts running, so that queueing behind
+    other items does not count against its timeout.
+    """
+
+    def __init__(self, func, item):
+        self.func = func
+        self.item = item
+        self.future = None
+        self.started = None
+        self.finished = None
+        self._started_event = threading.Event()
+
+    def run(self):
+        self.started = time.time()
+        self._started_event.set()
+        try:
+            return self.func(self.item)
+        finally:
+            self.finished = time.time()
+
+    def wait(self, timeout, deadline=None):
+        """Wait for the item to finish.
+
+        Args:
+            timeout (Optional[float]): The number of seconds the item
+                may run for (once started). :data:`None` means no limit.
+            deadline (Optional[float]): The time (from ``time.time()``)
+                by which the item must have finished. An item that has
+                not started by then is cancelled.
+
+        Returns:
+            Outcome: The result of the item.
+        """
+        if timeout is not None or deadline is not None:
+            # NOTE: A cancelled (never started) task never sets the event.
+            while not self._started_event.is_set():
+                if self.future.done():
+                    break
+                poll = 0.1
+                if deadline is not None:
+                    poll = min(poll, deadline - time.time())
+                    if poll <= 0 and self.future.cancel():
+                        error = ItemTimeout(
+                            'Item did not start before the batch deadline')
+                        return Outcome(error=error)
+                self._started_event.wait(max(poll, 0.001))
+
+        limits = []
+        if timeout is not None and self.started is not None:
+            limits.append((self.started + timeout, 'within {}s'.format(
+                timeout)))
+        if deadline is not None:
+            limits.append((deadline, 'before the batch deadline'))
+        try:
+            if not limits:
+                value = self.future.result()
+            else:
+                end, _ = min(limits)
+                value = self.future.result(
+                    timeout=max(0.0, end - time.time()))
+        except futures.TimeoutError:
+            _, reason = min(limits)
+            error = ItemTimeout('Item did not finish {}'.format(reason))
+            return Outcome(error=error, duration=self._duration())
+        except Exception as exc:
+            return Outcome(error=exc, duration=self._duration())
+
+        return Outcome(value=value, duration=self._duration())
+
+    def _duration(self):
+        if self.started is None:
+            return None
+        return (self.finished or time.time()) - self.started
+
+
+def bounded_map(func, items, concurrency=DEFAULT_CONCURRENCY, timeout=None,
+                batch_timeout=None):
+    """Call ``func`` on each item, with at most ``concurrency`` at once.
+
+    Failures are isolated: an exception (or timeout) for one item is
+    recorded in its :class:`Outcome` and does not affect the others.
+
+    Args:
+        func (Callable[[object], object]): The function to call.
+        items (Iterable[object]): The items to call it on.
+        concurrency (int): The maximum number of concurrent calls
+            (capped at :data:`MAX_CONCURRENCY`).
+        timeout (Optional[float]): The number of seconds each item may
+            run for. Items still running after that are abandoned (their
+            thread is not interrupted).
+        batch_timeout (Optional[float]): The number of seconds all of
+            the items may take. Items that have not started by then are
+            cancelled, and items still running are abandoned. Both
+            count as timed out.
+
+    Returns:
+        List[Outcome]: The outcome for each item, in input order.
+    """
+    deadline = None
+    if batch_timeout is not None:
+        deadline = time.time() + batch_timeout
+    concurrency = max(1, min(concurrency, MAX_CONCURRENCY))
+    executor = futures.ThreadPoolExecutor(max_workers=concurrency)
+    tasks = []
+    try:
+        for item in items:
+            task = _Task(func, item)
+            task.future = executor.submit(task.run)
+            tasks.append(task)
+        return [task.wait(timeout, deadline=deadline) for task in tasks]
+    finally:
+        # NOTE: Items that have not started (e.g. after an error) must
+        #       not keep the pool's threads busy once we return.
+        for task in tasks:
+            task.future.cancel()
+        executor.shutdown(wait=False)
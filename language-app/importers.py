@@ -0,0 +1,295 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Custom ``sys.meta_path`` importers used by ``appengine_config.py``."""
+
+import logging
+import importlib
+import os
+import pkgutil
+import sys
+import threading
+import time
+import types
+
+
+# NOTE: Frames from these modules are skipped when looking for the
+#       module that triggered an import (``startup`` wraps
+#       ``__import__`` while the instance is starting).
+_IMPORT_MACHINERY = frozenset([__name__, 'startup', 'importlib'])
+
+def _importer_name():
+    """Get the name of the module running the current ``import``."""
+    frame = sys._getframe(1)
+    while frame is not None:
+        name = frame.f_globals.get('__name__')
+        if name not in _IMPORT_MACHINERY:
+            return name
+        frame = frame.f_back
+    return None
+
+
+def _is_within(fullname, mod_name):
+    """Check if ``fullname`` is ``mod_name`` or one of its submodules.
+
+    Unlike a bare ``startswith``, this respects the dotted name
+    boundaries, e.g. ``sixer`` is not within ``six``.
+    """
+    return fullname == mod_name or fullname.startswith(mod_name + '.')
+
+
+class VendorRedirector(object):
+    """Meta path finder that loads selected modules from ``lib/``.
+
+    The SDK / runtime (and the environment running ``dev_appserver``)
+    ship out-of-date copies of some packages that may be found before
+    the vendored ones. This finder claims the top-level name of each
+    redirected package and loads it from the vendored directory, so the
+    other copy is never imported. Submodules then resolve via the
+    vendored package's ``__path__``.
+
+    Args:
+        vendor_paths (Iterable[str]): The directories (or ``zipimport``-able
+            archives) containing vendored packages, in search order.
+        mod_names (Iterable[str]): The (possibly dotted) names of the
+            packages to redirect, e.g. ``'google.protobuf'``.
+    """
+
+    def __init__(self, vendor_paths, mod_names):
+        self.vendor_paths = tuple(
+            os.path.abspath(vendor_path) for vendor_path in vendor_paths)
+        self.mod_names = tuple(mod_names)
+
+    def owns(self, fullname):
+        """Check if a module is (or is inside) a redirected package.
+
+        Args:
+            fullname (str): The full dotted name of a module.
+
+        Returns:
+            bool: Indicating if the module is owned by this redirector.
+        """
+        return any(
+            _is_within(fullname, mod_name) for mod_name in self.mod_names)
+
+    def is_vendored(self, module):
+        """Check if an imported module was loaded from ``vendor_paths``.
+
+        Args:
+            module (Optional[module]): A value from ``sys.modules``.
+
+        Returns:
+            bool: Indicating if the module came from ``vendor_paths``.
+        """
+        filename = getattr(module, '__file__', None)
+        if filename is None:
+            return False
+        filename = os.path.abspath(filename)
+        return any(
+            filename.startswith(vendor_path + os.sep)
+            for vendor_path in self.vendor_paths)
+
+    def evict_foreign(self):
+        """Remove non-vendored copies of redirected modules.
+
+        Makes a single pass over ``sys.modules`` and only removes
+        modules that were **not** loaded from ``vendor_paths``, so
+        vendored modules that were already imported are kept rather
+        than imported a second time.
+
+        Returns:
+            List[str]: The names of the removed modules.
+        """
+        evicted = []
+        for fullname, module in list(sys.modules.items()):
+            if not self.owns(fullname):
+                continue
+            if self.is_vendored(module):
+                continue
+            del sys.modules[fullname]
+            evicted.append(fullname)
+        return evicted
+
+    def find_module(self, fullname, path=None):
+        if fullname in self.mod_names:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+
+        parent_parts = fullname.split('.')[:-1]
+        for vendor_path in self.vendor_paths:
+            search_path = os.path.join(vendor_path, *parent_parts)
+            importer = pkgutil.get_importer(search_path)
+            if importer is None:
+                continue
+            loader = importer.find_module(fullname)
+            if loader is not None:
+                return loader.load_module(fullname)
+
+        raise ImportError('No vendored module named {}'.format(fullname))
+
+    def install(self):
+        """Evict non-vendored copies and add this to ``sys.meta_path``.
+
+        Returns:
+            List[str]: The names of the evicted modules.
+        """
+        evicted = self.evict_foreign()
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+        return evicted
+
+
+class StubRegistry(object):
+    """Meta path finder that serves stub modules built in memory.
+
+    Stub modules are only created the first time they are imported (no
+    file is read, no filesystem probe is made) and every such import is
+    logged and counted in :attr:`hits`, along with the name of the
+    module that imported it, so we can tell which stubs are needed.
+    """
+
+    def __init__(self):
+        self._stubs = {}
+        self._lock = threading.Lock()
+        self.hits = {}
+
+    def register(self, mod_name, doc=None, **attrs):
+        """Register (or replace) a stub module.
+
+        Drops any existing import of ``mod_name`` so that the next
+        import gets the stub.
+
+        Args:
+            mod_name (str): The name of the module to stub out.
+            doc (Optional[str]): The docstring for the stub module.
+            attrs (Dict[str, object]): Attributes of the stub module.
+        """
+        with self._lock:
+            self._stubs[mod_name] = (doc, attrs)
+        sys.modules.pop(mod_name, None)
+
+    def find_module(self, fullname, path=None):
+        if fullname in self._stubs:
+            return self
+        return None
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+
+        doc, attrs = self._stubs[fullname]
+        module = types.ModuleType(fullname, doc)
+        module.__loader__ = self
+        module.__dict__.update(attrs)
+        sys.modules[fullname] = module
+
+        importer = _importer_name()
+        with self._lock:
+            self.hits.setdefault(fullname, []).append(importer)
+        logging.info('Stub module %r imported by %r', fullname, importer)
+        return module
+
+    def install(self):
+        """Add this registry to the front of ``sys.meta_path``."""
+        if self not in sys.meta_path:
+            sys.meta_path.insert(0, self)
+
+
+STUBS = StubRegistry()
+
+
+class LazyModule(object):
+    """Stand-in for a module that is only imported on first use.
+
+    The first attribute access (or call to :meth:`load`) imports the
+    module. Like a module-level ``try: import``, an ``ImportError`` is
+    only attempted once: it is remembered and re-raised on every use.
+
+    Args:
+        mod_name (str): The (dotted) name of the module.
+        on_import (Optional[Callable[[str, float, bool], None]]): Called
+            with the name, the duration (in seconds) and whether it
+            failed, when this stand-in actually imports the module.
+    """
+
+    def __init__(self, mod_name, on_import=None):
+        self.mod_name = mod_name
+        self.on_import = on_import
+        self.duration = None
+        self._module = None
+        self._exc_info = None
+        self._lock = threading.Lock()
+
+    def _import(self):
+        # NOTE: Another module may have imported it already, in which
+        #       case there is no (deferred) cost to record.
+        loaded = self.mod_name in sys.modules
+        start = time.time()
+        try:
+            self._module = importlib.import_module(self.mod_name)
+        except ImportError:
+            self._exc_info = sys.exc_info()
+        self.duration = time.time() - start
+        if self.on_import is not None and not loaded:
+            self.on_import(
+                self.mod_name, self.duration, self._exc_info is not None)
+
+    def load(self):
+        """Import the module (if it has not been imported yet).
+
+        Returns:
+            module: The imported module.
+
+        Raises:
+            ImportError: If the module could not be imported.
+        """
+        if self._module is not None:
+            return self._module
+
+        with self._lock:
+            if self._module is None and self._exc_info is None:
+                self._import()
+
+        if self._exc_info is not None:
+            # NOTE: We intentionally import at run-time, ``six`` is
+            #       vendored and ``lib/`` is not on ``sys.path`` yet
+            #       when this module is imported.
+            import six
+            six.reraise(*self._exc_info)
+        return self._module
+
+    def import_error(self):
+        """Get the error from importing the module (if any).
+
+        Returns:
+            Optional[tuple]: The ``sys.exc_info()`` of the failed import,
+            or :data:`None` if the module was imported.
+        """
+        try:
+            self.load()
+        except ImportError:
+            return self._exc_info
+        return None
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        if self._module is not None:
+            return repr(self._module)
+        return '<lazy module {!r}>'.format(self.mod_name)
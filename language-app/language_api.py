@@ -0,0 +1,544 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shared access to the Cloud Natural Language API.
+
+Creating a ``LanguageServiceClient`` means credential discovery, a new
+gRPC channel and a TLS handshake. A gRPC channel multiplexes concurrent
+calls, so (since the app is ``threadsafe``) one client is created per
+instance and shared by every request.
+"""
+
+import logging
+import os
+import threading
+import time
+
+import six
+
+import admission
+import fanout
+import metrics
+import result_cache
+import singleflight
+import tokens
+
+
+DEFAULT_TIMEOUT = 10.0
+MAX_CLIENT_AGE = 3600.0
+# NOTE: The maximum number of documents in a batch (see
+#       :func:`batch_max_documents`).
+BATCH_MAX_ENV = 'LANGUAGE_BATCH_MAX_DOCUMENTS'
+DEFAULT_BATCH_MAX = 100
+# NOTE: Leaves headroom under the 60 second App Engine request deadline.
+DEFAULT_BATCH_TIMEOUT = 45.0
+# NOTE: One of ``'memcache'`` (App Engine memcache), ``'fake'`` (an
+#       in-process stand-in) or unset (no shared tier).
+CACHE_SHARED_ENV = 'LANGUAGE_CACHE_SHARED'
+# NOTE: The ``host:port`` of a local stand-in for the API (e.g.
+#       ``fake_language_server.py``), reached over an insecure channel
+#       without credentials. Unset means the real API.
+TARGET_ENV = 'LANGUAGE_API_TARGET'
+# NOTE: These are the names of ``grpc.StatusCode`` members.
+BROKEN_CHANNEL_CODES = frozenset(['UNAVAILABLE'])
+# NOTE: Maps the feature names accepted by :func:`annotate_text` to the
+#       ``Features`` fields they enable.
+FEATURES = {
+    'sentiment': 'extract_document_sentiment',
+    'entities': 'extract_entities',
+    'syntax': 'extract_syntax',
+}
+DEFAULT_FEATURES = ('sentiment', 'entities', 'syntax')
+# NOTE: The ``Document.Type`` names accepted by :func:`make_document`.
+DOCUMENT_TYPES = ('PLAIN_TEXT', 'HTML')
+# NOTE: The API returns ``float`` (32-bit) scores, so more digits than
+#       this are noise.
+COMPACT_DIGITS = 4
+
+
+class ClientHandle(object):
+    """A client along with the channel and credentials it was built with.
+
+    Args:
+        client (object): A ``LanguageServiceClient`` (or a stand-in).
+        channel (Optional[grpc.Channel]): The channel used by ``client``.
+        credentials (Optional[google.auth.credentials.Credentials]): The
+            credentials used by ``channel``.
+    """
+
+    def __init__(self, client, channel=None, credentials=None):
+        self.client = client
+        self.channel = channel
+        self.credentials = credentials
+        self.created = time.time()
+        self.broken = False
+
+    @property
+    def age(self):
+        return time.time() - self.created
+
+
+def default_credentials():
+    """Get the (scoped) credentials used by the shared client.
+
+    These are discovered once per instance (see
+    :func:`tokens.default_credentials`), so ``/_ah/warmup`` can discover
+    them before the client is built.
+
+    Returns:
+        Tuple[google.auth.credentials.Credentials, Optional[str]]: The
+        credentials and project ID.
+    """
+    # NOTE: We intentionally import at run-time.
+    from google.cloud import language_v1
+
+    scopes = language_v1.LanguageServiceClient._ALL_SCOPES
+    return tokens.default_credentials(scopes=scopes)
+
+
+def _default_factory():
+    """Build a ``LanguageServiceClient`` with its own channel.
+
+    If :data:`TARGET_ENV` is set, the channel goes to that (local,
+    insecure) target instead of the API.
+
+    Returns:
+        ClientHandle: The client, channel and credentials.
+    """
+    # NOTE: We intentionally import at run-time.
+    import google.auth.transport.grpc
+    import google.auth.transport.requests
+    from google.cloud import language_v1
+
+    client_class = language_v1.LanguageServiceClient
+    target = os.environ.get(TARGET_ENV)
+    if target:
+        import grpc
+
+        channel = grpc.insecure_channel(target)
+        return ClientHandle(client_class(channel=channel), channel=channel)
+
+    credentials, _ = default_credentials()
+    target = '{}:{}'.format(
+        client_class.SERVICE_ADDRESS, client_class.DEFAULT_SERVICE_PORT)
+    channel = google.auth.transport.grpc.secure_authorized_channel(
+        credentials, google.auth.transport.requests.Request(), target)
+    client = client_class(channel=channel)
+    return ClientHandle(client, channel=channel, credentials=credentials)
+
+
+class ClientPool(object):
+    """Thread-safe, lazily built, process-wide client.
+
+    The client is rebuilt (on the next :meth:`get`) if it has been
+    marked broken via :meth:`invalidate`, if it fails a :meth:`check`
+    or once it is older than ``max_age``.
+
+    Args:
+        factory (Optional[Callable[[], ClientHandle]]): Builds a client.
+            Defaults to a real ``LanguageServiceClient``.
+        max_age (Optional[float]): The maximum age (in seconds) of a
+            client before it is rebuilt. :data:`None` means no limit.
+    """
+
+    def __init__(self, factory=None, max_age=MAX_CLIENT_AGE):
+        if factory is None:
+            factory = _default_factory
+        self.factory = factory
+        self.max_age = max_age
+        self.current = None
+        self.builds = 0
+        self._lock = threading.Lock()
+
+    def _usable(self, handle):
+        if handle is None or handle.broken:
+            return False
+        return self.max_age is None or handle.age < self.max_age
+
+    def get_handle(self):
+        """Get the shared client handle, building it if needed.
+
+        Returns:
+            ClientHandle: The current (healthy) client handle.
+        """
+        handle = self.current
+        if self._usable(handle):
+            return handle
+
+        with self._lock:
+            # NOTE: Another thread may have rebuilt while we waited.
+            handle = self.current
+            if not self._usable(handle):
+                handle = self.factory()
+                self.current = handle
+                self.builds += 1
+                logging.info(
+                    'Built Language client %r (build #%d)',
+                    handle.client, self.builds)
+        return handle
+
+    def get(self):
+        """Get the shared client, building it if needed.
+
+        Returns:
+            object: The current ``LanguageServiceClient``.
+        """
+        return self.get_handle().client
+
+    def invalidate(self, client):
+        """Mark a client as broken so the next :meth:`get` rebuilds it.
+
+        Does nothing if ``client`` has already been replaced, so many
+        requests failing on the same broken channel cause one rebuild.
+
+        Args:
+            client (object): The client that failed.
+        """
+        handle = self.current
+        if handle is not None and handle.client is client:
+            handle.broken = True
+            logging.warning('Language client %r marked broken', client)
+
+    def check(self, timeout=5.0):
+        """Health check: wait for the current channel to be ready.
+
+        Marks the client broken if the channel does not become ready
+        within ``timeout``.
+
+        Args:
+            timeout (float): The number of seconds to wait.
+
+        Returns:
+            bool: Indicating if the channel is ready.
+        """
+        handle = self.get_handle()
+        if handle.channel is None:
+            return True
+
+        import grpc
+
+        try:
+            grpc.channel_ready_future(handle.channel).result(timeout=timeout)
+            return True
+        except grpc.FutureTimeoutError:
+            self.invalidate(handle.client)
+            return False
+
+
+def _shared_cache():
+    """Get the shared (second) result cache tier from the environment."""
+    backend = os.environ.get(CACHE_SHARED_ENV)
+    if backend == 'memcache':
+        from google.appengine.api import memcache
+        return memcache
+    elif backend == 'fake':
+        return result_cache.FakeMemcache()
+    elif backend:
+        raise ValueError('Unknown shared cache', CACHE_SHARED_ENV, backend)
+    return None
+
+
+POOL = ClientPool()
+CACHE = result_cache.ResultCache(shared=_shared_cache())
+FLIGHTS = singleflight.Group()
+
+
+def call(method_name, *args, **kwargs):
+    """Call a method on the shared client.
+
+    The call goes through :data:`admission.ADMISSION` (so it may be
+    rejected, or retried if the API is overloaded) and each attempt is
+    timed via :func:`metrics.timed_call`. If the call fails because the
+    channel is broken, the client is invalidated so that the next call
+    gets a new channel.
+
+    Args:
+        method_name (str): The ``LanguageServiceClient`` method to call.
+        args (tuple): Positional arguments for the method.
+        kwargs (dict): Keyword arguments for the method.
+
+    Returns:
+        object: The response from the API.
+    """
+    client = POOL.get()
+
+    def attempt():
+        with metrics.timed_call('language', method_name):
+            return getattr(client, method_name)(*args, **kwargs)
+
+    try:
+        return admission.ADMISSION.call('language', method_name, attempt)
+    except Exception as exc:
+        if admission.status_code_name(exc) in BROKEN_CHANNEL_CODES:
+            POOL.invalidate(client)
+        raise
+
+
+def _call_options(timeout):
+    if timeout is None:
+        return None
+
+    # NOTE: We intentionally import at run-time.
+    from google.gax import CallOptions
+
+    return CallOptions(timeout=timeout)
+
+
+def make_document(item):
+    """Build a ``Document`` from a string or a (partial) document dict.
+
+    Args:
+        item (Union[str, dict]): Either the text content or a dict with
+            ``content`` and (optionally) ``type``. The type may be the
+            enum value or its name (e.g. ``'HTML'``) and defaults to
+            ``PLAIN_TEXT``.
+
+    Returns:
+        dict: A document that can be passed to the client.
+
+    Raises:
+        ValueError: If ``item`` is not a string or a dict with content,
+            or the type is an unknown name.
+    """
+    # NOTE: We intentionally import at run-time.
+    from google.cloud.language_v1 import enums
+
+    if isinstance(item, six.string_types):
+        item = {'content': item}
+    if not isinstance(item, dict) or 'content' not in item:
+        raise ValueError(
+            'Expected text or a document dict with "content".')
+
+    # NOTE: Keys decoded from JSON are ``unicode``, which (in Python 2)
+    #       protobuf does not accept as field names.
+    document = dict((str(key), value) for key, value in item.items())
+    type_ = document.get('type', enums.Document.Type.PLAIN_TEXT)
+    if isinstance(type_, six.string_types):
+        if type_ not in DOCUMENT_TYPES:
+            raise ValueError(
+                'Unknown document type, expected one of: {}.'.format(
+                    ', '.join(DOCUMENT_TYPES)))
+        type_ = getattr(enums.Document.Type, type_)
+    document['type'] = type_
+    return document
+
+
+def to_dict(response):
+    """Convert an API response (a protobuf message) to a dict."""
+    # NOTE: We intentionally import at run-time.
+    from google.protobuf import json_format
+
+    return json_format.MessageToDict(response)
+
+
+def cached_call(method_name, document, timeout=None, **fields):
+    """Call a single-document method, re-using cached results.
+
+    Identical requests (same method, document and fields) are served
+    from :data:`CACHE`. On a miss, concurrent identical requests share
+    a single RPC (via :data:`FLIGHTS`), though each waits no longer than
+    its own ``timeout``.
+
+    Args:
+        method_name (str): The ``LanguageServiceClient`` method to call.
+        document (dict): The document to analyze.
+        timeout (Optional[float]): The RPC timeout (in seconds), also
+            the longest to wait for an identical RPC already running.
+        fields (dict): Other (JSON serializable) request fields, e.g.
+            ``features``.
+
+    Returns:
+        object: The (possibly cached) response from the API.
+
+    Raises:
+        singleflight.WaitTimeout: If an identical RPC (made for another
+            request) did not finish within ``timeout``.
+    """
+    key = result_cache.make_key(method_name, document, options=fields)
+
+    def load():
+        value = call(
+            method_name, document, options=_call_options(timeout),
+            **fields)
+        # NOTE: Cache before the flight ends, so that a request arriving
+        #       just after it does not miss both and make another RPC.
+        CACHE.set(key, value)
+        return value
+
+    value = CACHE.get(key)
+    if value is None:
+        value = FLIGHTS.do(key, load, timeout=timeout)
+    return value
+
+
+def analyze_sentiment(document, timeout=None, encoding_type=None):
+    fields = {}
+    if encoding_type is not None:
+        fields['encoding_type'] = encoding_type
+    return cached_call(
+        'analyze_sentiment', document, timeout=timeout, **fields)
+
+
+def make_features(names):
+    """Build the ``Features`` for :func:`annotate_text`.
+
+    Args:
+        names (Iterable[str]): Feature names (keys of :data:`FEATURES`).
+
+    Returns:
+        dict: The ``Features`` (as a dict) enabling each feature.
+
+    Raises:
+        ValueError: If there are no names or a name is not known.
+    """
+    names = list(names)
+    unknown = [name for name in names if name not in FEATURES]
+    if unknown or not names:
+        raise ValueError('Expected one or more features from: {}.'.format(
+            ', '.join(sorted(FEATURES))))
+    return dict((FEATURES[name], True) for name in names)
+
+
+def annotate_text(document, features=DEFAULT_FEATURES, timeout=None):
+    """Run several analyses of a document in a single RPC.
+
+    Offsets in the response are in code points (i.e. indices into the
+    document content as a ``unicode`` string).
+
+    Args:
+        document (dict): The document to analyze.
+        features (Iterable[str]): The analyses to run (keys of
+            :data:`FEATURES`).
+        timeout (Optional[float]): The RPC timeout (in seconds).
+
+    Returns:
+        object: The (possibly cached) ``AnnotateTextResponse``.
+
+    Raises:
+        ValueError: If ``features`` is not valid.
+    """
+    # NOTE: We intentionally import at run-time.
+    from google.cloud.language_v1 import enums
+
+    return cached_call(
+        'annotate_text', document, timeout=timeout,
+        features=make_features(features),
+        encoding_type=enums.EncodingType.UTF32)
+
+
+def _round(value):
+    return round(value, COMPACT_DIGITS)
+
+
+def compact_annotation(response, features=DEFAULT_FEATURES):
+    """Convert an ``AnnotateTextResponse`` to a compact dict.
+
+    Only the requested features are included. Enums are converted to
+    their names and each token is a row of ``[text, offset, tag, lemma,
+    head, label]`` (tokens make up most of a response).
+
+    Args:
+        response (object): The response from :func:`annotate_text`.
+        features (Iterable[str]): The features that were requested.
+
+    Returns:
+        dict: The merged result, ready to be serialized.
+    """
+    # NOTE: We intentionally import at run-time.
+    from google.cloud.language_v1 import types
+
+    features = frozenset(features)
+    result = {'language': response.language}
+    if 'sentiment' in features:
+        result['sentiment'] = {
+            'score': _round(response.document_sentiment.score),
+            'magnitude': _round(response.document_sentiment.magnitude),
+        }
+    sentences = []
+    for sentence in response.sentences:
+        info = {
+            'text': sentence.text.content,
+            'offset': sentence.text.begin_offset,
+        }
+        if 'sentiment' in features:
+            info['score'] = _round(sentence.sentiment.score)
+            info['magnitude'] = _round(sentence.sentiment.magnitude)
+        sentences.append(info)
+    result['sentences'] = sentences
+
+    if 'entities' in features:
+        entities = []
+        for entity in response.entities:
+            info = {
+                'name': entity.name,
+                'type': types.Entity.Type.Name(entity.type),
+                'salience': _round(entity.salience),
+                'offsets': [
+                    mention.text.begin_offset for mention in entity.mentions],
+            }
+            if entity.metadata:
+                info['metadata'] = dict(entity.metadata)
+            entities.append(info)
+        result['entities'] = entities
+
+    if 'syntax' in features:
+        result['tokens'] = [
+            [
+                token.text.content,
+                token.text.begin_offset,
+                types.PartOfSpeech.Tag.Name(token.part_of_speech.tag),
+                token.lemma,
+                token.dependency_edge.head_token_index,
+                types.DependencyEdge.Label.Name(token.dependency_edge.label),
+            ]
+            for token in response.tokens
+        ]
+    return result
+
+
+def batch_max_documents():
+    """Get the maximum number of documents in a batch.
+
+    Returns:
+        int: The value of :data:`BATCH_MAX_ENV` (if set) or
+        :data:`DEFAULT_BATCH_MAX`.
+    """
+    return int(os.environ.get(BATCH_MAX_ENV, DEFAULT_BATCH_MAX))
+
+
+def analyze_sentiment_batch(
+        items, concurrency=fanout.DEFAULT_CONCURRENCY,
+        timeout=DEFAULT_TIMEOUT, batch_timeout=DEFAULT_BATCH_TIMEOUT):
+    """Analyze the sentiment of many documents concurrently.
+
+    Args:
+        items (List[Union[str, dict]]): Documents (see
+            :func:`make_document`).
+        concurrency (int): The maximum number of concurrent RPCs.
+        timeout (Optional[float]): The timeout (in seconds) for each
+            document.
+        batch_timeout (Optional[float]): The timeout (in seconds) for
+            the whole batch. Documents not finished by then time out.
+
+    Returns:
+        List[fanout.Outcome]: The outcome for each document, in input
+        order. A successful outcome holds the response as a dict.
+    """
+    def analyze(item):
+        response = analyze_sentiment(make_document(item), timeout=timeout)
+        return to_dict(response)
+
+    return fanout.bounded_map(
+        analyze, items, concurrency=concurrency, timeout=timeout,
+        batch_timeout=batch_timeout)
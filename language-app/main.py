@@ -14,32 +14,50 @@
 
 import _multiprocessing
 import functools
-import imp
 import io
+import json
 import logging
 import os
 import subprocess
 import sys
-import unittest
+import time
 
-import boltons.tbutils
 import flask
-import google.auth
-import google.protobuf
-try:
-    import grpc
-    grpc_info = None
-except ImportError as exc:
-    grpc = None
-    grpc_info = sys.exc_info()
-import pkg_resources
-import setuptools
 import six
 
 from google.appengine.api import app_identity
 
+import admission
+import chunking
+import dist_manifest
+import error_cache
+import fanout
+import importers
+import language_api
+import metrics
+import startup
+import tokens
+import warmup
+
+
+# NOTE: These are only imported the first time a route uses them (the
+#       duration of each first import is added to the startup profile),
+#       so a cold start doesn't pay for modules most requests never use.
+#       ``unit_runner`` is deferred since it imports ``unittest``.
+protobuf = importers.LazyModule(
+    'google.protobuf', on_import=startup.record_deferred)
+grpc = importers.LazyModule('grpc', on_import=startup.record_deferred)
+tbutils = importers.LazyModule(
+    'boltons.tbutils', on_import=startup.record_deferred)
+unittest = importers.LazyModule(
+    'unittest', on_import=startup.record_deferred)
+unit_runner = importers.LazyModule(
+    'unit_runner', on_import=startup.record_deferred)
+
 
 app = flask.Flask(__name__)
+app.wsgi_app = metrics.MetricsMiddleware(
+    app.wsgi_app, route_func=metrics.flask_route_func(app))
 
 MAIN_HTML = """\
 <html>
@@ -48,7 +66,13 @@ MAIN_HTML = """\
     <li><a href="/auth-check">Auth Info</a></li>
     <li><a href="/import">Package Import Check</a></li>
     <li><a href="/unit-tests">Unit Test Output</a></li>
+    <li><a href="/unit-tests?mode=parallel">Unit Test Output (Parallel)</a></li>
     <li><a href="/system-tests">System Test Output</a></li>
+    <li><a href="/startup-profile">Startup Profile</a></li>
+    <li><a href="/metrics">Metrics</a></li>
+    <li><a href="/errors">Error Summary</a></li>
+    <li><a href="/admission">Admission Control State</a></li>
+    <li><a href="/_ah/warmup">Warmup (Per-Step Timing)</a></li>
   </ul>
 </html>
 """
@@ -62,7 +86,21 @@ def code_block(*lines):
     return '\n'.join(html_lines)
 
 
+def format_frames(traceback):
+    return tbutils.TracebackInfo.from_traceback(traceback).get_formatted()
+
+
+# NOTE: The frames of repeats of the same error (by type and traceback
+#       frames) are formatted once and then served from here.
+ERRORS = error_cache.ErrorCache(format_frames)
+
+
 class PrettyErrors(object):
+    """Render errors raised by a route as a traceback page.
+
+    The page is served with a 500 status, so that (like errors that
+    escape a route) it is counted by ``app_request_errors_total``.
+    """
 
     def __init__(self, callable_):
         self.callable_ = callable_
@@ -71,10 +109,19 @@ class PrettyErrors(object):
     def __call__(self, *args, **kwargs):
         try:
             return self.callable_(*args, **kwargs)
+        except admission.Rejected:
+            # NOTE: Load shedding is answered by ``rejected()``
+            #       (a 503 with ``Retry-After``), not a traceback page.
+            raise
         except:
-            exc_info = boltons.tbutils.ExceptionInfo.from_current()
-            exc_str = exc_info.get_formatted()
-            return code_block(exc_str)
+            exc_type, exc_value, traceback = sys.exc_info()
+            record = ERRORS.record(exc_type, exc_value, traceback)
+            # NOTE: The message is not cached, since it may contain data
+            #       from the request that raised it.
+            page = code_block(
+                record.frames +
+                error_cache.format_exception_only(exc_type, exc_value))
+            return page, 500
 
 
 @app.route('/')
@@ -85,25 +132,26 @@ def main():
 @app.route('/info')
 @PrettyErrors
 def info():
-    if grpc is None:
-        exc_info = boltons.tbutils.ExceptionInfo.from_exc_info(*grpc_info)
+    grpc_info = grpc.import_error()
+    if grpc_info is not None:
+        exc_info = tbutils.ExceptionInfo.from_exc_info(*grpc_info)
         grpc_msg = exc_info.get_formatted()
     else:
         try:
-            dist = pkg_resources.get_distribution('grpcio')
+            dist = dist_manifest.get_distribution('grpcio')
             grpc_msg = '\n'.join([
                 '>>> grpc',
                 repr(grpc),
-                '>>> dist = pkg_resources.get_distribution(\'grpcio\')',
+                '>>> dist = dist_manifest.get_distribution(\'grpcio\')',
                 '>>> dist',
                 repr(dist),
             ])
-        except pkg_resources.DistributionNotFound:
-            exc_info = boltons.tbutils.ExceptionInfo.from_current()
+        except dist_manifest.DistributionNotFound:
+            exc_info = tbutils.ExceptionInfo.from_current()
             grpc_msg = '\n'.join([
                 '>>> grpc',
                 repr(grpc),
-                '>>> dist = pkg_resources.get_distribution(\'grpcio\')',
+                '>>> dist = dist_manifest.get_distribution(\'grpcio\')',
                 exc_info.get_formatted(),
             ])
 
@@ -123,6 +171,8 @@ def info():
         '>>> import _multiprocessing',
         '>>> _multiprocessing',
         repr(_multiprocessing),
+        '>>> importers.STUBS.hits',
+        repr(importers.STUBS.hits),
         '>>> import os',
         '>>> os',
         repr(os),
@@ -135,44 +185,51 @@ def info():
         repr(six),
         '>>> six.__version__',
         repr(six.__version__),
-        '>>> import setuptools',
-        '>>> setuptools',
-        repr(setuptools),
-        '>>> import pkg_resources',
-        '>>> pkg_resources',
-        repr(pkg_resources),
+        # NOTE: Importing ``setuptools`` or ``pkg_resources`` scans all of
+        #       ``sys.path``, so they are only shown if already imported
+        #       (e.g. by a ``dist_manifest`` fallback).
+        '>>> sys.modules.get(\'setuptools\')',
+        repr(sys.modules.get('setuptools')),
+        '>>> sys.modules.get(\'pkg_resources\')',
+        repr(sys.modules.get('pkg_resources')),
         '>>> import google.protobuf',
         '>>> google.protobuf',
-        repr(google.protobuf),
+        repr(protobuf.load()),
         '>>> google.protobuf.__version__',
-        repr(google.protobuf.__version__),
+        repr(protobuf.__version__),
         '>>> import grpc',
         grpc_msg,
     )
 
 
-def load_module(path):
-    dirname, basename = os.path.split(path)
-    mod_name, extension = os.path.splitext(basename)
-    assert extension == '.py'
-    file_obj, filename, details = imp.find_module(mod_name, [dirname])
-    return imp.load_module(
-        mod_name, file_obj, filename, details)
-
-
 @app.route('/unit-tests')
 @PrettyErrors
 def unit_tests():
-    test_mods = []
-    for dirpath, _, filenames in os.walk('unit-tests'):
-        for filename in filenames:
-            if not filename.endswith('.py'):
-                continue
-            if filename == '__init__.py':
-                continue
-            test_mods.append(os.path.join(dirpath, filename))
-
-    mod_objs = [load_module(path) for path in test_mods]
+    test_mods = unit_runner.discover_test_modules()
+    mod_objs, changed = unit_runner.load_modules(test_mods)
+    if flask.request.args.get('incremental') == '1':
+        test_mods, mod_objs = unit_runner.select_incremental(
+            test_mods, mod_objs, changed)
+    parallel = flask.request.args.get('mode') == 'parallel'
+    workers = flask.request.args.get(
+        'workers', unit_runner.DEFAULT_WORKERS, type=int)
+    report_format = flask.request.args.get('format')
+    if report_format in ('json', 'junit'):
+        if parallel:
+            mod_results = list(
+                unit_runner.run_parallel(test_mods, mod_objs, workers))
+        else:
+            mod_results = [
+                unit_runner.run_module(path, mod_obj)
+                for path, mod_obj in zip(test_mods, mod_objs)
+            ]
+        return unit_test_report(mod_results, report_format)
+
+    if parallel:
+        return flask.Response(
+            stream_unit_tests(test_mods, mod_objs, workers),
+            mimetype='text/html')
+
     suite = unittest.TestSuite()
     for mod_obj in mod_objs:
         tests = unittest.defaultTestLoader.loadTestsFromModule(mod_obj)
@@ -181,6 +238,8 @@ def unit_tests():
     stream = io.BytesIO()
     test_result = unittest.TextTestRunner(
         stream=stream, verbosity=2).run(suite)
+    unit_runner.record_outcome(
+        test_mods, unit_runner.failed_modules(test_mods, test_result))
 
     return code_block(
         '>>> import imp',
@@ -222,6 +281,51 @@ def unit_tests():
     )
 
 
+def unit_test_report(mod_results, report_format):
+    """Render structured results with per-test and per-module timings.
+
+    Helper for :func:`unit_tests` (``/unit-tests?format=json`` or
+    ``/unit-tests?format=junit``).
+    """
+    if report_format == 'json':
+        slowest = flask.request.args.get(
+            'slowest', unit_runner.DEFAULT_SLOWEST, type=int)
+        return flask.Response(
+            unit_runner.to_json(mod_results, slowest=slowest),
+            mimetype='application/json')
+
+    return flask.Response(
+        unit_runner.to_junit(mod_results), mimetype='application/xml')
+
+
+def stream_unit_tests(test_mods, mod_objs, workers):
+    """Stream the output of each test module as it finishes.
+
+    Helper for :func:`unit_tests` (``/unit-tests?mode=parallel``).
+    Modules run on a bounded thread pool but are reported in order.
+    """
+    start = time.time()
+    yield '<pre>\n'
+    tests_run = failures = errors = 0
+    results = unit_runner.run_parallel(test_mods, mod_objs, workers)
+    for mod_result in results:
+        test_result = mod_result.test_result
+        tests_run += test_result.testsRun
+        failures += len(test_result.failures)
+        errors += len(test_result.errors)
+        header = '>>> {} ({:.3f}s)'.format(
+            mod_result.path, mod_result.duration)
+        yield flask.escape(header) + '\n'
+        yield flask.escape(mod_result.output) + '\n'
+
+    summary = 'Ran {} tests in {:.3f}s ({} failures, {} errors)'.format(
+        tests_run, time.time() - start, failures, errors)
+    yield flask.escape(summary) + '\n'
+    # NOTE: Adding markup to ``flask.escape()`` output would escape it,
+    #       so the closing tag is a chunk of its own.
+    yield '</pre>\n'
+
+
 @app.route('/import')
 @PrettyErrors
 def import_():
@@ -237,13 +341,19 @@ def import_():
 @app.route('/auth-check')
 @PrettyErrors
 def auth_check():
-    credentials, project = google.auth.default()
-    key_name, signature = app_identity.sign_blob(b'abc')
+    credentials, project = tokens.default_credentials()
+    def sign_blob():
+        with metrics.timed_call('app_identity', 'sign_blob'):
+            return app_identity.sign_blob(b'abc')
+
+    key_name, signature = admission.ADMISSION.call(
+        'app_identity', 'sign_blob', sign_blob)
     scope = 'https://www.googleapis.com/auth/userinfo.email'
-    token, expiry = app_identity.get_access_token(scope)
+    token, expiry = tokens.MANAGER.get_access_token(scope)
     return code_block(
-        '>>> import google.auth',
-        '>>> credentials, project = google.auth.default()',
+        '>>> import tokens',
+        '>>> # Calls ``google.auth.default()`` once per instance.',
+        '>>> credentials, project = tokens.default_credentials()',
         '>>> credentials',
         repr(credentials),
         '>>> project',
@@ -256,7 +366,8 @@ def auth_check():
         # ALSO: get_access_token_uncached
         # (scopes, service_account_id=None)
         '>>> scope = \'https://www.googleapis.com/auth/userinfo.email\'',
-        '>>> token, expiry = app_identity.get_access_token(scope)',
+        '>>> # Cached per scope and refreshed ahead of ``expiry``.',
+        '>>> token, expiry = tokens.MANAGER.get_access_token(scope)',
         '>>> token',
         repr(token[:6] + b'...'),
         '>>> expiry',
@@ -283,49 +394,201 @@ def auth_check():
 @PrettyErrors
 def system_tests():
     # NOTE: We intentionally import at run-time.
-    from google.cloud import language_v1
     from google.cloud.language_v1 import enums
 
-    scopes = language_v1.LanguageServiceClient._ALL_SCOPES
-    credentials, _ = google.auth.default(scopes=scopes)
-    logging.info('credentials: %r', credentials)
-    client = language_v1.LanguageServiceClient(credentials=credentials)
-    logging.info('client: %r', client)
+    handle = language_api.POOL.get_handle()
+    logging.info('credentials: %r', handle.credentials)
+    logging.info('client: %r', handle.client)
     content = 'Hello, world!'
     type_ = enums.Document.Type.PLAIN_TEXT
     document = {'content': content, 'type': type_}
     logging.info('document: %r', document)
-    response = client.analyze_sentiment(document)
+    response = language_api.analyze_sentiment(document)
     logging.info('response: %r', response)
 
     return code_block(
-        '>>> from google.cloud import language_v1',
         '>>> from google.cloud.language_v1 import enums',
+        '>>> import language_api',
         '>>>',
-        '>>> scopes = language_v1.LanguageServiceClient._ALL_SCOPES',
-        '>>> scopes',
-        repr(scopes),
-        '>>> credentials, _ = google.auth.default(scopes=scopes)',
-        '>>> credentials',
-        repr(credentials),
-        '>>>',
-        '>>> client = language_v1.LanguageServiceClient(credentials=credentials)',
-        '>>> client',
-        repr(client),
+        '>>> # Shared by all requests on this instance.',
+        '>>> handle = language_api.POOL.get_handle()',
+        '>>> handle.credentials',
+        repr(handle.credentials),
+        '>>> handle.client',
+        repr(handle.client),
+        '>>> handle.age',
+        repr(handle.age),
+        '>>> language_api.POOL.builds',
+        repr(language_api.POOL.builds),
         '>>>',
         '>>> content = \'Hello, world!\'',
         '>>> type_ = enums.Document.Type.PLAIN_TEXT',
         '>>> document = {\'content\': content, \'type\': type_}',
-        '>>> response = client.analyze_sentiment(document)',
+        '>>> response = language_api.analyze_sentiment(document)',
         '>>>',
         '>>> response',
         repr(response)
     )
 
 
+@app.route('/analyze/batch', methods=['POST'])
+def analyze_batch():
+    payload = flask.request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = payload.get('documents')
+    if not isinstance(payload, list):
+        msg = 'Expected a JSON list of documents (or {"documents": [...]}).'
+        return flask.jsonify(error=msg), 400
+    max_documents = language_api.batch_max_documents()
+    if len(payload) > max_documents:
+        msg = 'Expected at most {} documents, got {}.'.format(
+            max_documents, len(payload))
+        return flask.jsonify(error=msg), 400
+
+    concurrency = flask.request.args.get(
+        'concurrency', fanout.DEFAULT_CONCURRENCY, type=int)
+    timeout = flask.request.args.get(
+        'timeout', language_api.DEFAULT_TIMEOUT, type=float)
+    outcomes = language_api.analyze_sentiment_batch(
+        payload, concurrency=concurrency, timeout=timeout)
+
+    results = []
+    for outcome in outcomes:
+        if outcome.ok:
+            results.append({'ok': True, 'response': outcome.value})
+        else:
+            error = '{}: {}'.format(
+                outcome.error.__class__.__name__, outcome.error)
+            results.append({'ok': False, 'error': error})
+    return flask.jsonify(results=results)
+
+
+@app.route('/analyze/annotate', methods=['POST'])
+def analyze_annotate():
+    payload = flask.request.get_json(silent=True)
+    features = language_api.DEFAULT_FEATURES
+    if isinstance(payload, dict) and 'document' in payload:
+        features = payload.get('features', features)
+        payload = payload['document']
+    features = flask.request.args.get('features', features)
+    if isinstance(features, six.string_types):
+        features = [name for name in features.split(',') if name]
+    try:
+        document = language_api.make_document(payload)
+        language_api.make_features(features)
+    except ValueError as exc:
+        return flask.jsonify(error=str(exc)), 400
+
+    timeout = flask.request.args.get(
+        'timeout', language_api.DEFAULT_TIMEOUT, type=float)
+    response = language_api.annotate_text(
+        document, features=features, timeout=timeout)
+    result = language_api.compact_annotation(response, features=features)
+    # NOTE: ``flask.jsonify`` pretty-prints, which (for the token rows)
+    #       can double the size of the response.
+    return flask.Response(
+        json.dumps(result, separators=(',', ':')),
+        mimetype='application/json')
+
+
+@app.route('/analyze/chunked', methods=['POST'])
+def analyze_chunked():
+    payload = flask.request.get_json(silent=True)
+    if isinstance(payload, dict) and 'document' in payload:
+        payload = payload['document']
+    max_bytes = flask.request.args.get(
+        'max_bytes', chunking.DEFAULT_MAX_BYTES, type=int)
+    concurrency = flask.request.args.get(
+        'concurrency', fanout.DEFAULT_CONCURRENCY, type=int)
+    timeout = flask.request.args.get(
+        'timeout', language_api.DEFAULT_TIMEOUT, type=float)
+    try:
+        document = language_api.make_document(payload)
+        if max_bytes < chunking.MIN_MAX_BYTES:
+            raise ValueError('max_bytes must be at least {}.'.format(
+                chunking.MIN_MAX_BYTES))
+    except ValueError as exc:
+        return flask.jsonify(error=str(exc)), 400
+
+    response, chunks = chunking.analyze_sentiment(
+        document, max_bytes=max_bytes, concurrency=concurrency,
+        timeout=timeout)
+    return flask.jsonify(
+        chunks=[{'offset': chunk.offset, 'length': len(chunk.text)}
+                for chunk in chunks],
+        response=language_api.to_dict(response))
+
+
+@app.route('/cache-stats')
+def cache_stats():
+    return flask.jsonify(language_api.CACHE.stats())
+
+
+@app.route('/metrics')
+def metrics_():
+    for stat, value in language_api.CACHE.stats().items():
+        metrics.REGISTRY.set_gauge('app_language_cache', {'stat': stat}, value)
+    for stat, value in language_api.FLIGHTS.stats().items():
+        metrics.REGISTRY.set_gauge(
+            'app_language_singleflight', {'stat': stat}, value)
+    for method, state in admission.ADMISSION.state().items():
+        for stat, value in state.items():
+            metrics.REGISTRY.set_gauge(
+                'app_admission', {'method': method, 'stat': stat}, value)
+    return flask.Response(
+        metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/admission')
+def admission_():
+    return flask.jsonify(admission.ADMISSION.state())
+
+
+@app.route('/errors')
+def errors():
+    return flask.jsonify(
+        errors=ERRORS.summary(), evictions=ERRORS.evictions)
+
+
+@app.route('/startup-profile')
+@PrettyErrors
+def startup_profile():
+    min_ms = flask.request.args.get('min_ms', 0.0, type=float)
+    return code_block(*startup.format_tree(min_ms=min_ms))
+
+
+@app.route('/_ah/warmup')
+def warmup_():
+    step_names = flask.request.args.get('steps')
+    if step_names is not None:
+        step_names = [name for name in step_names.split(',') if name]
+    try:
+        results = warmup.run(step_names)
+    except ValueError as exc:
+        return flask.jsonify(error=str(exc)), 400
+
+    total = sum(result.duration for result in results)
+    return flask.jsonify(
+        steps=[result.to_dict() for result in results],
+        total_ms=round(1000.0 * total, 3))
+
+
+@app.errorhandler(admission.Rejected)
+def rejected(exc):
+    # NOTE: Shed the load rather than queue it, and ask the client to
+    #       back off too.
+    response = flask.jsonify(error=str(exc))
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+
 @app.errorhandler(500)
 def server_error(exc):
     # Log the error and stacktrace (``logging.exception`` will
     # automatically add the stacktrace).
     logging.exception('An error occurred during a request.')
     return 'An internal error occurred.', 500
+
+
+startup.finish()
@@ -0,0 +1,324 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process request and outbound call metrics (Prometheus text format).
+
+:class:`MetricsMiddleware` wraps the WSGI app and records, per route, a
+latency histogram, the in-flight request count and request / error
+counts. :func:`timed_call` records the latency (and errors) of outbound
+calls (e.g. the Language API and ``app_identity``), so the time spent
+in our code can be told apart from the time spent waiting on RPCs.
+
+The metrics are per instance (App Engine runs many), so a scraper must
+aggregate across instances.
+"""
+
+import bisect
+import contextlib
+import threading
+import time
+
+import werkzeug.exceptions
+import werkzeug.routing
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+UNMATCHED_ROUTE = '<unmatched>'
+# NOTE: Maps each metric name to its type and help text.
+METRICS = {
+    'app_requests_in_flight': (
+        'gauge', 'Requests currently being handled.'),
+    'app_request_duration_seconds': (
+        'histogram', 'Request latency (until the response is closed).'),
+    'app_requests_total': (
+        'counter', 'Requests handled, by status code.'),
+    'app_request_errors_total': (
+        'counter', 'Requests that raised or returned a 5xx status.'),
+    'app_outbound_duration_seconds': (
+        'histogram', 'Latency of outbound calls (RPCs).'),
+    'app_outbound_errors_total': (
+        'counter', 'Outbound calls that raised.'),
+    'app_language_cache': (
+        'gauge', 'Language API result cache statistics.'),
+    'app_admission': (
+        'gauge', 'Outbound call admission control state, by method.'),
+    'app_language_singleflight': (
+        'gauge', 'Language API calls made and shared (saved) by '
+        'coalescing identical in-flight requests.'),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\')
+            .replace('"', '\\"').replace('\n', '\\n'))
+
+
+def _format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, _escape(value)) for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Histogram(object):
+    """Counts of observed values in cumulative buckets.
+
+    Args:
+        buckets (Tuple[float, ...]): The (sorted) upper bounds of the
+            buckets. A final ``+Inf`` bucket is implied.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # NOTE: A bucket counts values less than or equal to its bound.
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def cumulative(self):
+        """Get ``(upper bound, cumulative count)`` for each bucket."""
+        bounds = self.buckets + (float('inf'),)
+        running = 0
+        result = []
+        for bound, count in zip(bounds, self.counts):
+            running += count
+            result.append((bound, running))
+        return result
+
+
+class Registry(object):
+    """Thread-safe store of labelled counters, gauges and histograms.
+
+    Args:
+        buckets (Tuple[float, ...]): The buckets for every histogram.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        """Add to a counter (or gauge)."""
+        key = name, _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set_gauge(self, name, labels, value):
+        with self._lock:
+            self._values[name, _label_key(labels)] = value
+
+    def observe(self, name, labels, value):
+        """Add an observation to a histogram."""
+        key = name, _label_key(labels)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = Histogram(self.buckets)
+                self._values[key] = histogram
+            histogram.observe(value)
+
+    def get(self, name, labels):
+        """Get the current value of a counter or gauge (or a histogram)."""
+        with self._lock:
+            return self._values.get((name, _label_key(labels)))
+
+    def render(self):
+        """Render every metric in the Prometheus text format.
+
+        Returns:
+            str: The metrics, grouped (and sorted) by name.
+        """
+        by_name = {}
+        with self._lock:
+            for (name, label_key), value in self._values.items():
+                if isinstance(value, Histogram):
+                    value = value.total, value.count, value.cumulative()
+                by_name.setdefault(name, []).append((label_key, value))
+
+        lines = []
+        for name in sorted(by_name):
+            metric_type, help_text = METRICS.get(name, ('untyped', name))
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for label_key, value in sorted(by_name[name]):
+                if metric_type != 'histogram':
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(label_key), _format_value(value)))
+                    continue
+
+                total, count, cumulative = value
+                for bound, bucket_count in cumulative:
+                    bucket_labels = _format_labels(
+                        label_key, [('le', _format_value(bound))])
+                    lines.append('{}_bucket{} {}'.format(
+                        name, bucket_labels, bucket_count))
+                labels = _format_labels(label_key)
+                lines.append('{}_sum{} {}'.format(
+                    name, labels, _format_value(total)))
+                lines.append('{}_count{} {}'.format(name, labels, count))
+
+        lines.append('')
+        return '\n'.join(lines)
+
+
+REGISTRY = Registry()
+
+
+@contextlib.contextmanager
+def timed_call(service, method, registry=None):
+    """Time an outbound call (and count it if it raises).
+
+    Args:
+        service (str): The service called, e.g. ``'language'``.
+        method (str): The method called, e.g. ``'analyze_sentiment'``.
+        registry (Optional[Registry]): Where to record the call. Defaults
+            to :data:`REGISTRY`.
+    """
+    if registry is None:
+        registry = REGISTRY
+    labels = {'service': service, 'method': method}
+    start = time.time()
+    try:
+        yield
+    except Exception:
+        registry.inc('app_outbound_errors_total', labels)
+        raise
+    finally:
+        registry.observe(
+            'app_outbound_duration_seconds', labels, time.time() - start)
+
+
+def flask_route_func(app):
+    """Build a function that maps a request to the URL rule it matches.
+
+    Using the rule (e.g. ``/info``) rather than the path keeps the
+    ``route`` label from depending on path parameters.
+
+    Args:
+        app (flask.Flask): The application.
+
+    Returns:
+        Callable[[dict], str]: Maps a WSGI environment to a route.
+    """
+    def route_func(environ):
+        adapter = app.url_map.bind_to_environ(environ)
+        try:
+            rule, _ = adapter.match(return_rule=True)
+        except (werkzeug.exceptions.HTTPException,
+                werkzeug.routing.RoutingException):
+            return UNMATCHED_ROUTE
+        return rule.rule
+
+    return route_func
+
+
+class _ClosingIterable(object):
+    """Wraps a WSGI response to record metrics once it is closed."""
+
+    def __init__(self, result, on_close):
+        self.result = result
+        self.on_close = on_close
+        self.failed = False
+
+    def __iter__(self):
+        try:
+            for chunk in self.result:
+                yield chunk
+        except Exception:
+            self.failed = True
+            raise
+
+    def close(self):
+        try:
+            close = getattr(self.result, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            self.on_close(self.failed)
+
+
+class MetricsMiddleware(object):
+    """WSGI middleware that records per-route request metrics.
+
+    Latency is measured until the response is closed, so streamed
+    responses (e.g. ``/unit-tests?mode=parallel``) are timed in full.
+
+    Args:
+        app (Callable): The WSGI application to wrap.
+        route_func (Optional[Callable[[dict], str]]): Maps a WSGI
+            environment to the ``route`` label. Defaults to the path.
+        registry (Optional[Registry]): Where to record the metrics.
+            Defaults to :data:`REGISTRY`.
+    """
+
+    def __init__(self, app, route_func=None, registry=None):
+        if route_func is None:
+            route_func = lambda environ: environ.get('PATH_INFO', '')
+        if registry is None:
+            registry = REGISTRY
+        self.app = app
+        self.route_func = route_func
+        self.registry = registry
+
+    def _finish(self, route, method, start, status, failed):
+        labels = {'route': route, 'method': method}
+        self.registry.observe(
+            'app_request_duration_seconds', labels, time.time() - start)
+        self.registry.inc(
+            'app_requests_total', dict(labels, status=status))
+        if failed or status.startswith('5'):
+            self.registry.inc('app_request_errors_total', labels)
+        self.registry.inc('app_requests_in_flight', {'route': route}, -1)
+
+    def __call__(self, environ, start_response):
+        route = self.route_func(environ)
+        method = environ.get('REQUEST_METHOD', 'GET')
+        statuses = []
+
+        def recording_start_response(status, headers, exc_info=None):
+            statuses.append(status.split(' ', 1)[0])
+            return start_response(status, headers, exc_info)
+
+        self.registry.inc('app_requests_in_flight', {'route': route})
+        start = time.time()
+        try:
+            result = self.app(environ, recording_start_response)
+        except Exception:
+            self._finish(route, method, start, '500', True)
+            raise
+
+        def on_close(failed):
+            status = statuses[-1] if statuses else '500'
+            self._finish(route, method, start, status, failed)
+
+        return _ClosingIterable(result, on_close)
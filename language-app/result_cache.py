@@ -0,0 +1,162 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Two-tier cache for API results, keyed by a hash of the request.
+
+The first tier is an in-process LRU cache with a TTL. The optional
+second tier is anything with a ``memcache``-style interface, i.e.
+``get(key)`` and ``set(key, value, time=ttl)``; in production that is
+``google.appengine.api.memcache`` and locally :class:`FakeMemcache`.
+"""
+
+import hashlib
+import json
+import threading
+import time
+
+import cachetools
+
+
+DEFAULT_MAXSIZE = 1024
+DEFAULT_TTL = 600.0
+KEY_PREFIX = 'language-result:'
+
+
+def make_key(method_name, document, options=None):
+    """Hash an API request into a cache key.
+
+    Args:
+        method_name (str): The name of the API method.
+        document (dict): The document sent (content, type, etc.).
+        options (Optional[dict]): Any other request fields that change
+            the result (e.g. the features requested).
+
+    Returns:
+        str: A key that is the same for identical requests.
+    """
+    parts = [method_name, document]
+    if options:
+        parts.append(options)
+    payload = json.dumps(parts, sort_keys=True)
+    digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    return KEY_PREFIX + digest
+
+
+def _now():
+    return time.time()
+
+
+class _CountingTTLCache(cachetools.TTLCache):
+    """A ``TTLCache`` that counts evictions made to free up space."""
+
+    def __init__(self, *args, **kwargs):
+        super(_CountingTTLCache, self).__init__(*args, **kwargs)
+        self.evictions = 0
+
+    def popitem(self):
+        result = super(_CountingTTLCache, self).popitem()
+        self.evictions += 1
+        return result
+
+
+class FakeMemcache(object):
+    """In-memory stand-in for the ``memcache`` API (for local use)."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+            if expires is not None and expires <= _now():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value, time=0):
+        # NOTE: ``time`` (the TTL in seconds) matches the ``memcache`` API.
+        expires = None
+        if time:
+            expires = _now() + time
+        with self._lock:
+            self._values[key] = value, expires
+        return True
+
+
+class ResultCache(object):
+    """Thread-safe LRU + TTL cache with an optional shared second tier.
+
+    Args:
+        maxsize (int): The maximum number of entries kept in process.
+        ttl (float): The number of seconds an entry is valid for.
+        shared (Optional[object]): A second tier with a ``memcache``
+            interface. Results found there are copied to the first tier.
+    """
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL, shared=None):
+        self.ttl = ttl
+        self.shared = shared
+        self._local = _CountingTTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Look up a key in each tier.
+
+        Returns:
+            Optional[object]: The cached value, or :data:`None`.
+        """
+        with self._lock:
+            value = self._local.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+        if self.shared is not None:
+            value = self.shared.get(key)
+            if value is not None:
+                with self._lock:
+                    self.shared_hits += 1
+                    self._local[key] = value
+                return value
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        """Store a value in each tier."""
+        with self._lock:
+            self._local[key] = value
+        if self.shared is not None:
+            self.shared.set(key, value, time=int(self.ttl))
+
+    def stats(self):
+        """Get the cache counters.
+
+        Returns:
+            Dict[str, int]: Hits (per tier), misses, evictions and size.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'evictions': self._local.evictions,
+                'size': len(self._local),
+                'maxsize': int(self._local.maxsize),
+            }
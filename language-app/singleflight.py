@@ -0,0 +1,124 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Coalesce identical concurrent calls into one.
+
+Since the app is ``threadsafe``, a burst of requests for the same
+document can all miss the result cache at the same moment and each make
+the same RPC. With :class:`Group`, the first caller for a key makes the
+call and the others wait for (and share) its result, or its error.
+
+Nothing is remembered once a call finishes (that is the job of the
+result cache), so a failed call is retried by the next caller.
+
+A waiter may give up (with :exc:`WaitTimeout`) before the shared call
+finishes, since it may have a shorter deadline than the caller making
+the call. The call itself is only bounded by whatever deadline ``func``
+uses.
+"""
+
+import sys
+import threading
+
+import six
+
+
+class WaitTimeout(Exception):
+    """A shared call did not finish within the waiter's timeout."""
+
+
+class _Flight(object):
+    """A call in progress, and its result once it finishes."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exc_info = None
+
+
+class Group(object):
+    """Thread-safe registry of in-flight calls, keyed by request."""
+
+    def __init__(self):
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+        self.errors = 0
+        self.wait_timeouts = 0
+
+    def do(self, key, func, timeout=None):
+        """Call ``func``, unless a call for ``key`` is already running.
+
+        Args:
+            key (str): Identifies the call (e.g. a cache key).
+            func (Callable[[], object]): Makes the call.
+            timeout (Optional[float]): The number of seconds to wait for
+                a call already running (a call made by this caller is
+                not interrupted).
+
+        Returns:
+            object: The result of the (possibly shared) call.
+
+        Raises:
+            WaitTimeout: If a shared call did not finish in time.
+            Exception: Whatever the (possibly shared) call raised.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if leader:
+            try:
+                flight.value = func()
+            except:
+                flight.exc_info = sys.exc_info()
+                with self._lock:
+                    self.errors += 1
+            finally:
+                with self._lock:
+                    del self._flights[key]
+                flight.done.set()
+        elif not flight.done.wait(timeout):
+            with self._lock:
+                self.wait_timeouts += 1
+            raise WaitTimeout(
+                'Shared call did not finish within {}s'.format(timeout))
+
+        if flight.exc_info is not None:
+            six.reraise(*flight.exc_info)
+        return flight.value
+
+    def stats(self):
+        """Get the call counters.
+
+        Returns:
+            Dict[str, int]: Calls made, calls saved (``shared``), failed
+            calls, waiters that timed out and calls currently in flight.
+        """
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'shared': self.shared,
+                'errors': self.errors,
+                'wait_timeouts': self.wait_timeouts,
+                'in_flight': len(self._flights),
+            }
@@ -0,0 +1,288 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Startup profiler for instance cold starts.
+
+Importing this module starts recording. Every step wrapped in
+:func:`timed` (or run via :func:`step`) and every ``import`` statement
+that actually loads a module becomes a node in a nested timing tree,
+so slow imports show up underneath whatever triggered them.
+
+Recording stops (and the tree is logged) when :func:`finish` is called
+at the end of ``main.py``. Imports deferred until a route first uses
+them (see ``importers.LazyModule``) are recorded afterwards, via
+:func:`record_deferred`, in a separate tree.
+"""
+
+import __builtin__
+import contextlib
+import logging
+import sys
+import threading
+import time
+
+
+ORIGINAL_IMPORT = __builtin__.__import__
+LOG_MIN_MS = 1.0
+
+
+class TimingNode(object):
+    """A single timed step in the startup tree.
+
+    Args:
+        name (str): A label for the step (e.g. ``'import grpc'``).
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.duration = None
+        self.children = []
+
+    @property
+    def duration_ms(self):
+        if self.duration is None:
+            return None
+        return 1000.0 * self.duration
+
+    def to_lines(self, min_ms=0.0, depth=0):
+        """Render this node (and its children) as indented lines.
+
+        Args:
+            min_ms (float): Nodes faster than this are omitted.
+            depth (int): The indentation level of this node.
+
+        Returns:
+            List[str]: One line per rendered node.
+        """
+        duration_ms = self.duration_ms
+        if duration_ms is None:
+            timing = '  (running)'
+        elif duration_ms < min_ms:
+            return []
+        else:
+            timing = '{:9.2f}ms'.format(duration_ms)
+
+        lines = ['{} {}{}'.format(timing, '  ' * depth, self.name)]
+        for child in self.children:
+            lines.extend(child.to_lines(min_ms=min_ms, depth=depth + 1))
+        return lines
+
+
+ROOT = TimingNode('startup')
+_STACK = [ROOT]
+_OWNER = threading.current_thread()
+_FINISHED = []
+DEFERRED = TimingNode('deferred imports (on first use)')
+DEFERRED.duration = 0.0
+_DEFERRED_LOCK = threading.Lock()
+
+
+def _recording():
+    return not _FINISHED and threading.current_thread() is _OWNER
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Record the body of a ``with`` block as a node in the tree.
+
+    This is a no-op once :func:`finish` has been called or when used
+    from a thread other than the one that started the instance.
+
+    Args:
+        name (str): A label for the step.
+
+    Yields:
+        Optional[TimingNode]: The node for the step (:data:`None` if
+        not recording).
+    """
+    if not _recording():
+        yield None
+        return
+
+    node = TimingNode(name)
+    _STACK[-1].children.append(node)
+    _STACK.append(node)
+    try:
+        yield node
+    finally:
+        node.duration = time.time() - node.start
+        _STACK.pop()
+
+
+def step(func, *args, **kwargs):
+    """Call ``func`` and record it in the tree.
+
+    The label is built from the function and the positional
+    arguments, e.g. ``vendor.add('lib')``.
+
+    Returns:
+        object: The return value of ``func``.
+    """
+    module_name = getattr(func, '__module__', None) or ''
+    prefix = module_name.rsplit('.', 1)[-1]
+    if prefix == '__main__':
+        prefix = ''
+    elif prefix:
+        prefix += '.'
+    name = '{}{}({})'.format(
+        prefix, func.__name__, ', '.join(repr(arg) for arg in args))
+    with timed(name):
+        return func(*args, **kwargs)
+
+
+def _package(globals, level):
+    """Get the package a relative import is resolved against.
+
+    Follows the Python 2 rules: ``__package__`` if it is set, otherwise
+    the importing module (if it is a package) or its parent, then one
+    level up for each leading dot after the first.
+    """
+    if not globals:
+        return None
+    package = globals.get('__package__')
+    if package is None:
+        mod_name = globals.get('__name__') or ''
+        if '__path__' in globals:
+            package = mod_name
+        else:
+            package = mod_name.rpartition('.')[0]
+    if package and level > 1:
+        package = package.rsplit('.', level - 1)[0]
+    return package or None
+
+
+def _candidates(name, globals, level):
+    """Get the absolute names an import may load, in the order tried.
+
+    An implicit relative import (``level == -1``) tries the name in the
+    importing package first and then falls back to the absolute name.
+    """
+    if level == 0:
+        return [name]
+    package = _package(globals, max(level, 1))
+    if package is None:
+        return [name]
+    if level > 0:
+        return [package + '.' + name if name else package]
+    return [package + '.' + name, name]
+
+
+def _loaded_name(candidates):
+    for mod_name in candidates:
+        # NOTE: A failed implicit relative import leaves a ``None``
+        #       placeholder in ``sys.modules``.
+        if sys.modules.get(mod_name) is not None:
+            return mod_name
+    return None
+
+
+def _missing_submodules(mod_name, fromlist):
+    """Get the submodules a ``from package import ...`` will load."""
+    module = sys.modules[mod_name]
+    if not fromlist or not hasattr(module, '__path__'):
+        return []
+    return [
+        mod_name + '.' + item for item in fromlist
+        if item != '*' and not hasattr(module, item)
+    ]
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    """Replacement for the ``__import__`` builtin.
+
+    Only imports that actually load a module are recorded, so
+    re-imports of cached modules don't clutter the tree. Nodes are
+    labelled with the absolute module name, so relative imports (e.g.
+    ``from . import app`` within ``flask``) show as ``import flask.app``.
+    """
+    if not _recording():
+        return ORIGINAL_IMPORT(name, globals, locals, fromlist, level)
+
+    candidates = _candidates(name, globals, level)
+    loaded_name = _loaded_name(candidates)
+    if loaded_name is None:
+        labels = candidates[:1]
+    else:
+        labels = _missing_submodules(loaded_name, fromlist)
+        if not labels:
+            return ORIGINAL_IMPORT(name, globals, locals, fromlist, level)
+
+    with timed('import ' + ', '.join(labels)) as node:
+        try:
+            return ORIGINAL_IMPORT(name, globals, locals, fromlist, level)
+        finally:
+            # NOTE: Whether an implicit relative import resolved to the
+            #       package or fell back to an absolute import is only
+            #       known once it has run.
+            if loaded_name is None:
+                node.name = 'import ' + (
+                    _loaded_name(candidates) or candidates[-1])
+
+
+def record_deferred(mod_name, duration, failed=False):
+    """Record the first import of a module that was deferred.
+
+    Args:
+        mod_name (str): The name of the module.
+        duration (float): The number of seconds the import took.
+        failed (bool): Indicating if the import raised ``ImportError``.
+    """
+    name = 'import ' + mod_name
+    if failed:
+        name += ' (ImportError)'
+    node = TimingNode(name)
+    node.duration = duration
+    with _DEFERRED_LOCK:
+        DEFERRED.children.append(node)
+        DEFERRED.duration += duration
+    logging.info('Deferred %s took %.2fms', name, node.duration_ms)
+
+
+def format_tree(min_ms=0.0):
+    """Render the startup tree (and the deferred imports, if any).
+
+    Args:
+        min_ms (float): Nodes faster than this are omitted.
+
+    Returns:
+        List[str]: One line per rendered node.
+    """
+    lines = ROOT.to_lines(min_ms=min_ms)
+    with _DEFERRED_LOCK:
+        if DEFERRED.children:
+            lines.extend(DEFERRED.to_lines(min_ms=min_ms))
+    return lines
+
+
+def finish():
+    """Stop recording and log the tree.
+
+    Only the first call has an effect, so the tree is logged once
+    per instance.
+    """
+    if _FINISHED:
+        return
+
+    ROOT.duration = time.time() - ROOT.start
+    _FINISHED.append(True)
+    if __builtin__.__import__ is _timed_import:
+        __builtin__.__import__ = ORIGINAL_IMPORT
+
+    logging.info(
+        'Startup profile (steps over %.1fms):\n%s',
+        LOG_MIN_MS, '\n'.join(format_tree(min_ms=LOG_MIN_MS)))
+
+
+__builtin__.__import__ = _timed_import
@@ -0,0 +1,205 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-scope access token cache with refresh-ahead.
+
+A token is refreshed in a background thread once it is within
+``margin`` seconds of its expiry, so no request has to wait for a
+refresh unless the token has actually expired. Concurrent callers that
+do have to wait for the same scope share a single refresh.
+"""
+
+import logging
+import threading
+import time
+
+import google.auth
+import six
+
+import admission
+import metrics
+
+
+DEFAULT_MARGIN = 300.0
+REFRESH_WAIT = 30.0
+
+
+def app_identity_fetch(scopes):
+    """Fetch a new token from ``app_identity`` (the default backend).
+
+    Args:
+        scopes (Union[str, Tuple[str, ...]]): The OAuth 2.0 scope(s).
+
+    Returns:
+        Tuple[str, float]: The access token and its expiry (in seconds
+        since the epoch).
+    """
+    # NOTE: We intentionally import at run-time so other backends can
+    #       be used without the App Engine SDK.
+    from google.appengine.api import app_identity
+
+    method = 'get_access_token_uncached'
+
+    def attempt():
+        with metrics.timed_call('app_identity', method):
+            return app_identity.get_access_token_uncached(scopes)
+
+    return admission.ADMISSION.call('app_identity', method, attempt)
+
+
+class _ScopeState(object):
+    """The cached token and refresh status for a single scope."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.token = None
+        self.expiry = None
+        self.refreshing = None
+        self.error = None
+
+
+class TokenManager(object):
+    """Caches access tokens per scope and refreshes them ahead of time.
+
+    Args:
+        fetch (Optional[Callable]): Fetches a new ``(token, expiry)``
+            for a scope. Defaults to :func:`app_identity_fetch`.
+        margin (float): Refresh (in the background) once a token is
+            within this many seconds of its expiry.
+        clock (Callable[[], float]): The current time.
+        thread_factory (Callable): Creates the background refresh
+            threads (same signature as ``threading.Thread``).
+    """
+
+    def __init__(self, fetch=None, margin=DEFAULT_MARGIN, clock=time.time,
+                 thread_factory=threading.Thread):
+        if fetch is None:
+            fetch = app_identity_fetch
+        self.fetch = fetch
+        self.margin = margin
+        self.clock = clock
+        self.thread_factory = thread_factory
+        self.fetches = 0
+        self.background_refreshes = 0
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state(self, scopes):
+        with self._lock:
+            return self._states.setdefault(scopes, _ScopeState())
+
+    def _refresh(self, scopes, state, refreshing):
+        """Fetch a new token and wake up anyone waiting for it."""
+        try:
+            token, expiry = self.fetch(scopes)
+        except Exception as exc:
+            logging.exception('Failed to refresh token for %r', scopes)
+            with state.lock:
+                state.error = exc
+        else:
+            with state.lock:
+                state.token = token
+                state.expiry = expiry
+                state.error = None
+        finally:
+            with state.lock:
+                self.fetches += 1
+                state.refreshing = None
+            refreshing.set()
+
+    def _refresh_in_background(self, scopes, state, refreshing):
+        with self._lock:
+            self.background_refreshes += 1
+        thread = self.thread_factory(
+            target=self._refresh, args=(scopes, state, refreshing))
+        thread.daemon = True
+        thread.start()
+
+    def get_access_token(self, scopes):
+        """Get an access token, refreshing it if needed.
+
+        Args:
+            scopes (Union[str, Iterable[str]]): The OAuth 2.0 scope(s).
+
+        Returns:
+            Tuple[str, float]: The access token and its expiry.
+
+        Raises:
+            Exception: If the token had to be refreshed synchronously and
+                the refresh failed.
+        """
+        if not isinstance(scopes, six.string_types):
+            scopes = tuple(sorted(scopes))
+        state = self._state(scopes)
+
+        now = self.clock()
+        with state.lock:
+            current = state.token, state.expiry
+            valid = state.token is not None and now < state.expiry
+            if valid and now < state.expiry - self.margin:
+                return current
+
+            refreshing = state.refreshing
+            start = refreshing is None
+            if start:
+                refreshing = threading.Event()
+                state.refreshing = refreshing
+
+        if valid:
+            if start:
+                self._refresh_in_background(scopes, state, refreshing)
+            return current
+
+        if start:
+            self._refresh(scopes, state, refreshing)
+        else:
+            refreshing.wait(REFRESH_WAIT)
+
+        with state.lock:
+            if state.token is None or self.clock() >= state.expiry:
+                if state.error is not None:
+                    raise state.error
+                raise RuntimeError('Failed to get an access token', scopes)
+            return state.token, state.expiry
+
+
+_CREDENTIALS = {}
+_CREDENTIALS_LOCK = threading.Lock()
+
+
+def default_credentials(scopes=None):
+    """Get ``google.auth.default()``, discovered once per instance.
+
+    Args:
+        scopes (Optional[Iterable[str]]): The OAuth 2.0 scopes the
+            credentials are for. Each distinct set of scopes is
+            discovered (and cached) separately.
+
+    Returns:
+        Tuple[google.auth.credentials.Credentials, Optional[str]]: The
+        credentials and project ID.
+    """
+    if scopes is not None:
+        scopes = tuple(sorted(scopes))
+    result = _CREDENTIALS.get(scopes)
+    if result is None:
+        with _CREDENTIALS_LOCK:
+            result = _CREDENTIALS.get(scopes)
+            if result is None:
+                result = google.auth.default(scopes=scopes)
+                _CREDENTIALS[scopes] = result
+    return result
+
+
+MANAGER = TokenManager()
@@ -0,0 +1,413 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Helpers for running the vendored unit tests from a request handler.
+
+Discovered module paths and loaded module objects are cached for the
+life of the instance and are keyed on modification times, so repeated
+runs on a warm instance neither walk the test directory nor re-execute
+unchanged test modules. The paths of modules that failed on their last
+run are also tracked to support incremental reruns.
+"""
+
+import collections
+import imp
+import io
+import json
+import os
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as ElementTree
+
+from concurrent import futures
+
+
+TEST_DIR = 'unit-tests'
+DEFAULT_WORKERS = 4
+MAX_WORKERS = 16
+DEFAULT_SLOWEST = 10
+
+_LOCK = threading.RLock()
+# Maps a test directory to ``(dir_mtimes, test_mods)``.
+_DISCOVERED = {}
+# Maps a test module path to ``(mtime, mod_obj)``.
+_LOADED = {}
+# Paths of the test modules that failed on their most recent run.
+_FAILED = set()
+
+
+def _walk_test_dir(test_dir):
+    """Walk ``test_dir`` for test modules.
+
+    Helper for :func:`discover_test_modules`.
+
+    Returns:
+        Tuple[Dict[str, float], List[str]]: The modification time of
+        each directory walked and the (sorted) test module paths.
+    """
+    dir_mtimes = {}
+    test_mods = []
+    for dirpath, _, filenames in os.walk(test_dir):
+        dir_mtimes[dirpath] = os.path.getmtime(dirpath)
+        for filename in filenames:
+            if not filename.endswith('.py'):
+                continue
+            if filename == '__init__.py':
+                continue
+            test_mods.append(os.path.join(dirpath, filename))
+
+    return dir_mtimes, sorted(test_mods)
+
+
+def _unchanged(dir_mtimes):
+    for dirpath, mtime in dir_mtimes.items():
+        try:
+            if os.path.getmtime(dirpath) != mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def discover_test_modules(test_dir=TEST_DIR):
+    """Find all unit test modules.
+
+    The result is cached and only recomputed when the modification time
+    of a directory in the tree changes (i.e. a file was added, removed
+    or renamed).
+
+    Args:
+        test_dir (str): The directory to search.
+
+    Returns:
+        List[str]: Paths to the test modules, in a stable order.
+    """
+    with _LOCK:
+        cached = _DISCOVERED.get(test_dir)
+        if cached is not None and _unchanged(cached[0]):
+            return list(cached[1])
+
+        dir_mtimes, test_mods = _walk_test_dir(test_dir)
+        _DISCOVERED[test_dir] = dir_mtimes, test_mods
+        return list(test_mods)
+
+
+def load_module(path):
+    dirname, basename = os.path.split(path)
+    mod_name, extension = os.path.splitext(basename)
+    assert extension == '.py'
+    file_obj, filename, details = imp.find_module(mod_name, [dirname])
+    return imp.load_module(
+        mod_name, file_obj, filename, details)
+
+
+def load_modules(test_mods):
+    """Load test modules, re-using cached modules that are unchanged.
+
+    A module is (re-)loaded only if it has not been loaded on this
+    instance or its source has been modified since it was.
+
+    Args:
+        test_mods (List[str]): The paths of the test modules.
+
+    Returns:
+        Tuple[List[module], Set[str]]: The loaded modules (in the same
+        order as ``test_mods``) and the paths that were (re-)loaded.
+    """
+    mod_objs = []
+    changed = set()
+    with _LOCK:
+        for path in test_mods:
+            mtime = os.path.getmtime(path)
+            cached = _LOADED.get(path)
+            if cached is None or cached[0] != mtime:
+                cached = mtime, load_module(path)
+                _LOADED[path] = cached
+                changed.add(path)
+            mod_objs.append(cached[1])
+
+    return mod_objs, changed
+
+
+def select_incremental(test_mods, mod_objs, changed):
+    """Narrow down to the modules that need to be rerun.
+
+    These are the modules that were (re-)loaded (see
+    :func:`load_modules`) or that failed on their most recent run.
+
+    Returns:
+        Tuple[List[str], List[module]]: The selected paths and modules.
+    """
+    with _LOCK:
+        keep = changed | _FAILED
+    pairs = [
+        (path, mod_obj)
+        for path, mod_obj in zip(test_mods, mod_objs)
+        if path in keep
+    ]
+    return [pair[0] for pair in pairs], [pair[1] for pair in pairs]
+
+
+def record_outcome(test_mods, failed):
+    """Record which of a set of test modules failed on their last run.
+
+    Args:
+        test_mods (Iterable[str]): The paths of the modules that ran.
+        failed (Iterable[str]): The paths of those that failed.
+    """
+    with _LOCK:
+        _FAILED.difference_update(test_mods)
+        _FAILED.update(failed)
+
+
+def failed_modules(test_mods, test_result):
+    """Map the failures and errors in a result to test module paths.
+
+    Args:
+        test_mods (List[str]): The paths of the modules that ran.
+        test_result (unittest.TestResult): The result of the run.
+
+    Returns:
+        Set[str]: The paths of the modules with a failure or error.
+    """
+    by_name = {}
+    for path in test_mods:
+        mod_name, _ = os.path.splitext(os.path.basename(path))
+        by_name[mod_name] = path
+
+    failed = set()
+    for test, _ in test_result.failures + test_result.errors:
+        path = by_name.get(type(test).__module__)
+        if path is not None:
+            failed.add(path)
+    return failed
+
+
+TestTiming = collections.namedtuple(
+    'TestTiming', ['test_id', 'status', 'duration', 'message'])
+
+
+class TimingResult(unittest.TextTestResult):
+    """Text test result that also records the status and wall time
+    of each test in :attr:`timings`.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(TimingResult, self).__init__(*args, **kwargs)
+        self.timings = []
+        self._start = None
+        self._status = None
+        self._message = None
+
+    def startTest(self, test):
+        self._start = time.time()
+        self._status = 'pass'
+        self._message = None
+        super(TimingResult, self).startTest(test)
+
+    def stopTest(self, test):
+        super(TimingResult, self).stopTest(test)
+        duration = time.time() - self._start
+        self.timings.append(
+            TestTiming(test.id(), self._status, duration, self._message))
+
+    def addError(self, test, err):
+        super(TimingResult, self).addError(test, err)
+        self._status = 'error'
+        self._message = self.errors[-1][1]
+
+    def addFailure(self, test, err):
+        super(TimingResult, self).addFailure(test, err)
+        self._status = 'failure'
+        self._message = self.failures[-1][1]
+
+    def addSkip(self, test, reason):
+        super(TimingResult, self).addSkip(test, reason)
+        self._status = 'skipped'
+        self._message = reason
+
+    def addExpectedFailure(self, test, err):
+        super(TimingResult, self).addExpectedFailure(test, err)
+        self._status = 'expected_failure'
+
+    def addUnexpectedSuccess(self, test):
+        super(TimingResult, self).addUnexpectedSuccess(test)
+        self._status = 'unexpected_success'
+
+
+class ModuleResult(object):
+    """The outcome of running the tests in a single module.
+
+    Args:
+        path (str): The path of the test module.
+        output (str): The text written by the test runner.
+        test_result (unittest.TestResult): The result of the run.
+        duration (float): The wall time (in seconds) of the run.
+    """
+
+    def __init__(self, path, output, test_result, duration):
+        self.path = path
+        self.output = output
+        self.test_result = test_result
+        self.duration = duration
+
+
+def run_module(path, mod_obj):
+    """Run all of the tests in a loaded module.
+
+    Args:
+        path (str): The path of the test module.
+        mod_obj (module): The loaded test module.
+
+    Returns:
+        ModuleResult: The outcome of the run.
+    """
+    start = time.time()
+    tests = unittest.defaultTestLoader.loadTestsFromModule(mod_obj)
+    stream = io.BytesIO()
+    test_result = unittest.TextTestRunner(
+        stream=stream, verbosity=2, resultclass=TimingResult).run(tests)
+    failed = () if test_result.wasSuccessful() else (path,)
+    record_outcome((path,), failed)
+    return ModuleResult(
+        path, stream.getvalue(), test_result, time.time() - start)
+
+
+def run_parallel(test_mods, mod_objs, max_workers=DEFAULT_WORKERS):
+    """Run test modules on a bounded thread pool.
+
+    Modules are loaded by the caller (``imp.load_module`` is not safe to
+    use concurrently) and run concurrently, but the results are yielded
+    in the order of ``test_mods``, each as soon as it (and every module
+    before it) is done.
+
+    Args:
+        test_mods (List[str]): The paths of the test modules.
+        mod_objs (List[module]): The loaded test modules.
+        max_workers (int): The size of the thread pool (capped at
+            :data:`MAX_WORKERS`).
+
+    Yields:
+        ModuleResult: The outcome of each module run.
+    """
+    max_workers = max(1, min(max_workers, MAX_WORKERS))
+    executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+    pending = []
+    try:
+        for path, mod_obj in zip(test_mods, mod_objs):
+            pending.append(executor.submit(run_module, path, mod_obj))
+        for future in pending:
+            yield future.result()
+    finally:
+        # NOTE: If the consumer stops early (e.g. the client disconnects)
+        #       there is no point running the remaining modules.
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _module_summary(mod_result):
+    test_result = mod_result.test_result
+    return {
+        'path': mod_result.path,
+        'duration': mod_result.duration,
+        'tests': test_result.testsRun,
+        'failures': len(test_result.failures),
+        'errors': len(test_result.errors),
+        'skipped': len(test_result.skipped),
+    }
+
+
+def _test_summary(path, timing):
+    return {
+        'module': path,
+        'id': timing.test_id,
+        'status': timing.status,
+        'duration': timing.duration,
+        'message': timing.message,
+    }
+
+
+def to_json(mod_results, slowest=DEFAULT_SLOWEST):
+    """Render module results as a JSON report.
+
+    Args:
+        mod_results (List[ModuleResult]): The outcome of each module.
+        slowest (int): The number of slowest tests to list separately.
+
+    Returns:
+        str: The JSON report, with per-module and per-test timings.
+    """
+    modules = [_module_summary(mod_result) for mod_result in mod_results]
+    tests = [
+        _test_summary(mod_result.path, timing)
+        for mod_result in mod_results
+        for timing in mod_result.test_result.timings
+    ]
+    totals = {'duration': sum(module['duration'] for module in modules)}
+    for key in ('tests', 'failures', 'errors', 'skipped'):
+        totals[key] = sum(module[key] for module in modules)
+
+    by_duration = sorted(
+        tests, key=lambda test: test['duration'], reverse=True)
+    report = {
+        'summary': totals,
+        'modules': modules,
+        'tests': tests,
+        'slowest': by_duration[:slowest],
+    }
+    return json.dumps(report, indent=2, sort_keys=True)
+
+
+def to_junit(mod_results):
+    """Render module results as a JUnit XML report.
+
+    Each test module becomes a ``<testsuite>``.
+
+    Args:
+        mod_results (List[ModuleResult]): The outcome of each module.
+
+    Returns:
+        str: The JUnit XML report.
+    """
+    root = ElementTree.Element('testsuites')
+    totals = collections.Counter()
+    for mod_result in mod_results:
+        summary = _module_summary(mod_result)
+        for key in ('tests', 'failures', 'errors', 'duration'):
+            totals[key] += summary[key]
+        suite = ElementTree.SubElement(root, 'testsuite', {
+            'name': mod_result.path,
+            'tests': str(summary['tests']),
+            'failures': str(summary['failures']),
+            'errors': str(summary['errors']),
+            'skipped': str(summary['skipped']),
+            'time': '{:.6f}'.format(summary['duration']),
+        })
+        for timing in mod_result.test_result.timings:
+            class_name, _, name = timing.test_id.rpartition('.')
+            case = ElementTree.SubElement(suite, 'testcase', {
+                'classname': class_name,
+                'name': name,
+                'time': '{:.6f}'.format(timing.duration),
+            })
+            if timing.status in ('failure', 'error', 'skipped'):
+                child = ElementTree.SubElement(case, timing.status)
+                child.text = timing.message
+
+    for key in ('tests', 'failures', 'errors'):
+        root.set(key, str(totals[key]))
+    root.set('time', '{:.6f}'.format(totals['duration']))
+    return ElementTree.tostring(root)
@@ -0,0 +1,178 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Warmup steps run by ``/_ah/warmup`` before an instance gets traffic.
+
+Each step pays (once per instance) for something the first real request
+would otherwise wait on. The steps to run are configured (in order) via
+the ``WARMUP_STEPS`` environment variable, e.g. ``imports,credentials``.
+Every step is idempotent, so warmup can safely be requested again.
+"""
+
+import importlib
+import logging
+import os
+import time
+
+import language_api
+
+
+STEPS_ENV = 'WARMUP_STEPS'
+CHANNEL_TIMEOUT_ENV = 'WARMUP_CHANNEL_TIMEOUT'
+DEFAULT_CHANNEL_TIMEOUT = 5.0
+# NOTE: These are imported at run-time (on purpose) by the request
+#       handlers, so nothing imports them at startup.
+HEAVY_IMPORTS = (
+    'google.cloud.language_v1',
+    'google.gax',
+    'google.protobuf.json_format',
+    'google.auth.transport.grpc',
+    'google.auth.transport.requests',
+)
+
+
+def import_heavy():
+    """Import the modules the request handlers import lazily."""
+    for mod_name in HEAVY_IMPORTS:
+        importlib.import_module(mod_name)
+
+
+def discover_credentials():
+    """Discover the (scoped) credentials the shared client will use."""
+    language_api.default_credentials()
+
+
+def build_client():
+    """Build the shared ``LanguageServiceClient`` (and its channel)."""
+    language_api.POOL.get_handle()
+
+
+def connect_channel():
+    """Wait for the shared client's channel to connect.
+
+    Raises:
+        RuntimeError: If the channel is not ready within the timeout.
+    """
+    timeout = float(
+        os.environ.get(CHANNEL_TIMEOUT_ENV, DEFAULT_CHANNEL_TIMEOUT))
+    if not language_api.POOL.check(timeout=timeout):
+        raise RuntimeError('Channel not ready', timeout)
+
+
+def refresh_token():
+    """Fetch an access token for the shared client's credentials.
+
+    Otherwise the token is fetched (by the channel) during the first RPC.
+    """
+    credentials = language_api.POOL.get_handle().credentials
+    if credentials is None or credentials.valid:
+        return
+
+    # NOTE: We intentionally import at run-time.
+    import google.auth.transport.requests
+
+    credentials.refresh(google.auth.transport.requests.Request())
+
+
+STEPS = (
+    ('imports', import_heavy),
+    ('credentials', discover_credentials),
+    ('client', build_client),
+    ('channel', connect_channel),
+    ('token', refresh_token),
+)
+DEFAULT_STEPS = tuple(name for name, _ in STEPS)
+
+
+class StepResult(object):
+    """The result of running a single warmup step.
+
+    Args:
+        name (str): The name of the step.
+        duration (float): The time (in seconds) the step took.
+        error (Optional[Exception]): The exception raised (on failure).
+    """
+
+    def __init__(self, name, duration, error=None):
+        self.name = name
+        self.duration = duration
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def to_dict(self):
+        info = {
+            'name': self.name,
+            'ok': self.ok,
+            'ms': round(1000.0 * self.duration, 3),
+        }
+        if self.error is not None:
+            info['error'] = '{}: {}'.format(
+                self.error.__class__.__name__, self.error)
+        return info
+
+
+def configured_steps():
+    """Get the names of the steps to run from the environment.
+
+    Returns:
+        Tuple[str, ...]: The step names (defaults to all of them).
+    """
+    value = os.environ.get(STEPS_ENV)
+    if value is None:
+        return DEFAULT_STEPS
+    return tuple(name.strip() for name in value.split(',') if name.strip())
+
+
+def run(step_names=None):
+    """Run warmup steps in order.
+
+    A failing step is logged (and reported) but does not stop the
+    remaining steps.
+
+    Args:
+        step_names (Optional[Iterable[str]]): The steps to run. Defaults
+            to :func:`configured_steps`.
+
+    Returns:
+        List[StepResult]: The result of each step.
+
+    Raises:
+        ValueError: If a step name is not known.
+    """
+    if step_names is None:
+        step_names = configured_steps()
+    step_funcs = dict(STEPS)
+    unknown = [name for name in step_names if name not in step_funcs]
+    if unknown:
+        raise ValueError(
+            'Unknown warmup step(s), expected some of: {}.'.format(
+                ', '.join(DEFAULT_STEPS)))
+
+    results = []
+    for name in step_names:
+        start = time.time()
+        error = None
+        try:
+            step_funcs[name]()
+        except Exception as exc:
+            logging.exception('Warmup step %r failed', name)
+            error = exc
+        result = StepResult(name, time.time() - start, error=error)
+        logging.info(
+            'Warmup step %r took %.1fms', name, 1000.0 * result.duration)
+        results.append(result)
+    return results
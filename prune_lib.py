@@ -0,0 +1,376 @@
+# Copyright 2017 Google Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Prune a vendored ``lib/`` down to the modules the app actually imports.
+
+``requirements.txt`` pulls in test-only packages (``mock``, ``pbr``,
+``funcsigs``, ...) and large parts of other packages that ``main.py``
+never touches, and every one of those files is uploaded on deploy. This
+loads the app outside of App Engine (with the stand-ins in
+``app_fakes.py``), requests a set of entry routes with the Flask test
+client and records every module imported from ``lib/``. The output
+directory contains only:
+
+* The modules that were imported (along with the data files next to
+  them, e.g. ``certifi/cacert.pem``).
+* The ``*.dist-info`` / ``*.egg-info`` metadata (and ``*-nspkg.pth``
+  files) for distributions that still have a module left.
+* Anything matching a ``--keep`` pattern.
+
+Modules that ``main.py`` defers with ``importers.LazyModule`` (e.g.
+``boltons.tbutils``, only used once a route fails) are imported after
+the routes, so they are kept even though no route needed them.
+
+Modules only imported by routes that were **not** requested are pruned,
+e.g. the unit test dependencies unless ``--route /unit-tests`` is given::
+
+    $ language-app/clean-env/bin/python prune_lib.py language-app/lib-pruned
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import fnmatch
+import json
+import os
+import shutil
+import sys
+
+import app_fakes
+
+
+INFO_SUFFIXES = ('.dist-info', '.egg-info')
+BYTECODE_SUFFIXES = ('.pyc', '.pyo')
+SOURCE_SUFFIXES = ('.py',) + BYTECODE_SUFFIXES
+# NOTE: Each route is ``(method, path, JSON body)``.
+ROUTES = (
+    ('GET', '/', None),
+    ('GET', '/info', None),
+    ('GET', '/import', None),
+    ('GET', '/auth-check', None),
+    ('GET', '/system-tests', None),
+    ('POST', '/analyze/batch', ['Hello, world!', {'content': 'Goodbye.'}]),
+    ('POST', '/analyze/annotate', {'document': 'Hello, World!'}),
+    ('POST', '/analyze/chunked?max_bytes=8', 'Hello. Good day.'),
+    ('GET', '/cache-stats', None),
+    ('GET', '/startup-profile', None),
+    ('GET', '/_ah/warmup', None),
+)
+
+RouteStatus = collections.namedtuple(
+    'RouteStatus', ['method', 'path', 'status_code', 'ok'])
+
+
+def trace(routes=ROUTES, app_dir=app_fakes.APP_DIR):
+    """Load the app, request each route and collect the imported files.
+
+    Args:
+        routes (Iterable[Tuple[str, str, object]]): The method, path and
+            (optional) JSON body of each request.
+        app_dir (str): The root of the App Engine app.
+
+    Returns:
+        Tuple[str, Set[str], List[RouteStatus], List[str]]: The
+        (absolute) vendor directory, the paths (relative to it) of every
+        source file imported from it, the status of each request and the
+        names of the modules deferred by ``main.py``.
+    """
+    app = app_fakes.load_app(app_dir)
+    client = app.test_client()
+
+    statuses = []
+    for method, path, body in routes:
+        kwargs = {}
+        if body is not None:
+            kwargs['data'] = json.dumps(body)
+            kwargs['content_type'] = 'application/json'
+        response = client.open(path, method=method, **kwargs)
+        # NOTE: This consumes streamed responses so their generators run.
+        ok = app_fakes.response_ok(response)
+        statuses.append(
+            RouteStatus(method, path, response.status_code, ok))
+
+    # NOTE: A deferred module may only be imported on an error path,
+    #       which none of the routes take.
+    import main
+
+    lazy_names = []
+    for lazy_module in lazy_modules(main):
+        lazy_names.append(lazy_module.mod_name)
+        lazy_module.import_error()
+
+    import appengine_config
+
+    vendor_dir = os.path.realpath(appengine_config.VENDOR_DIR)
+    return vendor_dir, imported_files(vendor_dir), statuses, lazy_names
+
+
+def lazy_modules(module):
+    """Get the ``importers.LazyModule`` stand-ins defined in a module."""
+    import importers
+
+    return sorted(
+        (value for value in vars(module).values()
+         if isinstance(value, importers.LazyModule)),
+        key=lambda lazy_module: lazy_module.mod_name)
+
+
+def missing_lazy_modules(vendor_dir, kept, lazy_names):
+    """Get the deferred modules from ``lib/`` that would be pruned.
+
+    Args:
+        vendor_dir (str): The (real, absolute) vendor directory.
+        kept (Dict[str, int]): The kept files (see :func:`plan`).
+        lazy_names (Iterable[str]): The names of the deferred modules.
+
+    Returns:
+        List[str]: The names of the modules whose file is not kept.
+    """
+    prefix = vendor_dir + os.sep
+    missing = []
+    for mod_name in lazy_names:
+        filename = getattr(sys.modules.get(mod_name), '__file__', None)
+        if not filename:
+            continue
+        path = os.path.realpath(filename)
+        if not path.startswith(prefix):
+            continue
+        if path.endswith(BYTECODE_SUFFIXES):
+            path = path[:-1]
+        if os.path.relpath(path, vendor_dir) not in kept:
+            missing.append(mod_name)
+    return missing
+
+
+def imported_files(vendor_dir):
+    """Get the source files of all modules imported from a directory.
+
+    Args:
+        vendor_dir (str): The (real, absolute) vendor directory.
+
+    Returns:
+        Set[str]: The paths of the files, relative to ``vendor_dir``.
+    """
+    prefix = vendor_dir + os.sep
+    used = set()
+    for module in list(sys.modules.values()):
+        filename = getattr(module, '__file__', None)
+        if not filename:
+            continue
+        path = os.path.realpath(filename)
+        if not path.startswith(prefix):
+            continue
+        if path.endswith(BYTECODE_SUFFIXES) and os.path.exists(path[:-1]):
+            path = path[:-1]
+        used.add(os.path.relpath(path, vendor_dir))
+    return used
+
+
+def _walk_files(vendor_dir):
+    """Get every non-bytecode file in a directory (following links)."""
+    sizes = {}
+    for dirpath, _, filenames in os.walk(vendor_dir, followlinks=True):
+        for filename in filenames:
+            if filename.endswith(BYTECODE_SUFFIXES):
+                continue
+            path = os.path.join(dirpath, filename)
+            sizes[os.path.relpath(path, vendor_dir)] = os.path.getsize(path)
+    return sizes
+
+
+def _recorded_files(vendor_dir, info_dir):
+    """Get the files installed by a distribution (relative to ``lib/``).
+
+    Returns:
+        Optional[Set[str]]: The files from ``RECORD`` (wheels) or
+        ``installed-files.txt`` (eggs), or :data:`None` if neither exists.
+    """
+    info_path = os.path.join(vendor_dir, info_dir)
+    record = os.path.join(info_path, 'RECORD')
+    if os.path.isfile(record):
+        with open(record, 'r') as file_obj:
+            return set(
+                os.path.normpath(line.split(',', 1)[0])
+                for line in file_obj if line.strip())
+
+    installed = os.path.join(info_path, 'installed-files.txt')
+    if os.path.isfile(installed):
+        with open(installed, 'r') as file_obj:
+            return set(
+                os.path.normpath(os.path.join(info_dir, line.strip()))
+                for line in file_obj if line.strip())
+
+    return None
+
+
+def plan(vendor_dir, used, keep_patterns=()):
+    """Decide which files of the vendor directory to keep.
+
+    Args:
+        vendor_dir (str): The vendor directory.
+        used (Set[str]): The imported files (see :func:`imported_files`).
+        keep_patterns (Iterable[str]): ``fnmatch`` patterns (relative to
+            ``vendor_dir``) of files to always keep.
+
+    Returns:
+        Tuple[Dict[str, int], Dict[str, int]]: The kept and the removed
+        files, each mapped to its size in bytes.
+    """
+    sizes = _walk_files(vendor_dir)
+    used_dirs = set(os.path.dirname(path) for path in used)
+
+    kept = set()
+    for path in sizes:
+        dirname = os.path.dirname(path)
+        if path in used:
+            kept.add(path)
+        elif dirname and dirname in used_dirs and not path.endswith(
+                SOURCE_SUFFIXES):
+            kept.add(path)
+        elif any(fnmatch.fnmatch(path, pattern) for pattern in keep_patterns):
+            kept.add(path)
+
+    for info_dir in sorted(os.listdir(vendor_dir)):
+        if not info_dir.endswith(INFO_SUFFIXES):
+            continue
+        recorded = _recorded_files(vendor_dir, info_dir)
+        if recorded is not None:
+            present = recorded.intersection(sizes)
+            present = set(
+                path for path in present if not path.startswith(info_dir))
+            # NOTE: Metadata for a distribution whose code lives outside
+            #       of ``lib/`` (e.g. ``grpcio``) is always kept.
+            if present and not present.intersection(kept):
+                continue
+            kept.update(
+                path for path in present if path.endswith('.pth'))
+        kept.update(
+            path for path in sizes
+            if path.startswith(info_dir + os.sep))
+
+    removed = dict(
+        (path, size) for path, size in sizes.items() if path not in kept)
+    kept = dict((path, sizes[path]) for path in kept)
+    return kept, removed
+
+
+def write_pruned(vendor_dir, dest_dir, kept):
+    """Copy the kept files (following links) into a new directory."""
+    if os.path.exists(dest_dir):
+        shutil.rmtree(dest_dir)
+    for path in sorted(kept):
+        dest_path = os.path.join(dest_dir, path)
+        parent = os.path.dirname(dest_path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent)
+        shutil.copy2(os.path.join(vendor_dir, path), dest_path)
+
+
+def _top_level(path):
+    return path.split(os.sep, 1)[0]
+
+
+def report(kept, removed, statuses):
+    """Summarize the pruning as lines of text."""
+    lines = []
+    for status in statuses:
+        lines.append('{} {} -> {}{}'.format(
+            status.method, status.path, status.status_code,
+            '' if status.ok else ' (failed)'))
+    lines.append('')
+
+    by_top = collections.defaultdict(lambda: [0, 0])
+    for path, size in removed.items():
+        totals = by_top[_top_level(path)]
+        totals[0] += 1
+        totals[1] += size
+    kept_tops = set(_top_level(path) for path in kept)
+    ordered = sorted(by_top.items(), key=lambda item: -item[1][1])
+    for name, (count, size) in ordered:
+        partial = ' (partial)' if name in kept_tops else ''
+        lines.append('Removed {:5d} files {:10d} bytes  {}{}'.format(
+            count, size, name, partial))
+
+    total = len(kept) + len(removed)
+    total_bytes = sum(kept.values()) + sum(removed.values())
+    lines.append('')
+    lines.append(
+        'Removed {} of {} files and {:.1f} of {:.1f} MB; '
+        'kept {} files ({:.1f} MB)'.format(
+            len(removed), total, sum(removed.values()) / 1e6,
+            total_bytes / 1e6, len(kept), sum(kept.values()) / 1e6))
+    return lines
+
+
+def _parse_route(value):
+    """Parse ``'[METHOD] PATH'`` into a route (without a body)."""
+    parts = value.split()
+    if len(parts) == 1:
+        return 'GET', parts[0], None
+    if len(parts) == 2:
+        return parts[0].upper(), parts[1], None
+    raise argparse.ArgumentTypeError('Expected [METHOD] PATH', value)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(
+        description='Prune vendored packages to those the app imports.')
+    parser.add_argument('dest_dir', help='The pruned directory to create.')
+    parser.add_argument(
+        '--app-dir', default=app_fakes.APP_DIR,
+        help='The root of the App Engine app (default: %(default)s).')
+    parser.add_argument(
+        '--route', dest='routes', action='append', type=_parse_route,
+        help=('An extra route to request, as "[METHOD] PATH" (can be '
+              'repeated).'))
+    parser.add_argument(
+        '--keep', dest='keep_patterns', action='append', default=[],
+        help='A pattern (relative to lib/) of files to always keep.')
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help='Only report what would be removed.')
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    dest_dir = os.path.abspath(args.dest_dir)
+    routes = ROUTES + tuple(args.routes or ())
+    vendor_dir, used, statuses, lazy_names = trace(
+        routes, app_dir=args.app_dir)
+    kept, removed = plan(vendor_dir, used, keep_patterns=args.keep_patterns)
+
+    for line in report(kept, removed, statuses):
+        print(line)
+    failed = [status for status in statuses if not status.ok]
+    if failed:
+        msg = 'Some routes failed, so not every import was traced: {}'.format(
+            ', '.join(status.path for status in failed))
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+    missing = missing_lazy_modules(vendor_dir, kept, lazy_names)
+    if missing:
+        msg = 'Modules deferred by main.py would be pruned: {}'.format(
+            ', '.join(missing))
+        print(msg, file=sys.stderr)
+        sys.exit(1)
+
+    if not args.dry_run:
+        write_pruned(vendor_dir, dest_dir, kept)
+        print('Wrote {}'.format(dest_dir))
+
+
+if __name__ == '__main__':
+    main()